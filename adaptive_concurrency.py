@@ -0,0 +1,148 @@
+import time
+import threading
+from contextlib import contextmanager
+import requests
+from tracing import get_tracer
+
+# (initial, maximum) requests in flight per provider; the limit adapts between 1 and the maximum
+PROVIDER_LIMITS = {
+    "anthropic": (4, 32),
+    "elevenlabs.stt": (2, 16),
+    "elevenlabs.tts": (2, 16),
+    "youtube": (4, 32),
+    "youtube.transcript": (2, 8),
+}
+DEFAULT_LIMITS = (2, 16)
+
+# Multiplicative decrease on throttling and errors, and the latency rise that stops increases
+DECREASE_FACTOR = 0.5
+LATENCY_FACTOR = 3.0
+
+# The circuit opens after this many consecutive errors (not throttles) and stays open for OPEN_SECONDS
+FAILURE_THRESHOLD = 5
+OPEN_SECONDS = 30
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of sending a request while a provider's circuit is open."""
+
+def classify_status(status):
+    """Map an HTTP status to "throttled", "error" or "success" (client errors say nothing about capacity)."""
+    if status in (429, 529):
+        return "throttled"
+    if status == 408 or status >= 500:
+        return "error"
+    return "success"
+
+def classify_exception(e):
+    """Map an exception raised by a request to an outcome, or None if it says nothing about the provider."""
+    # googleapiclient's HttpError carries the response in e.resp
+    status = getattr(getattr(e, "resp", None), "status", None)
+    if status is not None:
+        return classify_status(int(status))
+    # youtube_transcript_api reports throttling with its own exception types
+    if type(e).__name__ in ("TooManyRequests", "IpBlocked", "RequestBlocked"):
+        return "throttled"
+    if isinstance(e, (requests.exceptions.RequestException, OSError)):
+        return "error"
+    return None
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the requests in flight to one provider, with a circuit breaker.
+
+    Every success raises the limit by 1/limit (about one per round of requests) unless the
+    latency has risen well above the fastest seen; a 429/529 or server error halves it, at
+    most once per round trip. After FAILURE_THRESHOLD consecutive errors (server errors or
+    connection failures; throttling only means "slower") the circuit opens and requests fail
+    fast with CircuitOpenError for OPEN_SECONDS; then one probe request at a time is let
+    through until one succeeds.
+    """
+
+    def __init__(self, name, initial=2, max_limit=16):
+        self.name = name
+        self.limit = float(initial)
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.min_latency = None
+        self.last_decrease = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot. Raises CircuitOpenError while the circuit is open."""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if now < self.open_until:
+                    raise CircuitOpenError(f"{self.name} circuit open after {self.failures} consecutive failures, "
+                                           f"retrying in {self.open_until - now:.0f}s")
+                # Half-open: a single probe at a time until a request succeeds again
+                limit = 1 if self.failures >= FAILURE_THRESHOLD else int(self.limit)
+                if self.in_flight < limit:
+                    self.in_flight += 1
+                    return
+                self.condition.wait()
+
+    def release(self, outcome, latency):
+        """Free a slot and adapt the limit to the outcome ("success", "throttled", "error" or None)."""
+        tracer = get_tracer()
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+
+            if outcome == "success":
+                self.failures = 0
+                self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+                if latency <= LATENCY_FACTOR * self.min_latency:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif outcome in ("throttled", "error"):
+                # Requests already in flight fail together, so decrease once per round trip
+                if now - self.last_decrease > latency:
+                    self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+                    self.last_decrease = now
+                    tracer.event("limit", self.name, limit=round(self.limit, 2), reason=outcome)
+                if outcome == "error":
+                    self.failures += 1
+                if outcome == "error" and self.failures >= FAILURE_THRESHOLD:
+                    self.open_until = now + OPEN_SECONDS
+                    print(f"  ✗ {self.failures} consecutive failures from {self.name}, "
+                          f"pausing its requests for {OPEN_SECONDS}s")
+                    tracer.event("limit", self.name, limit=round(self.limit, 2), reason="circuit open")
+
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """
+        Hold a slot for one request. Set slot["status"] to the HTTP status inside the block;
+        exceptions are classified with classify_exception and re-raised.
+        """
+        self.acquire()
+        started = time.monotonic()
+        state = {"status": None}
+        try:
+            yield state
+        except Exception as e:
+            self.release(classify_exception(e), time.monotonic() - started)
+            raise
+        self.release(classify_status(state["status"]) if state["status"] is not None else "success",
+                     time.monotonic() - started)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_provider(endpoint):
+    """Return the provider an endpoint name belongs to, e.g. "anthropic" for "anthropic.messages"."""
+    if endpoint in PROVIDER_LIMITS:
+        return endpoint
+    return endpoint.split(".")[0]
+
+def get_limiter(endpoint):
+    """Return the process-wide limiter of the provider serving an endpoint."""
+    provider = get_provider(endpoint)
+    with _limiters_lock:
+        if provider not in _limiters:
+            initial, max_limit = PROVIDER_LIMITS.get(provider, DEFAULT_LIMITS)
+            _limiters[provider] = AdaptiveLimiter(provider, initial, max_limit)
+        return _limiters[provider]
@@ -0,0 +1,422 @@
+import os
+import sys
+import json
+import time
+import zlib
+import queue
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from media_probe import get_mp3_data_duration
+
+STAGES = ["prepare_video", "generate_advice", "generate_video", "prepare_knowledge"]
+
+# Vocabulary for fake transcripts, tips and advice
+WORDS = ("settle", "scout", "city", "science", "culture", "gold", "army", "river", "wonder", "district",
+         "production", "food", "trade", "border", "age", "legacy", "town", "resource", "commander", "policy")
+
+def fake_sentence(rng, length=12):
+    return " ".join(rng.choice(WORDS) for _ in range(length)).capitalize() + "."
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Fake Anthropic, ElevenLabs and YouTube endpoints with configurable latency and 429 rate.
+
+    Responses are generated, not recorded, so they have the shape of the real APIs but
+    their content is meaningless. Throttling only applies to Anthropic and ElevenLabs,
+    whose clients retry; the YouTube client would just drop the failed search.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json', headers=None):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _begin(self, endpoint, throttle=True):
+        """Count the request, apply the latency and decide whether to throttle it."""
+        state = self.server.state
+        with state["lock"]:
+            state["requests"][endpoint] = state["requests"].get(endpoint, 0) + 1
+            throttled = throttle and state["rng"].random() < state["rate_429"]
+            if throttled:
+                state["throttled"][endpoint] = state["throttled"].get(endpoint, 0) + 1
+        time.sleep(state["latency"])
+        if throttled:
+            self._send(429, {"type": "error", "error": {"type": "rate_limit_error", "message": "Stand-in throttle"}},
+                       headers={"retry-after": "1"})
+        return not throttled
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = urlparse(self.path).path
+        rng = random.Random(len(body))
+
+        if path == "/v1/messages":
+            if not self._begin("anthropic.messages"):
+                return
+            request = json.loads(body)
+            # Advice requests use a list of system blocks, knowledge extraction a plain string
+            if isinstance(request.get("system"), list):
+                text = fake_sentence(rng, 40)
+            else:
+                text = "# Tips\n\n## General\n" + "\n".join(f"- {fake_sentence(rng)}" for _ in range(25))
+            self._send(200, {
+                "id": "msg_standin",
+                "type": "message",
+                "role": "assistant",
+                "content": [{"type": "text", "text": text}],
+                "usage": {"input_tokens": len(body) // 4, "output_tokens": len(text) // 4,
+                          "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+            })
+        elif path == "/v1/speech-to-text":
+            if not self._begin("elevenlabs.stt"):
+                return
+            # The MP3 frames inside the multipart body give the audio duration
+            duration = get_mp3_data_duration(body)
+            words = []
+            t = 0.0
+            while t + 0.3 < duration:
+                words.append({"text": rng.choice(WORDS), "start": round(t, 3), "end": round(t + 0.3, 3), "type": "word"})
+                words.append({"text": " ", "start": round(t + 0.3, 3), "end": round(t + 0.35, 3), "type": "spacing"})
+                t += 0.35
+            self._send(200, {"text": "".join(w["text"] for w in words).strip(), "words": words,
+                             "language_code": "en"})
+        elif path.startswith("/v1/text-to-speech/"):
+            if not self._begin("elevenlabs.tts"):
+                return
+            self._send(200, self.server.state["speech_mp3"], content_type='audio/mpeg')
+        else:
+            self._send(404, {"error": f"Unknown endpoint {path}"})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == "/youtube/v3/search":
+            self._begin("youtube.search", throttle=False)
+            q = query.get("q", [""])[0]
+            max_results = int(query.get("maxResults", ["10"])[0])
+            items = [{
+                "id": {"kind": "youtube#video", "videoId": f"{zlib.crc32(q.encode('utf-8')) % 10**6:06d}{i:05d}"[:11]},
+                "snippet": {"title": f"Guide {q} {i}", "channelTitle": "Stand-in", "publishedAt": "2025-01-01T00:00:00Z"}
+            } for i in range(max_results)]
+            self._send(200, {"items": items})
+        elif url.path == "/youtube/v3/videos":
+            self._begin("youtube.videos", throttle=False)
+            ids = query.get("id", [""])[0].split(",")
+            self._send(200, {"items": [{
+                "id": video_id,
+                "contentDetails": {"duration": "PT20M"},
+                "statistics": {"viewCount": "1000", "likeCount": "10", "commentCount": "1"},
+                "snippet": {"description": "Stand-in video"}
+            } for video_id in ids if video_id]})
+        elif url.path.startswith("/youtube-transcripts/"):
+            self._begin("youtube.transcript", throttle=False)
+            rng = random.Random(url.path)
+            self._send(200, [{"text": fake_sentence(rng, 8), "start": i * 3.0, "duration": 3.0} for i in range(400)])
+        else:
+            self._send(404, {"error": f"Unknown endpoint {url.path}"})
+
+def start_standin(latency, rate_429, speech_mp3, seed=0):
+    """Start the stand-in server on a free local port. Returns (server, base_url)."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.state = {
+        "lock": threading.Lock(),
+        "rng": random.Random(seed),
+        "latency": latency,
+        "rate_429": rate_429,
+        "speech_mp3": speech_mp3,
+        "requests": {},
+        "throttled": {}
+    }
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def generate_synthetic_video(video_path, duration):
+    """Render a gameplay-like test video: moving test pattern with scene changes and a tone."""
+    scene = max(1, duration // 4)
+    cmd = [
+        'ffmpeg', '-v', 'error',
+        '-f', 'lavfi', '-i', f"testsrc2=size=1280x720:rate=30:duration={duration}",
+        '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}",
+        '-vf', f"hue=h='360*floor(t/{scene})/4'",
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac',
+        '-y', video_path
+    ]
+    subprocess.run(cmd, check=True)
+
+def generate_speech_mp3(path, duration=3):
+    """Render the clip the text-to-speech stand-in returns for every request."""
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f"sine=frequency=220:duration={duration}",
+        '-c:a', 'libmp3lame', '-b:a', '64k', '-y', path
+    ], check=True)
+
+def generate_synthetic_knowledge(knowledge_dir, files=5, tips=40, seed=0):
+    """Write knowledge files in the format prepare_knowledge produces."""
+    rng = random.Random(seed)
+    os.makedirs(knowledge_dir, exist_ok=True)
+    for i in range(files):
+        with open(os.path.join(knowledge_dir, f"video{i:06d}_Synthetic guide {i}_knowledge.txt"), 'w', encoding='utf-8') as f:
+            f.write("# Tips\n\n## General\n" + "\n".join(f"- {fake_sentence(rng)}" for _ in range(tips)) + "\n")
+
+def bench_prepare_video(config):
+    import prepare_video
+    if not prepare_video.prepare_video(
+        config["video_path"], config["work_dir"],
+        batch_extract=config["batch_extract"], workers=config["workers"], transcription=config["transcription"]
+    ):
+        raise RuntimeError("prepare_video failed")
+    with open(os.path.join(config["prepared_dir"], "metadata.json"), 'r', encoding='utf-8') as f:
+        return len(json.load(f)["segments"])
+
+def bench_generate_advice(config):
+    import generate_advice
+    generate_advice.process_segments(config["knowledge_dir"], config["prepared_dir"], generate_speech=True,
+                                     top_k=config["top_k"])
+    return sum(1 for f in os.listdir(config["prepared_dir"]) if f.startswith("advice_") and f.endswith(".txt"))
+
+def bench_generate_video(config):
+    import generate_video
+    if not generate_video.generate_video_with_advice(config["video_path"], config["prepared_dir"],
+                                                     os.path.join(config["work_dir"], "output.mp4")):
+        raise RuntimeError("generate_video_with_advice failed")
+    return 1
+
+def bench_prepare_knowledge(config):
+    import requests
+    import prepare_knowledge
+
+    # youtube_transcript_api has no endpoint setting, so transcripts come from the stand-in directly
+    def get_transcript(video_id, *args, **kwargs):
+        response = requests.get(f"{config['base_url']}/youtube-transcripts/{video_id}", timeout=30)
+        response.raise_for_status()
+        return response.json()
+    prepare_knowledge.YouTubeTranscriptApi.get_transcript = staticmethod(get_transcript)
+
+    output_folder = os.path.join(config["work_dir"], "knowledge_crawl")
+    queries = [f"query {i}" for i in range(config["queries"])]
+    prepare_knowledge.prepare_knowledge(output_folder, queries, config["results_per_query"])
+    return len(os.listdir(os.path.join(output_folder, "knowledge")))
+
+STAGE_FUNCTIONS = {
+    "prepare_video": bench_prepare_video,
+    "generate_advice": bench_generate_advice,
+    "generate_video": bench_generate_video,
+    "prepare_knowledge": bench_prepare_knowledge
+}
+
+def get_peak_rss_mb():
+    """Peak resident set size of this process and its finished children (e.g. FFmpeg), in MB."""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _stage_worker(name, config, log_path, results):
+    # Keep the pipelines' progress output out of the report
+    log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+
+    tracer = None
+    if config["trace"]:
+        from tracing import configure_tracing
+        tracer = configure_tracing(os.path.join(config["work_dir"], f"trace_{name}.jsonl"))
+
+    start = time.perf_counter()
+    try:
+        if tracer:
+            with tracer.span(name):
+                items = STAGE_FUNCTIONS[name](config)
+        else:
+            items = STAGE_FUNCTIONS[name](config)
+        error = None
+    except BaseException as e:
+        # Stage code may call sys.exit on failure; report it instead of dying without a result
+        items = 0
+        error = f"{type(e).__name__}: {e}"
+    metrics = {"wallSeconds": time.perf_counter() - start, "items": items, "error": error,
+               "peakRssMb": get_peak_rss_mb()}
+    if tracer:
+        metrics["trace"] = tracer.summary_rows()
+        tracer.print_summary()
+        tracer.close()
+    sys.stdout.flush()
+    results.put(metrics)
+
+def run_stage(name, config, server, log_path):
+    """Run one pipeline stage in a fresh process so its wall time and peak RSS are isolated."""
+    before = {key: dict(server.state[key]) for key in ("requests", "throttled")}
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    process = context.Process(target=_stage_worker, args=(name, config, log_path, results))
+    process.start()
+    started = time.perf_counter()
+    metrics = None
+    while metrics is None:
+        try:
+            metrics = results.get(timeout=1)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+            # The result may have been queued just before the process exited
+            try:
+                metrics = results.get(timeout=1)
+            except queue.Empty:
+                metrics = {"wallSeconds": time.perf_counter() - started, "items": 0, "peakRssMb": 0.0,
+                           "error": f"stage process exited with code {process.exitcode} without a result"}
+    process.join()
+
+    metrics["itemsPerSecond"] = metrics["items"] / metrics["wallSeconds"] if metrics["wallSeconds"] else 0.0
+    for key in ("requests", "throttled"):
+        metrics[key] = {
+            endpoint: count - before[key].get(endpoint, 0)
+            for endpoint, count in server.state[key].items()
+            if count - before[key].get(endpoint, 0)
+        }
+    return metrics
+
+def get_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        return result.stdout.strip() or None
+    except Exception:
+        return None
+
+def run_benchmark(stages, duration=300, latency=0.2, rate_429=0.0, workers=4, batch_extract=True,
+                  transcription="segment", top_k=0, queries=2, results_per_query=5, work_dir=None, seed=0,
+                  trace=False):
+    """
+    Run the selected pipeline stages against synthetic media and the local stand-in server.
+
+    Every stage runs in its own process with a fresh response cache, and the report holds
+    wall time, items processed per second, peak RSS and the API requests each stage made.
+    With trace, each stage also writes trace_<stage>.jsonl and its totals go into the report.
+    """
+    work_dir = work_dir or tempfile.mkdtemp(prefix="duoai_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    log_path = os.path.join(work_dir, "pipeline.log")
+
+    print(f"Preparing synthetic media in {work_dir}...")
+    video_path = os.path.join(work_dir, "synthetic.mp4")
+    generate_synthetic_video(video_path, duration)
+    speech_path = os.path.join(work_dir, "speech.mp3")
+    generate_speech_mp3(speech_path)
+    knowledge_dir = os.path.join(work_dir, "knowledge")
+    generate_synthetic_knowledge(knowledge_dir, seed=seed)
+
+    with open(speech_path, 'rb') as f:
+        server, base_url = start_standin(latency, rate_429, f.read(), seed=seed)
+
+    # Every client reads its endpoint from the environment, which the stage processes inherit
+    os.environ.update({
+        "ANTHROPIC_BASE_URL": base_url,
+        "ELEVENLABS_BASE_URL": base_url,
+        "YOUTUBE_API_ENDPOINT": f"{base_url}/",
+        "ANTHROPIC_API_KEY": "standin",
+        "ELEVENLABS_API_KEY": "standin",
+        "YOUTUBE_API_KEY": "standin",
+        "DUOAI_CACHE_DIR": os.path.join(work_dir, "cache")
+    })
+
+    config = {
+        "base_url": base_url,
+        "work_dir": work_dir,
+        "video_path": video_path,
+        "prepared_dir": os.path.join(work_dir, "synthetic-prepared"),
+        "knowledge_dir": knowledge_dir,
+        "workers": workers,
+        "batch_extract": batch_extract,
+        "transcription": transcription,
+        "top_k": top_k,
+        "queries": queries,
+        "results_per_query": results_per_query,
+        "trace": trace
+    }
+
+    report = {
+        "commit": get_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "videoSeconds": duration, "latencySeconds": latency, "rate429": rate_429, "workers": workers,
+            "batchExtract": batch_extract, "transcription": transcription, "topK": top_k,
+            "queries": queries, "resultsPerQuery": results_per_query
+        },
+        "stages": {}
+    }
+
+    try:
+        for name in stages:
+            print(f"Running {name}...")
+            metrics = run_stage(name, config, server, log_path)
+            report["stages"][name] = metrics
+            status = f"✗ {metrics['error']}" if metrics["error"] else "✓"
+            print(f"  {status} {metrics['wallSeconds']:.2f}s, {metrics['items']} items "
+                  f"({metrics['itemsPerSecond']:.2f}/s), peak RSS {metrics['peakRssMb']:.0f} MB")
+    finally:
+        server.shutdown()
+
+    print(f"Pipeline output logged to {log_path}")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipelines offline with synthetic media and local API stand-ins.")
+    parser.add_argument("--stages", nargs='+', choices=STAGES, default=STAGES, help="Stages to run, in order (default: all)")
+    parser.add_argument("--duration", type=int, default=300, help="Length of the synthetic video in seconds (default: 300)")
+    parser.add_argument("--latency-ms", type=float, default=200, help="Stand-in response latency in milliseconds (default: 200)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of API requests answered with 429 (default: 0.0)")
+    parser.add_argument("--workers", type=int, default=4, help="prepare_video workers (default: 4)")
+    parser.add_argument("--no-batch-extract", action="store_true", help="Extract segments one by one in prepare_video")
+    parser.add_argument("--transcription", choices=["segment", "track"], default="segment", help="prepare_video transcription mode (default: segment)")
+    parser.add_argument("--top-k", type=int, default=0, help="generate_advice knowledge retrieval (default: 0, send all knowledge)")
+    parser.add_argument("--queries", type=int, default=2, help="prepare_knowledge search queries (default: 2)")
+    parser.add_argument("--results-per-query", type=int, default=5, help="prepare_knowledge results per query (default: 5)")
+    parser.add_argument("--work-dir", help="Directory for synthetic media and outputs (default: a new temporary directory)")
+    parser.add_argument("--output", help="Write the JSON report to this file (default: print it)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for generated content and throttling (default: 0)")
+    parser.add_argument("--trace", action="store_true", help="Trace every stage and include the trace totals in the report")
+
+    args = parser.parse_args()
+
+    report = run_benchmark(
+        args.stages,
+        duration=args.duration,
+        latency=args.latency_ms / 1000,
+        rate_429=args.rate_429,
+        workers=args.workers,
+        batch_extract=not args.no_batch_extract,
+        transcription=args.transcription,
+        top_k=args.top_k,
+        queries=args.queries,
+        results_per_query=args.results_per_query,
+        work_dir=args.work_dir,
+        seed=args.seed,
+        trace=args.trace
+    )
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"✓ Report saved to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import hashlib
+from http_client import request_with_retries
+from tracing import get_tracer
+
+# Limits of the Message Batches API (per batch), with some headroom on the size
+MAX_BATCH_REQUESTS = 100000
+MAX_BATCH_BYTES = 200 * 1024 * 1024
+
+def get_anthropic_base_url():
+    """Return the Anthropic API base URL; ANTHROPIC_BASE_URL points it at a local stand-in server."""
+    return os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com").rstrip("/")
+
+def get_batch_headers(api_key):
+    """Return the headers for Message Batches API requests."""
+    return {
+        "Content-Type": "application/json",
+        "x-api-key": api_key,
+        "anthropic-version": "2023-06-01"
+    }
+
+def write_batch_file(batch_requests, path):
+    """Write the batch requests to a JSONL submission file, one {custom_id, params} per line."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for request in batch_requests:
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+    print(f"Wrote {len(batch_requests)} requests to batch file {path}")
+
+def make_custom_id(prefix, *keys):
+    """
+    Build a batch custom_id from stable keys (e.g. a file name), so a resumed batch maps its
+    results to the same outputs even when the set of pending requests has changed.
+    """
+    digest = hashlib.sha256("\0".join(str(key) for key in keys).encode('utf-8')).hexdigest()
+    return f"{prefix}-{digest[:32]}"
+
+def get_group_digest(group):
+    """Return a digest of the custom_ids and params of a group of batch requests."""
+    digest = hashlib.sha256()
+    for request in group:
+        digest.update(json.dumps(request, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def split_batch_requests(batch_requests):
+    """Split requests into groups that fit within the per-batch request and size limits."""
+    groups = []
+    current = []
+    current_bytes = 0
+    for request in batch_requests:
+        size = len(json.dumps(request, ensure_ascii=False).encode('utf-8'))
+        if current and (len(current) >= MAX_BATCH_REQUESTS or current_bytes + size > MAX_BATCH_BYTES):
+            groups.append(current)
+            current = []
+            current_bytes = 0
+        current.append(request)
+        current_bytes += size
+    if current:
+        groups.append(current)
+    return groups
+
+def submit_batch(batch_requests, api_key):
+    """Submit a message batch and return its id, or None on failure."""
+    url = f"{get_anthropic_base_url()}/v1/messages/batches"
+    response = request_with_retries("POST", url, "anthropic.batch_submit", "batch submission", prefix="",
+                                    headers=get_batch_headers(api_key), json={"requests": batch_requests})
+    if response is None or response.status_code != 200:
+        print("✗ Batch submission failed")
+        return None
+    batch = response.json()
+    print(f"✓ Submitted batch {batch['id']} with {len(batch_requests)} requests")
+    return batch["id"]
+
+def wait_for_batch(batch_id, api_key, poll_interval=30, max_wait=24 * 3600):
+    """Poll a batch until it has ended. Returns the batch object, or None on failure or timeout."""
+    url = f"{get_anthropic_base_url()}/v1/messages/batches/{batch_id}"
+    deadline = time.monotonic() + max_wait
+    tracer = get_tracer()
+    while time.monotonic() < deadline:
+        # A failed status request is retried at the next poll
+        response = request_with_retries("GET", url, "anthropic.batch_status", "batch status request",
+                                        headers=get_batch_headers(api_key))
+        if response is not None and response.status_code == 200:
+            batch = response.json()
+            counts = batch.get("request_counts", {})
+            print(f"  Batch {batch_id}: {batch.get('processing_status')} "
+                  f"({counts.get('processing', 0)} processing, {counts.get('succeeded', 0)} succeeded, "
+                  f"{counts.get('errored', 0)} errored)")
+            if batch.get("processing_status") == "ended":
+                return batch
+        tracer.sleep("anthropic.batch_poll", poll_interval)
+
+    print(f"✗ Batch {batch_id} did not finish within {max_wait} seconds")
+    return None
+
+def fetch_batch_results(batch, api_key):
+    """
+    Download the results of an ended batch as a dict of custom_id -> message (None if it failed).
+
+    Returns an empty dict if the download fails; the batch stays in the submission state, so
+    the next run downloads its results again instead of resubmitting.
+    """
+    results_url = batch.get("results_url") or f"{get_anthropic_base_url()}/v1/messages/batches/{batch['id']}/results"
+    tracer = get_tracer()
+    response = request_with_retries("GET", results_url, "anthropic.batch_results", "batch results download",
+                                    prefix="", headers=get_batch_headers(api_key))
+    if response is None or response.status_code != 200:
+        print(f"✗ Failed to download the results of batch {batch['id']}")
+        return {}
+
+    results = {}
+    for line in response.text.splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        result = entry.get("result", {})
+        if result.get("type") == "succeeded":
+            results[entry["custom_id"]] = result.get("message")
+            # Batch messages are billed like single requests, so their token usage is traced the same way
+            usage = (result.get("message") or {}).get("usage") or {}
+            tracer.event("request", "anthropic.batch_message",
+                         **{key: value for key, value in usage.items() if isinstance(value, int)})
+        else:
+            print(f"  ✗ Request {entry.get('custom_id')} {result.get('type')}: {result.get('error')}")
+            results[entry["custom_id"]] = None
+    return results
+
+def run_batch(batch_requests, api_key, submission_path, poll_interval=30):
+    """
+    Write, submit and collect a set of batch requests.
+
+    The id and a digest of every submitted batch are recorded next to the submission file,
+    so an interrupted run resumes polling the batches whose requests are unchanged and only
+    submits the rest. Returns a dict of custom_id -> message (None for requests that failed).
+    """
+    write_batch_file(batch_requests, submission_path)
+
+    state_path = f"{submission_path}.state.json"
+    state = {}
+    if os.path.exists(state_path):
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except Exception as e:
+            print(f"Error loading batch state: {str(e)}")
+
+    submitted = {batch["digest"]: batch["id"] for batch in state.get("batches", []) if "digest" in batch}
+    batches = []
+    resumed = 0
+    for group in split_batch_requests(batch_requests):
+        digest = get_group_digest(group)
+        batch_id = submitted.get(digest)
+        if batch_id:
+            resumed += 1
+        else:
+            batch_id = submit_batch(group, api_key)
+            if not batch_id:
+                # Keep the batches submitted so far; the next run resumes them and submits the rest
+                break
+        batches.append({"id": batch_id, "digest": digest})
+        with open(state_path, 'w', encoding='utf-8') as f:
+            json.dump({"batches": batches}, f)
+    if resumed:
+        print(f"Resuming {resumed} previously submitted batches")
+    batch_ids = [batch["id"] for batch in batches]
+
+    results = {}
+    for batch_id in batch_ids:
+        batch = wait_for_batch(batch_id, api_key, poll_interval=poll_interval)
+        if batch:
+            results.update(fetch_batch_results(batch, api_key))
+
+    # Only forget the batches once every request has an outcome
+    if len(results) == len(batch_requests) and os.path.exists(state_path):
+        os.remove(state_path)
+    return results
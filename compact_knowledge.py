@@ -0,0 +1,184 @@
+import os
+import re
+import zlib
+import argparse
+import numpy as np
+
+# MinHash signature length, split into LSH bands of BAND_ROWS rows each
+NUM_HASHES = 64
+BAND_ROWS = 4
+
+# Tips whose shingle sets are at least this similar are treated as duplicates
+DEFAULT_THRESHOLD = 0.5
+
+# Shingle size in characters; character shingles tolerate small rewordings ("into" vs "to")
+SHINGLE_SIZE = 5
+
+MERSENNE_PRIME = (1 << 31) - 1
+
+LIST_ITEM_PATTERN = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+")
+
+def get_source_name(filename):
+    """Return the short name used to attribute a tip, the video ID for downloaded transcripts."""
+    stem = filename[:-len('_knowledge.txt')] if filename.endswith('_knowledge.txt') else os.path.splitext(filename)[0]
+    # Transcript files are named "<11-character video ID>_<title>", and IDs may contain "_"
+    return stem[:11] if len(stem) > 11 and stem[11] == '_' else stem
+
+def split_tips(content):
+    """Split a knowledge file into (heading, tip) pairs, one per list item or paragraph."""
+    tips = []
+    heading = ""
+    current = None
+    for line in content.splitlines():
+        stripped = line.strip()
+        if not stripped:
+            current = None
+            continue
+        if stripped.startswith('#'):
+            # Level-one headings are document titles, the others are sections
+            if stripped.startswith('##'):
+                heading = stripped.lstrip('#').strip()
+            current = None
+            continue
+        if LIST_ITEM_PATTERN.match(line) or current is None:
+            current = [heading, LIST_ITEM_PATTERN.sub("", line).strip()]
+            tips.append(current)
+        else:
+            # Continuation of a wrapped list item
+            current[1] += " " + stripped
+    return [(heading, tip) for heading, tip in tips if tip]
+
+def get_shingles(tip):
+    """Return the set of hashed character shingles of a tip, ignoring case and punctuation."""
+    text = " ".join(re.sub(r"[^\w\s]", " ", tip.lower()).split())
+    if not text:
+        return set()
+    grams = [text[i:i + SHINGLE_SIZE] for i in range(max(1, len(text) - SHINGLE_SIZE + 1))]
+    return {zlib.crc32(gram.encode('utf-8')) & MERSENNE_PRIME for gram in grams}
+
+def compute_minhash_signatures(shingle_sets, seed=1):
+    """Return a (tips x NUM_HASHES) matrix of MinHash signatures."""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MERSENNE_PRIME, NUM_HASHES, dtype=np.uint64)
+    b = rng.integers(0, MERSENNE_PRIME, NUM_HASHES, dtype=np.uint64)
+
+    signatures = np.full((len(shingle_sets), NUM_HASHES), MERSENNE_PRIME, dtype=np.uint64)
+    for i, shingles in enumerate(shingle_sets):
+        if not shingles:
+            continue
+        values = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        # Universal hashing (a * x + b) mod p; all operands are below 2^31 so nothing overflows
+        hashed = (np.outer(values, a) + b) % MERSENNE_PRIME
+        signatures[i] = hashed.min(axis=0)
+    return signatures
+
+def find_duplicate_clusters(shingle_sets, threshold=DEFAULT_THRESHOLD):
+    """
+    Group near-duplicate tips and return a list of clusters (lists of tip indices).
+
+    Candidate pairs come from MinHash LSH banding, and every candidate is confirmed with the
+    exact Jaccard similarity of the shingle sets, so the threshold is applied precisely.
+    """
+    parent = list(range(len(shingle_sets)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    signatures = compute_minhash_signatures(shingle_sets)
+    checked = set()
+    for band in range(NUM_HASHES // BAND_ROWS):
+        buckets = {}
+        for i, row in enumerate(signatures[:, band * BAND_ROWS:(band + 1) * BAND_ROWS]):
+            if shingle_sets[i]:
+                buckets.setdefault(row.tobytes(), []).append(i)
+
+        for members in buckets.values():
+            for x in range(len(members)):
+                for y in range(x + 1, len(members)):
+                    i, j = members[x], members[y]
+                    if (i, j) in checked or find(i) == find(j):
+                        continue
+                    checked.add((i, j))
+                    a, b = shingle_sets[i], shingle_sets[j]
+                    if len(a & b) / len(a | b) >= threshold:
+                        parent[find(j)] = find(i)
+
+    clusters = {}
+    for i in range(len(shingle_sets)):
+        clusters.setdefault(find(i), []).append(i)
+    return list(clusters.values())
+
+def compact_knowledge(knowledge_dir, output_dir=None, threshold=DEFAULT_THRESHOLD):
+    """
+    Write a deduplicated copy of a knowledge directory with source attribution.
+
+    Every tip of every knowledge file is clustered with its near-duplicates, and each cluster
+    is written once (its most detailed wording) followed by the videos it came from. The result
+    is a single knowledge.txt in output_dir, which can be used as the knowledge directory
+    for generate_advice.py.
+    """
+    if not os.path.exists(knowledge_dir):
+        print(f"Knowledge directory not found: {knowledge_dir}")
+        return False
+
+    if output_dir is None:
+        output_dir = f"{knowledge_dir.rstrip(os.sep)}_compact"
+
+    tips = []  # (heading, tip, source)
+    knowledge_files = sorted(f for f in os.listdir(knowledge_dir) if f.endswith('.txt'))
+    for filename in knowledge_files:
+        try:
+            with open(os.path.join(knowledge_dir, filename), 'r', encoding='utf-8') as f:
+                content = f.read()
+        except Exception as e:
+            print(f"Error reading knowledge file {filename}: {str(e)}")
+            continue
+        source = get_source_name(filename)
+        tips.extend((heading, tip, source) for heading, tip in split_tips(content))
+
+    if not tips:
+        print(f"No tips found in {knowledge_dir}")
+        return False
+
+    print(f"Clustering {len(tips)} tips from {len(knowledge_files)} knowledge files...")
+    clusters = find_duplicate_clusters([get_shingles(tip) for _, tip, _ in tips], threshold)
+
+    # Group the clusters by the section of their first occurrence, keeping the original order
+    sections = {}
+    for cluster in sorted(clusters, key=min):
+        heading = tips[min(cluster)][0] or "General"
+        representative = max(cluster, key=lambda i: len(tips[i][1]))
+        sources = sorted({tips[i][2] for i in cluster})
+        sections.setdefault(heading, []).append(f"- {tips[representative][1]} [sources: {', '.join(sources)}]")
+
+    lines = [f"# Compacted knowledge from {len(knowledge_files)} files"]
+    for heading, items in sections.items():
+        lines.append(f"\n## {heading}")
+        lines.extend(items)
+    compacted = "\n".join(lines) + "\n"
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, "knowledge.txt")
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(compacted)
+
+    original_chars = sum(len(tip) for _, tip, _ in tips)
+    compacted_chars = sum(len(tips[max(c, key=lambda i: len(tips[i][1]))][1]) for c in clusters)
+    print(f"✓ Merged {len(tips)} tips into {len(clusters)} ({len(tips) - len(clusters)} duplicates removed, "
+          f"{compacted_chars / original_chars:.0%} of the original tip text)")
+    print(f"✓ Saved compacted knowledge to {output_path}")
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deduplicate the tips of a knowledge directory into one compact file.")
+    parser.add_argument("knowledge_dir", help="Directory containing knowledge files")
+    parser.add_argument("--output-dir", help="Where to write knowledge.txt (default: <knowledge_dir>_compact)")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"Jaccard similarity above which tips are merged (default: {DEFAULT_THRESHOLD})")
+
+    args = parser.parse_args()
+
+    compact_knowledge(args.knowledge_dir, args.output_dir, args.threshold)
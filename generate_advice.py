@@ -3,14 +3,24 @@ import sys
 import argparse
 import json
 import base64
-import time
-import requests
+import queue
+import subprocess
+import threading
 from pathlib import Path
 from dotenv import load_dotenv
+from claude_batch import get_anthropic_base_url, make_custom_id, run_batch
+from response_cache import get_response_cache, make_cache_key, print_cache_stats
+from http_client import request_with_retries
+from tracing import configure_tracing, default_trace_path, get_tracer, print_trace_summary
+from knowledge_index import load_or_build_index, format_retrieved_knowledge
+from media_probe import get_mp3_duration
 
 # Load environment variables from .env file
 load_dotenv()
 
+# ELEVENLABS_BASE_URL points speech requests at a local stand-in server
+ELEVENLABS_BASE_URL = os.getenv("ELEVENLABS_BASE_URL", "https://api.elevenlabs.io").rstrip("/")
+
 def generate_speech_from_advice(advice_text, output_path, api_key, voice_id="pNInz6obpgDQGcFmaJgB"):
     """Generate speech from advice text using ElevenLabs API."""
     if not advice_text or not api_key:
@@ -18,7 +28,7 @@ def generate_speech_from_advice(advice_text, output_path, api_key, voice_id="pNI
         return False
     
     # Prepare the request to ElevenLabs
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
+    url = f"{ELEVENLABS_BASE_URL}/v1/text-to-speech/{voice_id}"
     headers = {
         "Content-Type": "application/json",
         "xi-api-key": api_key
@@ -34,48 +44,132 @@ def generate_speech_from_advice(advice_text, output_path, api_key, voice_id="pNI
         }
     }
     
+    # Reuse the audio of an identical earlier request
+    cache = get_response_cache()
+    cache_key = make_cache_key("elevenlabs-tts", {"voice_id": voice_id, **payload})
+    cached_audio = cache.get(cache_key)
+    if cached_audio is not None:
+        with open(output_path, 'wb') as f:
+            f.write(cached_audio)
+        print(f"  ✓ Saved cached speech to {output_path}")
+        return True
+    
     # Make the API request with retry logic
-    max_retries = 3
-    retry_delay = 5  # seconds
+    response = request_with_retries("POST", url, "elevenlabs.tts", "speech generation request",
+                                    headers=headers, json=payload)
+    if response is None or response.status_code != 200:
+        return False
     
-    for attempt in range(max_retries):
-        try:
-            print(f"  Generating speech... (attempt {attempt+1}/{max_retries})")
-            response = requests.post(url, headers=headers, json=payload, timeout=60)
-            
-            if response.status_code == 200:
-                # Save the audio file
-                with open(output_path, 'wb') as f:
-                    f.write(response.content)
-                print(f"  ✓ Saved speech to {output_path}")
-                return True
-            else:
-                print(f"  ✗ Speech generation failed: {response.status_code} - {response.text}")
-                if attempt < max_retries - 1:
-                    print(f"  Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # Exponential backoff
-                else:
-                    return False
-        except Exception as e:
-            print(f"  ✗ Error during speech generation: {str(e)}")
-            if attempt < max_retries - 1:
-                print(f"  Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
-                retry_delay *= 2
-            else:
-                return False
-    
-    return False
+    # Save the audio file
+    with open(output_path, 'wb') as f:
+        f.write(response.content)
+    cache.put(cache_key, response.content)
+    print(f"  ✓ Saved speech to {output_path}")
+    return True
+
+# Claude bills about one token per 750 pixels and downscales anything with a longer edge
+# than 1568 pixels itself. Frames are uploaded unchanged unless a token budget is given;
+# about 1000 tokens keeps HUD text legible while cutting the cost of full-HD frames
+SUGGESTED_IMAGE_TOKENS = 1000
+PIXELS_PER_IMAGE_TOKEN = 750
+MAX_IMAGE_EDGE = 1568
+IMAGE_JPEG_QUALITY = 5  # FFmpeg -q:v scale, 2 (best) to 31
 
-def encode_image_to_base64(image_path):
-    """Encode an image file to base64."""
+def parse_image_crop(crop):
+    """Parse an "x:y:w:h" crop given as fractions of the frame (e.g. "0:0.75:1:0.25" for the bottom quarter)."""
+    if not crop:
+        return None
+    try:
+        x, y, w, h = (float(value) for value in crop.split(':'))
+    except ValueError:
+        raise ValueError(f"Invalid crop '{crop}', expected x:y:w:h as fractions of the frame")
+    if not (0 <= x < 1 and 0 <= y < 1 and 0 < w <= 1 - x and 0 < h <= 1 - y):
+        raise ValueError(f"Invalid crop '{crop}', the region must lie inside the frame")
+    return x, y, w, h
+
+def prepare_image_for_advice(image_path, max_tokens=0, crop=None, timeout=30):
+    """
+    Return the JPEG bytes to upload for a frame, downscaled to a token budget and optionally cropped.
+    
+    Re-encoded images are kept in the response cache, keyed by the source bytes and the
+    settings, so re-runs do not run FFmpeg again. With max_tokens=0 and no crop the original
+    file is returned unchanged. Returns None if the image cannot be read or processed.
+    """
+    try:
+        with open(image_path, 'rb') as f:
+            source = f.read()
+    except Exception as e:
+        print(f"Error reading image {image_path}: {str(e)}")
+        return None
+    
+    if not max_tokens and not crop:
+        return source
+    
+    cache = get_response_cache()
+    cache_key = make_cache_key("advice-image", {"maxTokens": max_tokens, "crop": crop,
+                                                "quality": IMAGE_JPEG_QUALITY}, blobs=[source])
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    filters = []
+    region = parse_image_crop(crop)
+    if region:
+        x, y, w, h = region
+        filters.append(f"crop=iw*{w}:ih*{h}:iw*{x}:ih*{y}")
+    if max_tokens:
+        # Shrink (never enlarge) so that width * height fits the budget and the long edge fits the limit
+        factor = (f"min(1\\,min(sqrt({max_tokens * PIXELS_PER_IMAGE_TOKEN}/(iw*ih))\\,"
+                  f"{MAX_IMAGE_EDGE}/max(iw\\,ih)))")
+        filters.append(f"scale=trunc(iw*{factor}/2)*2:trunc(ih*{factor}/2)*2:flags=area")
+    
+    cmd = [
+        'ffmpeg',
+        '-v', 'error',
+        '-i', 'pipe:0',
+        '-vf', ",".join(filters),
+        '-q:v', str(IMAGE_JPEG_QUALITY),
+        '-f', 'image2pipe',
+        '-c:v', 'mjpeg',
+        'pipe:1'
+    ]
+    
     try:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+        with get_tracer().span("ffmpeg.advice_image"):
+            result = subprocess.run(cmd, input=source, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        if result.returncode != 0 or not result.stdout:
+            print(f"Error preprocessing image {image_path}: {result.stderr.decode(errors='replace').strip()}")
+            return None
     except Exception as e:
-        print(f"Error encoding image {image_path}: {str(e)}")
+        print(f"Error preprocessing image {image_path}: {str(e)}")
         return None
+    
+    cache.put(cache_key, result.stdout)
+    return result.stdout
+
+def encode_advice_image(image_path, max_tokens=0, crop=None):
+    """Preprocess a frame for an advice request and encode it to base64."""
+    data = prepare_image_for_advice(image_path, max_tokens, crop)
+    if data is None:
+        return None
+    return base64.b64encode(data).decode('utf-8')
+
+ADVISOR_INTRO = """You are an expert gaming advisor who provides specific, actionable advice to players based on their current game situation.
+Use the knowledge provided below to inform your advice."""
+
+ADVISOR_INSTRUCTIONS = """Analyze the game screenshot and transcript carefully. Then provide specific advice that will help the player in their current situation.
+
+Your advice must:
+1. Address the player directly using "you" language
+2. Be specific to what's visible in the screenshot and mentioned in the transcript, if relevant
+3. Do not repeat previously shared advice
+4. Be actionable - tell the player exactly what they should do
+5. Be strategic - explain why this is the best course of action
+6. Be concise - focus on the most important piece of advice
+
+Format your response as a short paragraph or a few sentences. Do not use bullet points.
+
+IMPORTANT: Respond ONLY with the advice itself. Do not include any introductions, explanations about what you're doing, or conclusions. Start directly with your advice in sentence form."""
 
 def load_knowledge_files(knowledge_dir):
     """Load all knowledge files from the knowledge directory."""
@@ -103,49 +197,65 @@ def load_knowledge_files(knowledge_dir):
     print(f"Loaded {len(combined_knowledge)} characters of knowledge")
     return combined_knowledge
 
-def generate_advice_with_claude_and_context(image_path, transcript_text, knowledge_text, previous_advices, api_key):
-    """Generate advice using Claude based on image, transcript, knowledge, and previous advices."""
-    if not api_key:
-        print("Error: ANTHROPIC_API_KEY not found in environment variables.")
-        return None
-    
+def parse_claude_response(result):
+    """Extract the text content from a Claude API response."""
+    content = result.get("content", [])
+    if isinstance(content, list) and len(content) > 0:
+        # Handle the Claude API response format
+        text_blocks = [block.get("text", "") for block in content if block.get("type") == "text"]
+        return "\n".join(text_blocks)
+    return "No text content found in response"
+
+def record_token_usage(stats, result):
+    """Add the token usage of a Claude response to the run statistics."""
+    if stats is None:
+        return
+    usage = result.get("usage", {})
+    stats["requests"] = stats.get("requests", 0) + 1
+    for field in ("input_tokens", "cache_creation_input_tokens", "cache_read_input_tokens", "output_tokens"):
+        stats[field] = stats.get(field, 0) + (usage.get(field) or 0)
+
+def print_token_usage(stats):
+    """Print how many input tokens were served from the prompt cache."""
+    if not stats.get("requests"):
+        return
+    uncached = stats.get("input_tokens", 0)
+    cache_writes = stats.get("cache_creation_input_tokens", 0)
+    cache_reads = stats.get("cache_read_input_tokens", 0)
+    total_input = uncached + cache_writes + cache_reads
+    cached_share = cache_reads / total_input if total_input else 0.0
+    print(f"Claude usage over {stats['requests']} requests: {total_input} input tokens "
+          f"({uncached} uncached, {cache_writes} cache writes, {cache_reads} cache reads, "
+          f"{cached_share:.0%} cached), {stats.get('output_tokens', 0)} output tokens")
+
+def build_advice_payload(image_path, transcript_text, knowledge_text, previous_advices, cache_knowledge=True,
+                         extra_image_paths=(), image_max_tokens=0, image_crop=None):
+    """Build the Claude request payload for one segment's advice, with optional scene-cut frames."""
     # Encode image to base64
-    image_base64 = encode_image_to_base64(image_path)
+    image_base64 = encode_advice_image(image_path, image_max_tokens, image_crop)
     if not image_base64:
         print("Failed to encode image, proceeding with text only")
     
-    # Prepare the request to Claude
-    url = "https://api.anthropic.com/v1/messages"
-    headers = {
-        "Content-Type": "application/json",
-        "x-api-key": api_key,
-        "anthropic-version": "2023-06-01"
-    }
-    
     # Format previous advices as a string
     previous_advices_text = ""
     if previous_advices:
         previous_advices_text = "Previous advices:\n" + "\n".join(previous_advices)
     
-    # Create system prompt with knowledge
-    system_prompt = f"""You are an expert gaming advisor who provides specific, actionable advice to players based on their current game situation.
-Use the knowledge provided below to inform your advice.
-
-{knowledge_text}
-
-Analyze the game screenshot and transcript carefully. Then provide specific advice that will help the player in their current situation.
-
-Your advice must:
-1. Address the player directly using "you" language
-2. Be specific to what's visible in the screenshot and mentioned in the transcript, if relevant
-3. Do not repeat previously shared advice
-4. Be actionable - tell the player exactly what they should do
-5. Be strategic - explain why this is the best course of action
-6. Be concise - focus on the most important piece of advice
-
-Format your response as a short paragraph or a few sentences. Do not use bullet points.
-
-IMPORTANT: Respond ONLY with the advice itself. Do not include any introductions, explanations about what you're doing, or conclusions. Start directly with your advice in sentence form."""
+    # The system prompt is the same for every segment, so it forms a stable prefix that
+    # ends in a cache breakpoint; previous advices, transcript and screenshot follow it
+    system_blocks = [{"type": "text", "text": ADVISOR_INTRO}]
+    if cache_knowledge and knowledge_text:
+        system_blocks.append({"type": "text", "text": knowledge_text})
+    system_blocks.append({
+        "type": "text",
+        "text": ADVISOR_INSTRUCTIONS,
+        "cache_control": {"type": "ephemeral"}
+    })
+    
+    # Knowledge selected for this segment only belongs in the variable suffix
+    request_text = f"Here's a screenshot from my game and the transcript of what's happening. Give me specific advice for what I should do in this situation:\n\nTRANSCRIPT:\n{transcript_text}"
+    if not cache_knowledge and knowledge_text:
+        request_text = f"RELEVANT KNOWLEDGE:{knowledge_text}\n\n{request_text}"
     
     # Create messages array with previous advices and current request
     messages = []
@@ -163,7 +273,7 @@ IMPORTANT: Respond ONLY with the advice itself. Do not include any introductions
         user_content = [
             {
                 "type": "text",
-                "text": f"Here's a screenshot from my game and the transcript of what's happening. Give me specific advice for what I should do in this situation:\n\nTRANSCRIPT:\n{transcript_text}"
+                "text": request_text
             },
             {
                 "type": "image",
@@ -176,7 +286,24 @@ IMPORTANT: Respond ONLY with the advice itself. Do not include any introductions
         ]
     else:
         # Text-only message
-        user_content = f"Here's a screenshot from my game and the transcript of what's happening. Give me specific advice for what I should do in this situation:\n\nTRANSCRIPT:\n{transcript_text}"
+        user_content = request_text
+    
+    # Frames from scene cuts later in the segment follow the main screenshot
+    extra_images = [encode_advice_image(path, image_max_tokens, image_crop) for path in extra_image_paths]
+    extra_images = [data for data in extra_images if data]
+    if extra_images:
+        if isinstance(user_content, str):
+            user_content = [{"type": "text", "text": user_content}]
+        user_content.append({"type": "text", "text": "Screenshots taken later in this segment, after the scene changed:"})
+        for data in extra_images:
+            user_content.append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": "image/jpeg",
+                    "data": data
+                }
+            })
     
     messages.append({
         "role": "user",
@@ -188,53 +315,227 @@ IMPORTANT: Respond ONLY with the advice itself. Do not include any introductions
         "model": "claude-3-5-haiku-latest",
         "max_tokens": 1000,
         "temperature": 0.2,
-        "system": system_prompt,
+        "system": system_blocks,
         "messages": messages
     }
     
+    return payload
+
+def generate_advice_with_claude_and_context(image_path, transcript_text, knowledge_text, previous_advices, api_key,
+                                            cache_knowledge=True, stats=None, extra_image_paths=(),
+                                            image_max_tokens=0, image_crop=None):
+    """
+    Generate advice using Claude based on image, transcript, knowledge, and previous advices.
+    
+    With cache_knowledge the knowledge is part of the cached system prompt prefix; pass
+    False when the knowledge differs per segment (retrieval) to send it with the request.
+    Token usage is accumulated into the optional stats dict.
+    """
+    if not api_key:
+        print("Error: ANTHROPIC_API_KEY not found in environment variables.")
+        return None
+    
+    # Prepare the request to Claude
+    url = f"{get_anthropic_base_url()}/v1/messages"
+    headers = {
+        "Content-Type": "application/json",
+        "x-api-key": api_key,
+        "anthropic-version": "2023-06-01"
+    }
+    
+    payload = build_advice_payload(image_path, transcript_text, knowledge_text, previous_advices, cache_knowledge,
+                                   extra_image_paths, image_max_tokens, image_crop)
+    
+    # Reuse the response of an identical earlier request
+    cache = get_response_cache()
+    cache_key = make_cache_key("anthropic-messages", payload)
+    cached = cache.get_json(cache_key)
+    if cached is not None:
+        print("  ✓ Using cached Claude response")
+        return parse_claude_response(cached)
+    
     # Make the API request with retry logic
-    max_retries = 3
-    retry_delay = 5  # seconds
+    response = request_with_retries("POST", url, "anthropic.messages", "Claude API request",
+                                    headers=headers, json=payload)
+    if response is None or response.status_code != 200:
+        return None
     
-    for attempt in range(max_retries):
-        try:
-            print(f"  Making Claude API request (attempt {attempt+1}/{max_retries})...")
-            response = requests.post(url, headers=headers, json=payload, timeout=60)
-            
-            if response.status_code == 200:
-                result = response.json()
-                # Extract the text content from the response
-                content = result.get("content", [])
-                if isinstance(content, list) and len(content) > 0:
-                    # Handle the Claude API response format
-                    text_blocks = [block.get("text", "") for block in content if block.get("type") == "text"]
-                    return "\n".join(text_blocks)
-                return "No text content found in response"
-            else:
-                print(f"  ✗ Claude API request failed: {response.status_code} - {response.text}")
-                if attempt < max_retries - 1:
-                    print(f"  Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # Exponential backoff
-                else:
-                    return None
-        except Exception as e:
-            print(f"  ✗ Error during Claude API request: {str(e)}")
-            if attempt < max_retries - 1:
-                print(f"  Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
-                retry_delay *= 2
-            else:
-                return None
-    
-    return None
+    result = response.json()
+    cache.put_json(cache_key, result)
+    record_token_usage(stats, result)
+    return parse_claude_response(result)
 
 def generate_advice_with_claude(image_path, transcript_text, knowledge_text, api_key):
     """Generate advice using Claude based on image, transcript, and knowledge."""
     # For backward compatibility, call the new function with empty previous_advices
     return generate_advice_with_claude_and_context(image_path, transcript_text, knowledge_text, [], api_key)
 
-def process_segments(knowledge_dir, transcript_dir, generate_speech=False, voice_id="pNInz6obpgDQGcFmaJgB"):
+class SpeechStage:
+    """Background text-to-speech stage fed by the advice loop through a bounded queue."""
+    
+    def __init__(self, api_key, voice_id, max_pending=4):
+        self.api_key = api_key
+        self.voice_id = voice_id
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def submit(self, segment, advice_text, speech_path, speech_file):
+        """Queue speech for a segment, blocking while the queue is full."""
+        self.queue.put((segment, advice_text, speech_path, speech_file))
+    
+    def close(self):
+        """Wait until all queued speech has been generated."""
+        self.queue.put(None)
+        self.thread.join()
+    
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            
+            segment, advice_text, speech_path, speech_file = item
+            try:
+                with get_tracer().span("speech.segment", segment=segment.get("segment")):
+                    generated = generate_speech_from_advice(advice_text, speech_path, self.api_key, self.voice_id)
+                if generated:
+                    # Update metadata with speech file and its duration, so videos need not probe it
+                    segment["speechFile"] = speech_file
+                    speech_duration = get_mp3_duration(speech_path)
+                    if speech_duration > 0:
+                        segment["speechDuration"] = round(speech_duration, 3)
+            except Exception as e:
+                print(f"  ✗ Error generating speech for segment {segment.get('segment')}: {str(e)}")
+
+def process_segments_with_batch_api(metadata_files, submission_path, knowledge_text, knowledge_index, top_k, api_key,
+                                    elevenlabs_api_key=None, voice_id="pNInz6obpgDQGcFmaJgB", poll_interval=30,
+                                    stats=None, image_max_tokens=0, image_crop=None):
+    """
+    Generate advice for every pending segment through one Message Batches API submission.
+    
+    Segments are independent in a batch, so the previous-advice context of each request only
+    contains advice that already existed on disk, not advice produced by the same batch.
+    """
+    cache = get_response_cache()
+    folders = []
+    batch_requests = []
+    pending = {}
+    
+    for metadata_path in metadata_files:
+        folder_path = os.path.dirname(metadata_path)
+        try:
+            with open(metadata_path, 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+        except Exception as e:
+            print(f"Error loading metadata file {metadata_path}: {str(e)}")
+            continue
+        folders.append((metadata_path, metadata))
+        
+        last_advices = []
+        for segment in metadata.get("segments", []):
+            segment_num = segment.get("segment")
+            transcript = segment.get("transcript")
+            frame_file = segment.get("frameFile")
+            
+            if not transcript or not frame_file:
+                continue
+            
+            advice_path = os.path.join(folder_path, f"advice_{segment_num}.txt")
+            if os.path.exists(advice_path):
+                with open(advice_path, 'r', encoding='utf-8') as f:
+                    last_advices.append(f"Segment {segment_num}: {f.read().strip()}")
+                if len(last_advices) > 10:
+                    last_advices.pop(0)
+                continue
+            
+            # Gated segments look like the last advised one, so they get no advice of their own
+            if segment.get("unchanged"):
+                continue
+            
+            # Select the knowledge chunks relevant to this segment
+            segment_knowledge = knowledge_text
+            if knowledge_index is not None:
+                segment_knowledge = format_retrieved_knowledge(knowledge_index.search(transcript, top_k))
+            
+            payload = build_advice_payload(
+                os.path.join(folder_path, frame_file),
+                transcript,
+                segment_knowledge,
+                list(last_advices),
+                cache_knowledge=knowledge_index is None,
+                extra_image_paths=[os.path.join(folder_path, f["frameFile"]) for f in segment.get("sceneFrames", [])],
+                image_max_tokens=image_max_tokens,
+                image_crop=image_crop
+            )
+            cache_key = make_cache_key("anthropic-messages", payload)
+            custom_id = make_custom_id("advice", os.path.abspath(folder_path), segment_num)
+            
+            # Answer from the response cache where possible instead of paying for a batch request
+            cached = cache.get_json(cache_key)
+            if cached is not None:
+                pending[custom_id] = (folder_path, segment, cache_key, cached)
+                continue
+            
+            batch_requests.append({"custom_id": custom_id, "params": payload})
+            pending[custom_id] = (folder_path, segment, cache_key, None)
+    
+    print(f"Found {len(pending)} segments without advice ({len(batch_requests)} to submit)")
+    
+    results = {}
+    if batch_requests:
+        results = run_batch(batch_requests, api_key, submission_path, poll_interval=poll_interval)
+    
+    for custom_id, (folder_path, segment, cache_key, cached) in pending.items():
+        segment_num = segment.get("segment")
+        message = cached or results.get(custom_id)
+        if not message:
+            print(f"  ✗ Failed to generate advice for segment {segment_num} in {os.path.basename(folder_path)}")
+            continue
+        
+        if not cached:
+            cache.put_json(cache_key, message)
+            record_token_usage(stats, message)
+        
+        advice = parse_claude_response(message)
+        advice_file = f"advice_{segment_num}.txt"
+        advice_path = os.path.join(folder_path, advice_file)
+        with open(advice_path, 'w', encoding='utf-8') as f:
+            f.write(advice)
+        
+        # Update metadata
+        segment["adviceFile"] = advice_file
+        segment["advice"] = advice
+        print(f"  ✓ Saved advice to {advice_path}")
+    
+    for metadata_path, metadata in folders:
+        folder_path = os.path.dirname(metadata_path)
+        
+        # Voice every advice that has no speech file yet
+        if elevenlabs_api_key:
+            speech_stage = SpeechStage(elevenlabs_api_key, voice_id)
+            try:
+                for segment in metadata.get("segments", []):
+                    segment_num = segment.get("segment")
+                    advice_path = os.path.join(folder_path, f"advice_{segment_num}.txt")
+                    speech_file = f"advice_{segment_num}.mp3"
+                    speech_path = os.path.join(folder_path, speech_file)
+                    if os.path.exists(advice_path) and not os.path.exists(speech_path):
+                        with open(advice_path, 'r', encoding='utf-8') as f:
+                            speech_stage.submit(segment, f.read().strip(), speech_path, speech_file)
+            finally:
+                speech_stage.close()
+        
+        # Save updated metadata
+        with open(metadata_path, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, indent=2)
+        print(f"Updated metadata saved to {metadata_path}")
+    
+    return True
+
+def process_segments(knowledge_dir, transcript_dir, generate_speech=False, voice_id="pNInz6obpgDQGcFmaJgB", top_k=0,
+                     speech_queue_size=4, batch=False, poll_interval=30, image_max_tokens=0,
+                     image_crop=None):
     """Process all segments in the transcript directory."""
     # Get API key
     api_key = os.getenv("ANTHROPIC_API_KEY")
@@ -250,8 +551,13 @@ def process_segments(knowledge_dir, transcript_dir, generate_speech=False, voice
             print("Warning: ELEVENLABS_API_KEY not found in environment variables. Speech generation will be skipped.")
             generate_speech = False
     
-    # Load knowledge files
-    knowledge_text = load_knowledge_files(knowledge_dir)
+    # Load knowledge files, or the retrieval index if only the most relevant chunks are sent
+    knowledge_index = None
+    knowledge_text = ""
+    if top_k > 0:
+        knowledge_index = load_or_build_index(knowledge_dir)
+    if knowledge_index is None:
+        knowledge_text = load_knowledge_files(knowledge_dir)
     
     # Find all metadata.json files in the transcript directory
     metadata_files = []
@@ -265,6 +571,30 @@ def process_segments(knowledge_dir, transcript_dir, generate_speech=False, voice
     
     print(f"Found {len(metadata_files)} metadata files to process")
     
+    # Token usage across all advice requests, including prompt cache hits
+    usage_stats = {}
+    
+    # Offline mode: one batch submission for all folders instead of per-segment requests
+    if batch:
+        process_segments_with_batch_api(
+            metadata_files,
+            os.path.join(transcript_dir, "advice_batch.jsonl"),
+            knowledge_text,
+            knowledge_index,
+            top_k,
+            api_key,
+            elevenlabs_api_key=elevenlabs_api_key if generate_speech else None,
+            voice_id=voice_id,
+            poll_interval=poll_interval,
+            stats=usage_stats,
+            image_max_tokens=image_max_tokens,
+            image_crop=image_crop
+        )
+        print("\nAdvice generation complete!")
+        print_token_usage(usage_stats)
+        print_cache_stats()
+        return True
+    
     # Process each metadata file
     for metadata_path in metadata_files:
         folder_path = os.path.dirname(metadata_path)
@@ -283,105 +613,111 @@ def process_segments(knowledge_dir, transcript_dir, generate_speech=False, voice
             # Keep track of the last 10 advices
             last_advices = []
             
-            # Process each segment
-            for segment in segments:
-                segment_num = segment.get("segment")
-                transcript = segment.get("transcript")
-                frame_file = segment.get("frameFile")
-                
-                if not transcript or not frame_file:
-                    print(f"  Skipping segment {segment_num}: Missing transcript or frame file")
-                    continue
-                
-                # Check if advice file already exists
-                advice_file = f"advice_{segment_num}.txt"
-                advice_path = os.path.join(folder_path, advice_file)
-                
-                # Check if speech file already exists
-                speech_file = f"advice_{segment_num}.mp3"
-                speech_path = os.path.join(folder_path, speech_file)
-                
-                # Load existing advice for context if it exists
-                if os.path.exists(advice_path):
-                    print(f"  Advice for segment {segment_num} already exists, loading for context...")
-                    try:
-                        with open(advice_path, 'r', encoding='utf-8') as f:
-                            existing_advice = f.read().strip()
-                            # Add to last advices with segment number
-                            last_advices.append(f"Segment {segment_num}: {existing_advice}")
-                            # Keep only the last 10
-                            if len(last_advices) > 10:
-                                last_advices.pop(0)
-                            
-                            # Generate speech if needed and not already exists
-                            if generate_speech and elevenlabs_api_key and not os.path.exists(speech_path):
-                                print(f"  Generating speech for existing advice...")
-                                generate_speech_from_advice(
-                                    existing_advice, 
-                                    speech_path, 
-                                    elevenlabs_api_key,
-                                    voice_id
-                                )
-                                
-                                # Update metadata with speech file
-                                segment["speechFile"] = speech_file
-                    except Exception as e:
-                        print(f"  Error loading existing advice: {str(e)}")
+            # Speech is synthesised in the background while the next advice is generated
+            speech_stage = None
+            if generate_speech and elevenlabs_api_key:
+                speech_stage = SpeechStage(elevenlabs_api_key, voice_id, max_pending=speech_queue_size)
+            
+            try:
+                # Process each segment
+                for segment in segments:
+                    segment_num = segment.get("segment")
+                    transcript = segment.get("transcript")
+                    frame_file = segment.get("frameFile")
                     
-                    # Skip to next segment if we're not generating speech or speech already exists
-                    if not generate_speech or os.path.exists(speech_path):
+                    if not transcript or not frame_file:
+                        print(f"  Skipping segment {segment_num}: Missing transcript or frame file")
                         continue
-                
-                # If we need to generate new advice
-                if not os.path.exists(advice_path):
-                    print(f"  Processing segment {segment_num}...")
                     
-                    # Get paths
-                    frame_path = os.path.join(folder_path, frame_file)
+                    # Check if advice file already exists
+                    advice_file = f"advice_{segment_num}.txt"
+                    advice_path = os.path.join(folder_path, advice_file)
                     
-                    # Generate advice with context from previous advices
-                    advice = generate_advice_with_claude_and_context(
-                        frame_path, 
-                        transcript, 
-                        knowledge_text, 
-                        last_advices,
-                        api_key
-                    )
+                    # Check if speech file already exists
+                    speech_file = f"advice_{segment_num}.mp3"
+                    speech_path = os.path.join(folder_path, speech_file)
                     
-                    if advice:
-                        # Save advice
-                        with open(advice_path, 'w', encoding='utf-8') as f:
-                            f.write(advice)
+                    # Load existing advice for context if it exists
+                    if os.path.exists(advice_path):
+                        print(f"  Advice for segment {segment_num} already exists, loading for context...")
+                        try:
+                            with open(advice_path, 'r', encoding='utf-8') as f:
+                                existing_advice = f.read().strip()
+                                # Add to last advices with segment number
+                                last_advices.append(f"Segment {segment_num}: {existing_advice}")
+                                # Keep only the last 10
+                                if len(last_advices) > 10:
+                                    last_advices.pop(0)
+                                
+                                # Generate speech if needed and not already exists
+                                if speech_stage and not os.path.exists(speech_path):
+                                    print(f"  Queueing speech for existing advice...")
+                                    speech_stage.submit(segment, existing_advice, speech_path, speech_file)
+                        except Exception as e:
+                            print(f"  Error loading existing advice: {str(e)}")
                         
-                        # Update metadata
-                        segment["adviceFile"] = advice_file
-                        segment["advice"] = advice
+                        # Nothing else to do for this segment
+                        continue
+                    
+                    # Gated segments look like the last advised one, so they get no advice of their own
+                    if segment.get("unchanged"):
+                        print(f"  ℹ Segment {segment_num} unchanged since the last advised segment, skipping")
+                        continue
+                    
+                    # If we need to generate new advice
+                    if not os.path.exists(advice_path):
+                        print(f"  Processing segment {segment_num}...")
                         
-                        # Add to last advices
-                        last_advices.append(f"Segment {segment_num}: {advice}")
-                        # Keep only the last 10
-                        if len(last_advices) > 10:
-                            last_advices.pop(0)
+                        # Get paths
+                        frame_path = os.path.join(folder_path, frame_file)
                         
-                        print(f"  ✓ Saved advice to {advice_path}")
+                        # Select the knowledge chunks relevant to this segment
+                        if knowledge_index is not None:
+                            knowledge_text = format_retrieved_knowledge(knowledge_index.search(transcript, top_k))
                         
-                        # Generate speech if enabled
-                        if generate_speech and elevenlabs_api_key:
-                            speech_success = generate_speech_from_advice(
-                                advice, 
-                                speech_path, 
-                                elevenlabs_api_key,
-                                voice_id
+                        # Generate advice with context from previous advices
+                        with get_tracer().span("advice.segment", segment=segment_num):
+                            advice = generate_advice_with_claude_and_context(
+                                frame_path, 
+                                transcript, 
+                                knowledge_text, 
+                                last_advices,
+                                api_key,
+                                cache_knowledge=knowledge_index is None,
+                                stats=usage_stats,
+                                extra_image_paths=[
+                                    os.path.join(folder_path, f["frameFile"]) for f in segment.get("sceneFrames", [])
+                                ],
+                                image_max_tokens=image_max_tokens,
+                                image_crop=image_crop
                             )
+                        
+                        if advice:
+                            # Save advice
+                            with open(advice_path, 'w', encoding='utf-8') as f:
+                                f.write(advice)
                             
-                            if speech_success:
-                                # Update metadata with speech file
-                                segment["speechFile"] = speech_file
-                    else:
-                        print(f"  ✗ Failed to generate advice for segment {segment_num}")
-                
-                # Wait before processing next segment to avoid rate limiting
-                time.sleep(2)
+                            # Update metadata
+                            segment["adviceFile"] = advice_file
+                            segment["advice"] = advice
+                            
+                            # Add to last advices
+                            last_advices.append(f"Segment {segment_num}: {advice}")
+                            # Keep only the last 10
+                            if len(last_advices) > 10:
+                                last_advices.pop(0)
+                            
+                            print(f"  ✓ Saved advice to {advice_path}")
+                            
+                            # Hand the advice to the speech stage and move on to the next segment
+                            if speech_stage:
+                                speech_stage.submit(segment, advice, speech_path, speech_file)
+                        else:
+                            print(f"  ✗ Failed to generate advice for segment {segment_num}")
+            finally:
+                # Wait for queued speech so the metadata below includes every speech file
+                if speech_stage:
+                    speech_stage.close()
             
             # Save updated metadata
             with open(metadata_path, 'w', encoding='utf-8') as f:
@@ -393,6 +729,8 @@ def process_segments(knowledge_dir, transcript_dir, generate_speech=False, voice
             print(f"Error processing metadata file {metadata_path}: {str(e)}")
     
     print("\nAdvice generation complete!")
+    print_token_usage(usage_stats)
+    print_cache_stats()
     return True
 
 if __name__ == "__main__":
@@ -401,13 +739,35 @@ if __name__ == "__main__":
     parser.add_argument("transcript_dir", help="Directory containing transcript files and metadata")
     parser.add_argument("--generate-speech", action="store_true", help="Generate speech for each advice using ElevenLabs")
     parser.add_argument("--voice-id", default="pNInz6obpgDQGcFmaJgB", help="ElevenLabs voice ID to use (default: pNInz6obpgDQGcFmaJgB)")
+    parser.add_argument("--batch", action="store_true", help="Generate all pending advice with one Message Batches API job")
+    parser.add_argument("--poll-interval", type=int, default=30, help="Seconds between batch status checks (default: 30)")
+    parser.add_argument("--image-tokens", type=int, default=0,
+                        help=f"Downscale frames to about this many image tokens, e.g. {SUGGESTED_IMAGE_TOKENS}; 0 uploads them unchanged (default: 0)")
+    parser.add_argument("--image-crop", help="Only send this region of each frame, as x:y:w:h fractions (e.g. 0:0.75:1:0.25)")
+    parser.add_argument("--top-k", type=int, default=0, help="Only send the K knowledge chunks most relevant to each segment (default: 0, send all knowledge)")
+    parser.add_argument("--trace", nargs='?', const="", help="Write a JSONL trace of spans, requests and retries and print a summary (default path: traces/generate_advice_<time>.jsonl)")
     
     args = parser.parse_args()
     
+    if args.trace is not None:
+        configure_tracing(args.trace or default_trace_path(__file__))
+    
+    try:
+        parse_image_crop(args.image_crop)
+    except ValueError as e:
+        parser.error(str(e))
+    
     # Process segments
-    process_segments(
-        args.knowledge_dir, 
-        args.transcript_dir, 
-        generate_speech=args.generate_speech,
-        voice_id=args.voice_id
-    )
+    with get_tracer().span("generate_advice"):
+        process_segments(
+            args.knowledge_dir, 
+            args.transcript_dir, 
+            generate_speech=args.generate_speech,
+            voice_id=args.voice_id,
+            top_k=args.top_k,
+            batch=args.batch,
+            poll_interval=args.poll_interval,
+            image_max_tokens=args.image_tokens,
+            image_crop=args.image_crop
+        )
+    print_trace_summary()
@@ -6,10 +6,19 @@ import subprocess
 import tempfile
 from pathlib import Path
 from dotenv import load_dotenv
+from media_probe import PROBE_CACHE_FILENAME, ProbeCache, probe_durations
+from tracing import configure_tracing, default_trace_path, get_tracer, print_trace_summary
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Volume of the original game audio under the advice
+ORIGINAL_AUDIO_VOLUME = 0.0
+
+# Above this many advice clips, mix through a single pre-rendered advice track
+TRACK_MIX_THRESHOLD = 32
+TRACK_SAMPLE_RATE = 48000
+
 def check_audio_streams(video_path):
     """Check audio streams in the video file."""
     cmd = [
@@ -112,7 +121,76 @@ def get_audio_duration(audio_path, timeout=10):
         print(f"Exception during audio duration check: {str(e)}")
         return 0
 
-def generate_video_with_advice(input_video_path, transcript_folder_path, output_video_path=None):
+def render_advice_track(advice_segments, track_path, sample_rate=TRACK_SAMPLE_RATE):
+    """
+    Render non-overlapping advice clips into one sparse mono track.
+    
+    Each clip is decoded to PCM and streamed into a single FLAC encoder, with silence written
+    for the gaps, so memory use does not depend on the number of clips or the track length.
+    Clips are cut at the start of the next clip so every clip starts at its exact sample.
+    """
+    bytes_per_second = sample_rate * 2  # 16-bit mono
+    encoder_cmd = [
+        'ffmpeg',
+        '-v', 'error',
+        '-f', 's16le', '-ar', str(sample_rate), '-ac', '1', '-i', 'pipe:0',
+        '-c:a', 'flac',
+        '-y',
+        track_path
+    ]
+    
+    try:
+        encoder = subprocess.Popen(encoder_cmd, stdin=subprocess.PIPE)
+    except Exception as e:
+        print(f"Error starting advice track encoder: {str(e)}")
+        return False
+    
+    try:
+        position = 0  # samples written so far
+        for i, segment in enumerate(advice_segments):
+            start_sample = int(segment["start_time"] * sample_rate)
+            
+            # Silence up to the start of this clip, written in bounded chunks
+            while position < start_sample:
+                silence_samples = min(start_sample - position, sample_rate)
+                encoder.stdin.write(bytes(silence_samples * 2))
+                position += silence_samples
+            
+            # Never let a clip run into the next one
+            max_samples = None
+            if i + 1 < len(advice_segments):
+                max_samples = int(advice_segments[i + 1]["start_time"] * sample_rate) - position
+            
+            decoder = subprocess.Popen(
+                ['ffmpeg', '-v', 'error', '-i', segment["speech_path"],
+                 '-f', 's16le', '-ar', str(sample_rate), '-ac', '1', 'pipe:1'],
+                stdout=subprocess.PIPE
+            )
+            written = 0
+            while True:
+                chunk = decoder.stdout.read(bytes_per_second)
+                if not chunk:
+                    break
+                if max_samples is not None:
+                    chunk = chunk[:max(0, (max_samples - written) * 2)]
+                encoder.stdin.write(chunk)
+                written += len(chunk) // 2
+            decoder.stdout.close()
+            if decoder.wait() != 0:
+                print(f"Warning: Could not decode {segment['speech_path']}")
+            position += written
+        
+        encoder.stdin.close()
+        if encoder.wait() != 0:
+            print("Error encoding advice track")
+            return False
+        return True
+    except Exception as e:
+        print(f"Error rendering advice track: {str(e)}")
+        encoder.kill()
+        return False
+
+def generate_video_with_advice(input_video_path, transcript_folder_path, output_video_path=None, mix_mode="auto"):
     """
     Generate a new video with the original audio reduced to 20% and advice audio overlaid.
     
@@ -120,6 +198,8 @@ def generate_video_with_advice(input_video_path, transcript_folder_path, output_
         input_video_path: Path to the original video
         transcript_folder_path: Path to the folder containing transcripts and advice audio
         output_video_path: Path for the output video (if None, will be generated based on input)
+        mix_mode: "inline" adds every clip as its own ffmpeg input, "track" renders the clips
+            into one sparse track first, "auto" picks "track" above TRACK_MIX_THRESHOLD clips
     """
     # Validate input paths
     if not os.path.exists(input_video_path):
@@ -161,128 +241,116 @@ def generate_video_with_advice(input_video_path, transcript_folder_path, output_
         print(f"Error loading metadata: {str(e)}")
         return False
     
-    # Create a temporary directory for intermediate files
-    with tempfile.TemporaryDirectory() as temp_dir:
-        print(f"Created temporary directory: {temp_dir}")
-        
-        # Step 1: Create a version of the original video with audio volume reduced to 20%
-        reduced_audio_video_path = os.path.join(temp_dir, "reduced_audio.mp4")
-        
-        cmd = [
-            'ffmpeg',
-            '-i', input_video_path,
-            '-filter_complex', '[0:a]volume=0.0[a]',
-            '-map', '0:v',
-            '-map', '[a]',
-            '-c:v', 'copy',
-            reduced_audio_video_path
-        ]
-        
-        print("Reducing original audio volume to 20%...")
-        try:
-            subprocess.run(cmd, check=True)
-            print("✓ Audio volume reduced successfully")
-        except subprocess.CalledProcessError as e:
-            print(f"Error reducing audio volume: {e}")
-            return False
-        
-        # Step 2: Prepare the filter complex for overlaying advice audio
-        filter_complex = []
-        input_count = 1  # Start with 1 for the reduced audio video
+    # Collect all advice segments that have speech files
+    speech_segments = []
+    
+    for segment in segments:
+        speech_file = segment.get("speechFile")
         
-        # Track the end time of the last advice to avoid overlaps
-        last_advice_end_time = 0
+        if not speech_file:
+            continue
         
-        # Collect all advice segments that have speech files
-        advice_segments = []
+        speech_path = os.path.join(transcript_folder_path, speech_file)
+        if not os.path.exists(speech_path):
+            print(f"Warning: Speech file not found: {speech_path}")
+            continue
         
-        for segment in segments:
-            segment_num = segment.get("segment")
-            start_time = segment.get("startTime", 0)
-            speech_file = segment.get("speechFile")
-            
-            if not speech_file:
-                continue
-            
-            speech_path = os.path.join(transcript_folder_path, speech_file)
-            if not os.path.exists(speech_path):
-                print(f"Warning: Speech file not found: {speech_path}")
-                continue
-            
-            # Get the duration of the speech file
+        speech_segments.append((segment, speech_path))
+    
+    # Durations come from metadata when recorded at speech generation time, otherwise they
+    # are read from the MP3 headers in parallel and remembered in the folder's probe cache
+    to_probe = [path for segment, path in speech_segments if not segment.get("speechDuration")]
+    durations = {}
+    if to_probe:
+        print(f"Probing duration of {len(to_probe)} speech files...")
+        probe_cache = ProbeCache(os.path.join(transcript_folder_path, PROBE_CACHE_FILENAME))
+        with get_tracer().span("probe_durations", files=len(to_probe)):
+            durations = probe_durations(to_probe, probe_cache)
+    
+    advice_segments = []
+    for segment, speech_path in speech_segments:
+        speech_duration = segment.get("speechDuration") or durations.get(speech_path, 0)
+        if speech_duration <= 0:
+            # Fall back to ffprobe for files the header parser cannot read
             speech_duration = get_audio_duration(speech_path)
-            if speech_duration <= 0:
-                print(f"Warning: Could not determine duration of {speech_path}")
-                continue
-            
-            # Calculate end time of this advice
-            end_time = start_time + speech_duration
-            
-            # Add to our list of advice segments
-            advice_segments.append({
-                "segment_num": segment_num,
-                "start_time": start_time,
-                "end_time": end_time,
-                "speech_path": speech_path,
-                "speech_duration": speech_duration
-            })
-        
-        # Sort advice segments by start time
-        advice_segments.sort(key=lambda x: x["start_time"])
+        if speech_duration <= 0:
+            print(f"Warning: Could not determine duration of {speech_path}")
+            continue
         
-        # Filter out overlapping segments
-        filtered_advice_segments = []
-        for segment in advice_segments:
-            if segment["start_time"] >= last_advice_end_time:
-                filtered_advice_segments.append(segment)
-                last_advice_end_time = segment["end_time"]
-            else:
-                print(f"Skipping segment {segment['segment_num']} due to overlap with previous advice")
+        start_time = segment.get("startTime", 0)
         
-        print(f"Using {len(filtered_advice_segments)} advice segments (skipped {len(advice_segments) - len(filtered_advice_segments)} due to overlaps)")
+        # Add to our list of advice segments
+        advice_segments.append({
+            "segment_num": segment.get("segment"),
+            "start_time": start_time,
+            "end_time": start_time + speech_duration,
+            "speech_path": speech_path,
+            "speech_duration": speech_duration
+        })
+    
+    # Sort advice segments by start time
+    advice_segments.sort(key=lambda x: x["start_time"])
+    
+    # Filter out overlapping segments, tracking the end time of the last advice
+    last_advice_end_time = 0
+    filtered_advice_segments = []
+    for segment in advice_segments:
+        if segment["start_time"] >= last_advice_end_time:
+            filtered_advice_segments.append(segment)
+            last_advice_end_time = segment["end_time"]
+        else:
+            print(f"Skipping segment {segment['segment_num']} due to overlap with previous advice")
+    
+    print(f"Using {len(filtered_advice_segments)} advice segments (skipped {len(advice_segments) - len(filtered_advice_segments)} due to overlaps)")
+    
+    # With many clips, one ffmpeg input and adelay chain per clip hits file descriptor and
+    # filter graph limits, so the clips are first rendered into a single sparse track
+    if mix_mode == "auto":
+        mix_mode = "track" if len(filtered_advice_segments) > TRACK_MIX_THRESHOLD else "inline"
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Build a single filter graph that reduces the original audio and mixes in the advice,
+        # reading the original video directly so no intermediate video file is written
+        inputs = [input_video_path]
+        filter_parts = [f"[0:a]volume={ORIGINAL_AUDIO_VOLUME}[orig]"]
         
-        # If no advice segments remain, just copy the reduced audio video
-        if not filtered_advice_segments:
-            print("No advice segments to overlay, copying reduced audio video...")
-            cmd = [
-                'ffmpeg',
-                '-i', reduced_audio_video_path,
-                '-c', 'copy',
-                output_video_path
-            ]
-            
-            try:
-                subprocess.run(cmd, check=True)
-                print(f"✓ Video saved to {output_video_path}")
-                return True
-            except subprocess.CalledProcessError as e:
-                print(f"Error copying video: {e}")
+        if filtered_advice_segments and mix_mode == "track":
+            track_path = os.path.join(temp_dir, "advice_track.flac")
+            print(f"Rendering {len(filtered_advice_segments)} advice clips into a single track...")
+            with get_tracer().span("ffmpeg.render_track", clips=len(filtered_advice_segments)):
+                rendered = render_advice_track(filtered_advice_segments, track_path)
+            if not rendered:
                 return False
-        
-        # Build the filter complex for overlaying advice audio
-        inputs = [reduced_audio_video_path]
-        filter_parts = []
-        
-        # Add input for each advice audio file
-        for i, segment in enumerate(filtered_advice_segments):
-            inputs.append(segment["speech_path"])
+            print("✓ Advice track rendered")
             
-            # Add adelay filter to position the audio at the right timestamp
-            # adelay takes delay in milliseconds
-            delay_ms = int(segment["start_time"] * 1000)
-            filter_parts.append(f"[{i+1}:a]adelay={delay_ms}|{delay_ms}[a{i+1}]")
-        
-        # Mix all audio streams
-        mix_inputs = "[0:a]"  # Start with the reduced original audio
-        for i in range(len(filtered_advice_segments)):
-            mix_inputs += f"[a{i+1}]"
-        
-        filter_parts.append(f"{mix_inputs}amix=inputs={len(filtered_advice_segments)+1}:duration=longest:normalize=0[aout]")
+            inputs.append(track_path)
+            filter_parts.append("[orig][1:a]amix=inputs=2:duration=longest:normalize=0[aout]")
+            print("Creating final video with reduced original audio and the advice track...")
+        elif filtered_advice_segments:
+            # Add input for each advice audio file
+            for i, segment in enumerate(filtered_advice_segments):
+                inputs.append(segment["speech_path"])
+                
+                # Add adelay filter to position the audio at the right timestamp
+                # adelay takes delay in milliseconds
+                delay_ms = int(segment["start_time"] * 1000)
+                filter_parts.append(f"[{i+1}:a]adelay={delay_ms}|{delay_ms}[a{i+1}]")
+            
+            # Mix all audio streams, starting with the reduced original audio
+            mix_inputs = "[orig]"
+            for i in range(len(filtered_advice_segments)):
+                mix_inputs += f"[a{i+1}]"
+            
+            filter_parts.append(f"{mix_inputs}amix=inputs={len(filtered_advice_segments)+1}:duration=longest:normalize=0[aout]")
+            print("Creating final video with reduced original audio and overlaid advice audio...")
+        else:
+            # No advice to overlay, only the volume reduction remains
+            filter_parts[0] = f"[0:a]volume={ORIGINAL_AUDIO_VOLUME}[aout]"
+            print("No advice segments to overlay, creating video with reduced original audio...")
         
         # Combine all filter parts
         filter_complex = ";".join(filter_parts)
         
-        # Step 3: Create the final video with overlaid advice audio
         cmd = [
             'ffmpeg',
             *sum([['-i', input_path] for input_path in inputs], []),  # Flatten the input arguments
@@ -293,9 +361,9 @@ def generate_video_with_advice(input_video_path, transcript_folder_path, output_
             output_video_path
         ]
         
-        print("Creating final video with overlaid advice audio...")
         try:
-            subprocess.run(cmd, check=True)
+            with get_tracer().span("ffmpeg.mux", inputs=len(inputs)):
+                subprocess.run(cmd, check=True)
             print(f"✓ Video successfully created: {output_video_path}")
             
             # Verify that the output video has audio
@@ -314,16 +382,24 @@ if __name__ == "__main__":
     parser.add_argument("input_video", help="Path to the original video file")
     parser.add_argument("transcript_folder", help="Path to the folder containing transcripts and advice audio")
     parser.add_argument("--output", help="Path for the output video (optional, default is next to original)")
+    parser.add_argument("--mix-mode", choices=["auto", "inline", "track"], default="auto",
+                        help="How to overlay advice clips: one ffmpeg input per clip (inline) or one pre-rendered track (track) (default: auto)")
+    parser.add_argument("--trace", nargs='?', const="", help="Write a JSONL trace of spans and print a summary (default path: traces/generate_video_<time>.jsonl)")
     
     args = parser.parse_args()
     
+    if args.trace is not None:
+        configure_tracing(args.trace or default_trace_path(__file__))
+    
     # Check if FFmpeg is installed
     if not check_ffmpeg():
         print("Please install FFmpeg and make sure it's in your PATH.")
         sys.exit(1)
     
     # Generate the video
-    success = generate_video_with_advice(args.input_video, args.transcript_folder, args.output)
+    with get_tracer().span("generate_video"):
+        success = generate_video_with_advice(args.input_video, args.transcript_folder, args.output, mix_mode=args.mix_mode)
+    print_trace_summary()
     
     if success:
         print("Video generation completed successfully!")
@@ -0,0 +1,212 @@
+import os
+import time
+import random
+import threading
+from datetime import datetime, timezone
+import requests
+from requests.adapters import HTTPAdapter
+from adaptive_concurrency import CircuitOpenError, get_limiter
+from tracing import get_tracer
+
+try:
+    import httpx  # Optional, only used for HTTP/2
+except ImportError:
+    httpx = None
+
+# (connect, read) timeouts in seconds per endpoint; uploads and long generations get more time
+ENDPOINT_TIMEOUTS = {
+    "anthropic.messages": (10, 120),
+    "anthropic.batch_submit": (10, 300),
+    "anthropic.batch_status": (10, 60),
+    "anthropic.batch_results": (10, 300),
+    "elevenlabs.tts": (10, 60),
+    "elevenlabs.stt": (10, 120),
+}
+DEFAULT_TIMEOUT = (10, 60)
+
+# Statuses worth retrying: timeouts, rate limits, overload and transient server errors
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504, 529)
+
+# Connections kept open per host; enough for the concurrent workers of every script
+POOL_SIZE = 32
+
+# Backoff is capped so a long outage does not stall a run for minutes per attempt
+MAX_BACKOFF = 60
+
+# Throttled requests (429/529) are retried more often than failed ones; the adaptive limit
+# already slows everyone down, so waiting out the rate limit is cheaper than giving up
+MAX_THROTTLED_RETRIES = 8
+
+def get_rate_limit_delay(response):
+    """Return how many seconds the API asks us to wait, based on the response headers."""
+    headers = response.headers
+
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+
+    # Fall back to the reset timestamps of exhausted Anthropic rate limits
+    delay = 0.0
+    for limit in ("requests", "tokens", "input-tokens", "output-tokens"):
+        remaining = headers.get(f"anthropic-ratelimit-{limit}-remaining")
+        reset = headers.get(f"anthropic-ratelimit-{limit}-reset")
+        if remaining is None or reset is None:
+            continue
+        try:
+            if int(remaining) > 0:
+                continue
+            reset_at = datetime.fromisoformat(reset.replace("Z", "+00:00"))
+            delay = max(delay, (reset_at - datetime.now(timezone.utc)).total_seconds())
+        except ValueError:
+            pass
+    return delay
+
+def get_backoff_delay(attempt, base_delay, response=None):
+    """
+    Return the wait before retry number attempt (0-based).
+
+    A delay requested by the server (retry-after or rate limit reset) is honoured, plus up to
+    base_delay of jitter; otherwise the delay grows exponentially with "full jitter". Either
+    way, clients that were throttled or failed together do not retry together.
+    """
+    if response is not None:
+        requested = get_rate_limit_delay(response)
+        if requested > 0:
+            return requested + random.uniform(0, base_delay)
+    return random.uniform(0, min(MAX_BACKOFF, base_delay * (2 ** attempt)))
+
+# Exceptions raised for connection failures and timeouts by either client
+TRANSPORT_ERRORS = (requests.exceptions.RequestException,) + ((httpx.HTTPError,) if httpx else ())
+
+class _Http2Session:
+    """Adapter giving an httpx HTTP/2 client the parts of the requests.Session interface used here."""
+
+    def __init__(self):
+        self.client = httpx.Client(http2=True, limits=httpx.Limits(max_connections=POOL_SIZE))
+
+    def request(self, method, url, timeout=None, **kwargs):
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        response = self.client.request(method, url, timeout=httpx.Timeout(read, connect=connect), **kwargs)
+        # Tracing reads the sent body from response.request.body, as with requests
+        response.request.body = response.request.content
+        return response
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+_session = None
+_session_lock = threading.Lock()
+
+def create_session():
+    """
+    Create the HTTP client shared by all API calls.
+
+    Connections are pooled and kept alive, so only the first request to a host pays for the
+    TLS handshake. With DUOAI_HTTP2=1 and httpx[http2] installed, requests are multiplexed
+    over HTTP/2 instead.
+    """
+    if os.getenv("DUOAI_HTTP2", "").lower() in ("1", "true", "yes"):
+        try:
+            import h2  # noqa: F401, required by httpx for HTTP/2
+            if httpx is None:
+                raise ImportError("httpx")
+            return _Http2Session()
+        except ImportError:
+            print("Warning: DUOAI_HTTP2 needs httpx[http2] (pip install 'httpx[http2]'), using HTTP/1.1")
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_session():
+    """Return the process-wide HTTP client."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+def get_timeout(endpoint):
+    """Return the (connect, read) timeout for an endpoint."""
+    return ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+
+def send_request(method, url, endpoint, timeout=None, **kwargs):
+    """
+    Send one request with the shared client and trace it.
+
+    The request waits for a slot of its provider's adaptive concurrency limit, and its outcome
+    adjusts that limit. Raises TRANSPORT_ERRORS on failure, including CircuitOpenError.
+    """
+    tracer = get_tracer()
+    with get_limiter(endpoint).slot() as slot:
+        started = time.perf_counter()
+        try:
+            response = get_session().request(method, url, timeout=timeout or get_timeout(endpoint), **kwargs)
+        except TRANSPORT_ERRORS as e:
+            tracer.request(endpoint, started, error=e)
+            raise
+        tracer.request(endpoint, started, response)
+        slot["status"] = response.status_code
+    return response
+
+def request_with_retries(method, url, endpoint, description, max_retries=3, base_delay=2, timeout=None,
+                         prefix="  ", before_attempt=None, on_throttle=None, **kwargs):
+    """
+    Send a request, retrying connection errors and retryable statuses with jittered backoff.
+
+    Errors are retried up to max_retries attempts and throttling (429/529) up to
+    MAX_THROTTLED_RETRIES times; nothing is retried while the provider's circuit is open.
+    description names the call in progress messages (e.g. "Claude API request"). Callers with
+    their own rate limiter pass before_attempt, called before every attempt, and on_throttle,
+    called with the backoff delay after a 429/529. Returns the last response, which the caller
+    checks for success, or None if no response was received. Request bodies must be bytes or
+    JSON, not open files, so they can be sent again.
+    """
+    tracer = get_tracer()
+    response = None
+    failures = 0
+    throttles = 0
+    while True:
+        if before_attempt is not None:
+            before_attempt()
+        print(f"{prefix}Sending {description} (attempt {failures + throttles + 1})...")
+        try:
+            response = send_request(method, url, endpoint, timeout=timeout, **kwargs)
+        except CircuitOpenError as e:
+            print(f"{prefix}✗ {str(e)}")
+            return None
+        except TRANSPORT_ERRORS as e:
+            print(f"{prefix}✗ Error during {description}: {str(e)}")
+            response = None
+            reason = str(e)
+            failures += 1
+        else:
+            if response.status_code < 400:
+                return response
+            print(f"{prefix}✗ {description[0].upper()}{description[1:]} failed: {response.status_code} - {response.text}")
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            reason = response.status_code
+            if response.status_code in (429, 529):
+                throttles += 1
+            else:
+                failures += 1
+
+        if failures >= max_retries or throttles > MAX_THROTTLED_RETRIES:
+            return response
+
+        delay = get_backoff_delay(failures + throttles - 1, base_delay, response)
+        if on_throttle is not None and response is not None and response.status_code in (429, 529):
+            on_throttle(delay)
+        print(f"{prefix}Retrying in {delay:.1f} seconds...")
+        tracer.retry(endpoint, delay, reason)
+        time.sleep(delay)
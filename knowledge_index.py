@@ -0,0 +1,229 @@
+import os
+import re
+import json
+import zlib
+import argparse
+import numpy as np
+
+# Index files are stored next to the knowledge files they were built from
+INDEX_DIRNAME = ".index"
+INDEX_VERSION = 1
+
+# Number of hashed feature buckets (unigrams and bigrams share the same space)
+NUM_FEATURES = 2 ** 18
+
+# Target size of a knowledge chunk in characters
+CHUNK_SIZE = 800
+
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "for", "from",
+    "has", "have", "i", "if", "in", "is", "it", "its", "just", "me", "my", "not", "of",
+    "on", "or", "so", "that", "the", "their", "them", "then", "there", "they", "this",
+    "to", "up", "was", "we", "what", "when", "which", "will", "with", "you", "your"
+}
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+def tokenize(text):
+    """Lowercase the text and return its unigram and bigram features."""
+    words = [w.strip("'") for w in TOKEN_PATTERN.findall(text.lower())]
+    words = [w for w in words if w and w not in STOP_WORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+def hash_feature(feature):
+    """Map a feature to a bucket with a hash that is stable across processes."""
+    return zlib.crc32(feature.encode('utf-8')) % NUM_FEATURES
+
+def split_into_chunks(text, chunk_size=CHUNK_SIZE):
+    """Split a knowledge file into chunks of whole paragraphs or list items."""
+    # Knowledge files are mostly lists, so break before every list item as well as on blank lines
+    parts = re.split(r"\n\s*\n|\n(?=\s*(?:[-*•]|\d+[.)])\s)", text)
+
+    chunks = []
+    current = ""
+    for part in parts:
+        part = part.strip()
+        if not part:
+            continue
+        if current and len(current) + len(part) + 1 > chunk_size:
+            chunks.append(current)
+            current = part
+        else:
+            current = f"{current}\n{part}" if current else part
+    if current:
+        chunks.append(current)
+    return chunks
+
+def get_knowledge_manifest(knowledge_dir):
+    """Return name, size and mtime of every knowledge file, used to detect a stale index."""
+    manifest = []
+    for filename in sorted(os.listdir(knowledge_dir)):
+        if not filename.endswith('.txt'):
+            continue
+        stat = os.stat(os.path.join(knowledge_dir, filename))
+        manifest.append([filename, stat.st_size, int(stat.st_mtime)])
+    return manifest
+
+class KnowledgeIndex:
+    """Hashed TF-IDF index over knowledge chunks, stored as a sparse CSR matrix in NumPy arrays."""
+
+    def __init__(self, chunks, sources, indptr, indices, data, idf):
+        self.chunks = chunks
+        self.sources = sources
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.idf = idf
+
+    @classmethod
+    def build(cls, knowledge_dir):
+        """Chunk every knowledge file in the directory and build the index."""
+        chunks = []
+        sources = []
+        for filename, _, _ in get_knowledge_manifest(knowledge_dir):
+            try:
+                with open(os.path.join(knowledge_dir, filename), 'r', encoding='utf-8') as f:
+                    content = f.read()
+            except Exception as e:
+                print(f"Error reading knowledge file {filename}: {str(e)}")
+                continue
+            for chunk in split_into_chunks(content):
+                chunks.append(chunk)
+                sources.append(filename)
+
+        # Term counts per chunk
+        rows = []
+        document_frequency = np.zeros(NUM_FEATURES, dtype=np.int32)
+        for chunk in chunks:
+            buckets, counts = np.unique(
+                np.array([hash_feature(f) for f in tokenize(chunk)], dtype=np.int64),
+                return_counts=True
+            )
+            rows.append((buckets, counts))
+            document_frequency[buckets] += 1
+
+        # Smoothed inverse document frequency
+        idf = (np.log((1 + len(chunks)) / (1 + document_frequency)) + 1).astype(np.float32)
+
+        # Sublinear tf * idf, L2-normalised per chunk
+        indptr = np.zeros(len(chunks) + 1, dtype=np.int64)
+        indices = []
+        data = []
+        for i, (buckets, counts) in enumerate(rows):
+            weights = (1 + np.log(counts)).astype(np.float32) * idf[buckets]
+            norm = np.linalg.norm(weights)
+            if norm > 0:
+                weights /= norm
+            indices.append(buckets.astype(np.int32))
+            data.append(weights)
+            indptr[i + 1] = indptr[i] + len(buckets)
+
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+        data = np.concatenate(data) if data else np.zeros(0, dtype=np.float32)
+        return cls(chunks, sources, indptr, indices, data, idf)
+
+    def save(self, knowledge_dir, manifest):
+        """Persist the index into the knowledge directory."""
+        index_dir = os.path.join(knowledge_dir, INDEX_DIRNAME)
+        os.makedirs(index_dir, exist_ok=True)
+        np.savez_compressed(
+            os.path.join(index_dir, "vectors.npz"),
+            indptr=self.indptr, indices=self.indices, data=self.data, idf=self.idf
+        )
+        with open(os.path.join(index_dir, "chunks.json"), 'w', encoding='utf-8') as f:
+            json.dump({
+                "version": INDEX_VERSION,
+                "numFeatures": NUM_FEATURES,
+                "manifest": manifest,
+                "chunks": self.chunks,
+                "sources": self.sources
+            }, f)
+
+    @classmethod
+    def load(cls, knowledge_dir, manifest=None):
+        """Load a persisted index, or return None if it is missing or out of date."""
+        index_dir = os.path.join(knowledge_dir, INDEX_DIRNAME)
+        chunks_path = os.path.join(index_dir, "chunks.json")
+        vectors_path = os.path.join(index_dir, "vectors.npz")
+        if not os.path.exists(chunks_path) or not os.path.exists(vectors_path):
+            return None
+
+        try:
+            with open(chunks_path, 'r', encoding='utf-8') as f:
+                info = json.load(f)
+            if info.get("version") != INDEX_VERSION or info.get("numFeatures") != NUM_FEATURES:
+                return None
+            if manifest is not None and info.get("manifest") != manifest:
+                return None
+
+            vectors = np.load(vectors_path)
+            return cls(
+                info["chunks"], info["sources"],
+                vectors["indptr"], vectors["indices"], vectors["data"], vectors["idf"]
+            )
+        except Exception as e:
+            print(f"Error loading knowledge index: {str(e)}")
+            return None
+
+    def search(self, query, top_k=10):
+        """Return the top-k (score, source, chunk) tuples most similar to the query."""
+        if not self.chunks:
+            return []
+
+        buckets, counts = np.unique(
+            np.array([hash_feature(f) for f in tokenize(query)], dtype=np.int64),
+            return_counts=True
+        )
+        if len(buckets) == 0:
+            return []
+
+        query_vector = np.zeros(NUM_FEATURES, dtype=np.float32)
+        query_vector[buckets] = (1 + np.log(counts)) * self.idf[buckets]
+
+        # Sparse matrix-vector product: sum each chunk's weights times the query weights
+        products = self.data * query_vector[self.indices]
+        cumulative = np.concatenate(([0.0], np.cumsum(products, dtype=np.float64)))
+        scores = cumulative[self.indptr[1:]] - cumulative[self.indptr[:-1]]
+
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), self.sources[i], self.chunks[i]) for i in best if scores[i] > 0]
+
+def load_or_build_index(knowledge_dir):
+    """Load the persisted index for a knowledge directory, rebuilding it if files changed."""
+    if not os.path.exists(knowledge_dir):
+        print(f"Knowledge directory not found: {knowledge_dir}")
+        return None
+
+    manifest = get_knowledge_manifest(knowledge_dir)
+    index = KnowledgeIndex.load(knowledge_dir, manifest)
+    if index is not None:
+        print(f"Loaded knowledge index with {len(index.chunks)} chunks")
+        return index
+
+    print(f"Building knowledge index for {len(manifest)} knowledge files...")
+    index = KnowledgeIndex.build(knowledge_dir)
+    index.save(knowledge_dir, manifest)
+    print(f"✓ Indexed {len(index.chunks)} chunks in {os.path.join(knowledge_dir, INDEX_DIRNAME)}")
+    return index
+
+def format_retrieved_knowledge(results):
+    """Format search results in the same layout load_knowledge_files uses."""
+    knowledge_text = ""
+    for _, source, chunk in results:
+        knowledge_text += f"\n\n--- KNOWLEDGE FROM {source} ---\n{chunk}\n"
+    return knowledge_text
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the retrieval index for a knowledge directory.")
+    parser.add_argument("knowledge_dir", help="Directory containing knowledge files")
+    parser.add_argument("--query", help="Print the chunks most relevant to this text")
+    parser.add_argument("--top-k", type=int, default=5, help="Number of chunks to return (default: 5)")
+
+    args = parser.parse_args()
+
+    index = load_or_build_index(args.knowledge_dir)
+    if index is not None and args.query:
+        for score, source, chunk in index.search(args.query, args.top_k):
+            print(f"\n[{score:.3f}] {source}\n{chunk}")
@@ -0,0 +1,199 @@
+import os
+import json
+import struct
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Probe results are kept next to the media they describe
+PROBE_CACHE_FILENAME = ".probe_cache.json"
+
+# Bitrates in kbit/s by (MPEG version 1?, layer) and bitrate index
+BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# Sample rates by version bits (0 = MPEG 2.5, 2 = MPEG 2, 3 = MPEG 1) and sample rate index
+SAMPLE_RATES = {
+    0: [11025, 12000, 8000],
+    2: [22050, 24000, 16000],
+    3: [44100, 48000, 32000],
+}
+
+def parse_frame_header(data, offset):
+    """Parse the MP3 frame header at offset. Returns (frame_length, samples, sample_rate) or None."""
+    if offset + 4 > len(data) or data[offset] != 0xFF or (data[offset + 1] & 0xE0) != 0xE0:
+        return None
+
+    version_bits = (data[offset + 1] >> 3) & 0x3
+    layer = 4 - ((data[offset + 1] >> 1) & 0x3)
+    bitrate_index = data[offset + 2] >> 4
+    sample_rate_index = (data[offset + 2] >> 2) & 0x3
+    padding = (data[offset + 2] >> 1) & 0x1
+    if version_bits == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    mpeg1 = version_bits == 3
+    bitrate = BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version_bits][sample_rate_index]
+
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    if layer == 3 and not mpeg1:
+        return 72 * bitrate // sample_rate + padding, 576, sample_rate
+    return 144 * bitrate // sample_rate + padding, 1152, sample_rate
+
+def skip_id3v2(data):
+    """Return the offset of the first byte after a leading ID3v2 tag."""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    # Tag size is a 28-bit "syncsafe" integer
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+def find_frame(data, offset):
+    """Return the offset of the next frame header that is followed by another valid header."""
+    while True:
+        offset = data.find(b"\xFF", offset)
+        if offset < 0 or offset + 4 > len(data):
+            return -1
+        header = parse_frame_header(data, offset)
+        if header:
+            following = offset + header[0]
+            if following + 4 > len(data) or parse_frame_header(data, following):
+                return offset
+        offset += 1
+
+def get_vbr_frame_count(data, offset):
+    """Return the frame count from a Xing/Info or VBRI header in the first frame, if present."""
+    mpeg1 = ((data[offset + 1] >> 3) & 0x3) == 3
+    mono = (data[offset + 3] >> 6) == 3
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+
+    xing = offset + 4 + side_info
+    if data[xing:xing + 4] in (b"Xing", b"Info") and len(data) >= xing + 12:
+        flags = struct.unpack(">I", data[xing + 4:xing + 8])[0]
+        if flags & 0x1:
+            return struct.unpack(">I", data[xing + 8:xing + 12])[0]
+
+    vbri = offset + 36
+    if data[vbri:vbri + 4] == b"VBRI" and len(data) >= vbri + 18:
+        return struct.unpack(">I", data[vbri + 14:vbri + 18])[0]
+    return None
+
+def get_mp3_duration(audio_path):
+    """
+    Read the duration of an MP3 file from its frame headers, without running ffprobe.
+
+    The frame count of a Xing/Info/VBRI header is used when present, otherwise every frame
+    header is walked. Returns the duration in seconds, or 0 if the file is not a valid MP3.
+    """
+    try:
+        with open(audio_path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        print(f"Error reading {audio_path}: {str(e)}")
+        return 0
+    return get_mp3_data_duration(data)
+
+def get_mp3_data_duration(data):
+    """Return the duration of in-memory MP3 data in seconds, or 0 if it contains no MP3 frames."""
+    offset = find_frame(data, skip_id3v2(data))
+    if offset < 0:
+        return 0
+
+    _, samples, sample_rate = parse_frame_header(data, offset)
+    frame_count = get_vbr_frame_count(data, offset)
+    if frame_count:
+        return frame_count * samples / sample_rate
+
+    total_samples = 0
+    while offset >= 0:
+        header = parse_frame_header(data, offset)
+        if header is None:
+            # Lost sync (e.g. a trailing tag or garbage), look for the next real frame
+            offset = find_frame(data, offset + 1)
+            continue
+        frame_length, samples, sample_rate = header
+        if offset + frame_length > len(data):
+            break
+        total_samples += samples
+        offset += frame_length
+    return total_samples / sample_rate
+
+class ProbeCache:
+    """Media durations keyed by path and invalidated when the file's size or mtime changes."""
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                print(f"Error loading probe cache: {str(e)}")
+
+    def get(self, path):
+        """Return the cached duration of a file, or None if unknown or out of date."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        entry = self.entries.get(os.path.abspath(path))
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry["duration"]
+        return None
+
+    def put(self, path, duration):
+        stat = os.stat(path)
+        with self.lock:
+            self.entries[os.path.abspath(path)] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "duration": duration
+            }
+            self.dirty = True
+
+    def save(self):
+        """Write the cache to disk if anything changed."""
+        if not self.dirty:
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.cache_path) or ".", prefix=".tmp_")
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.cache_path)
+            self.dirty = False
+        except OSError as e:
+            print(f"Error saving probe cache: {str(e)}")
+
+def probe_durations(paths, cache=None, workers=8):
+    """Return a dict of path -> duration for MP3 files, probing uncached files in parallel."""
+    durations = {}
+    to_probe = []
+    for path in paths:
+        duration = cache.get(path) if cache else None
+        if duration is None:
+            to_probe.append(path)
+        else:
+            durations[path] = duration
+
+    if to_probe:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(to_probe)))) as executor:
+            for path, duration in zip(to_probe, executor.map(get_mp3_duration, to_probe)):
+                durations[path] = duration
+                if cache and duration > 0:
+                    cache.put(path, duration)
+
+    if cache:
+        cache.save()
+    return durations
@@ -0,0 +1,478 @@
+import os
+import json
+import heapq
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+from prepare_video import (check_ffmpeg, create_output_directory, extract_audio_segment, extract_frame,
+                           extract_segments_batch, get_contiguous_runs, get_video_duration, transcribe_audio,
+                           write_metadata_atomic)
+from generate_advice import (SUGGESTED_IMAGE_TOKENS, generate_advice_with_claude_and_context,
+                             generate_speech_from_advice, load_knowledge_files, print_token_usage)
+from generate_video import generate_video_with_advice
+from knowledge_index import format_retrieved_knowledge, load_or_build_index
+from media_probe import get_mp3_duration
+from response_cache import print_cache_stats
+from tracing import configure_tracing, default_trace_path, get_tracer, print_trace_summary
+
+# Load environment variables from .env file
+load_dotenv()
+
+SEGMENT_DURATION = 30
+
+# Segments extracted per FFmpeg pass with batch_extract: large enough to save most process
+# starts, small enough that the first segments of every video reach transcription early
+EXTRACT_CHUNK_SEGMENTS = 10
+
+# Previous advices sent with each advice request, as in generate_advice.py
+CONTEXT_ADVICES = 10
+
+# Stages in pipeline order. Among ready tasks, later stages go first so finished work leaves
+# the pipeline early, then lower segment numbers across all videos, so every video starts
+# its advice chain (which runs segment by segment) as soon as possible
+STAGES = ["extract", "transcribe", "advise", "speech", "metadata", "render"]
+
+class Task:
+    """A unit of work in the scheduler's dependency graph."""
+
+    def __init__(self, name, stage, func, deps, after, resources, priority):
+        self.name = name
+        self.stage = stage
+        self.func = func
+        self.deps = deps            # must succeed before this task runs
+        self.after = after          # must finish (in any state) before this task runs
+        self.resources = resources  # names of the resource slots the task holds while running
+        self.priority = priority
+        self.state = "pending"      # pending, running, done, failed or skipped
+        self.waiting = len(deps) + len(after)
+        self.dependents = []
+
+    def __lt__(self, other):
+        return self.priority < other.priority
+
+class DagScheduler:
+    """
+    Run a dependency graph of tasks on a thread pool, limited by named resource slots.
+
+    A task starts as soon as its dependencies have finished and every resource it needs has
+    a free slot. Tasks whose hard dependencies failed are skipped, and so are their dependents.
+    """
+
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self.in_use = {name: 0 for name in limits}
+        self.tasks = []
+        self.ready = {}  # resource tuple -> heap of ready tasks
+
+    def add(self, name, stage, func, deps=(), after=(), resources=(), priority=()):
+        """Add a task; deps and after are tasks added earlier. Returns the new task."""
+        task = Task(name, stage, func, list(deps), list(after), tuple(resources), priority)
+        for dependency in task.deps + task.after:
+            dependency.dependents.append(task)
+        self.tasks.append(task)
+        if task.waiting == 0:
+            self._push(task)
+        return task
+
+    def _push(self, task):
+        heapq.heappush(self.ready.setdefault(task.resources, []), task)
+
+    def _finish(self, task, state):
+        """Record a task's final state and release the dependents waiting only for it."""
+        finished = [(task, state)]
+        while finished:
+            task, state = finished.pop()
+            task.state = state
+            for dependent in task.dependents:
+                if dependent.state != "pending":
+                    continue
+                if state != "done" and task in dependent.deps:
+                    finished.append((dependent, "skipped"))
+                    continue
+                dependent.waiting -= 1
+                if dependent.waiting == 0:
+                    self._push(dependent)
+
+    def _dispatch(self, executor, running):
+        """Start every ready task whose resources have a free slot, highest priority first."""
+        for resources, heap in sorted(self.ready.items(), key=lambda item: item[1][0].priority if item[1] else ()):
+            while heap and all(self.in_use[name] < self.limits[name] for name in resources):
+                task = heapq.heappop(heap)
+                if task.state != "pending":
+                    continue
+                for name in resources:
+                    self.in_use[name] += 1
+                task.state = "running"
+                running[executor.submit(self._run, task)] = task
+
+    def _run(self, task):
+        with get_tracer().span(f"pipeline.{task.stage}", task=task.name):
+            return task.func()
+
+    def run(self):
+        """Run all tasks. Returns a dict of state -> number of tasks."""
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, sum(self.limits.values()))) as executor:
+            self._dispatch(executor, running)
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    for name in task.resources:
+                        self.in_use[name] -= 1
+                    try:
+                        state = "failed" if future.result() is False else "done"
+                    except Exception as e:
+                        print(f"  ✗ {task.name} failed: {str(e)}")
+                        state = "failed"
+                    self._finish(task, state)
+                self._dispatch(executor, running)
+
+        counts = {}
+        for task in self.tasks:
+            counts[task.state] = counts.get(task.state, 0) + 1
+        return counts
+
+class VideoJob:
+    """State of one video moving through the pipeline."""
+
+    def __init__(self, index, video_path, base_dir, duration):
+        self.index = index
+        self.video_path = video_path
+        self.output_dir, self.name = create_output_directory(video_path, base_dir)
+        self.duration = duration
+        self.num_segments = int(duration // SEGMENT_DURATION)
+        self.segments = {}
+        self.last_advices = []
+        self.usage_stats = {}
+        self.rendered = False
+
+    def path(self, filename):
+        return os.path.join(self.output_dir, filename)
+
+    def has_file(self, filename):
+        return os.path.exists(self.path(filename)) and os.path.getsize(self.path(filename)) > 0
+
+    def extract(self, start_segment, end_segment, batch=False):
+        """
+        Extract the frames and audio of a range of segments that have no files from an earlier run.
+
+        By default every segment is extracted by seeking to it, which decodes only a few
+        frames. With batch, each run of missing segments is decoded in one FFmpeg pass,
+        falling back to seeking if the pass fails. Returns False if no segment could be extracted.
+        """
+        missing = [i for i in range(start_segment, end_segment)
+                   if not (self.has_file(f"frame_{i}.jpg") and self.has_file(f"audio_{i}.mp3"))]
+        for run_start, run_end in get_contiguous_runs(missing):
+            if batch:
+                if extract_segments_batch(self.video_path, self.output_dir, run_start, run_end, SEGMENT_DURATION):
+                    continue
+                print(f"  ✗ [{self.name}] Batch extraction of segments {run_start}-{run_end - 1} failed, "
+                      f"extracting them one by one")
+            for i in range(run_start, run_end):
+                extract_frame(self.video_path, self.path(f"frame_{i}.jpg"), i * SEGMENT_DURATION)
+                extract_audio_segment(self.video_path, self.path(f"audio_{i}.mp3"), i * SEGMENT_DURATION,
+                                      SEGMENT_DURATION)
+
+        for i in range(start_segment, end_segment):
+            if not self.has_file(f"audio_{i}.mp3"):
+                print(f"  ✗ [{self.name}] Failed to extract audio {i}")
+                continue
+            if not self.has_file(f"frame_{i}.jpg"):
+                print(f"  ✗ [{self.name}] Failed to extract frame {i}")
+            self.segments[i] = {
+                "segment": i,
+                "startTime": i * SEGMENT_DURATION,
+                "frameFile": f"frame_{i}.jpg",
+                "audioFile": f"audio_{i}.mp3"
+            }
+        return any(i in self.segments for i in range(start_segment, end_segment))
+
+    def transcribe(self, i, language):
+        """Transcribe a segment, reusing its transcript file from an earlier run."""
+        segment = self.segments.get(i)
+        if segment is None:
+            return False
+        transcript_file = f"transcript_{i}.txt"
+        if os.path.exists(self.path(transcript_file)):
+            with open(self.path(transcript_file), 'r', encoding='utf-8') as f:
+                transcript = f.read()
+        else:
+            transcript = transcribe_audio(self.path(segment["audioFile"]), language, timeout_seconds=60)
+            if not transcript:
+                print(f"  ✗ [{self.name}] No transcript for segment {i}")
+                return True
+            with open(self.path(transcript_file), 'w', encoding='utf-8') as f:
+                f.write(transcript)
+
+        segment["transcriptFile"] = transcript_file
+        segment["transcript"] = transcript
+        return True
+
+    def advise(self, i, knowledge_text, knowledge_index, top_k, api_key, image_max_tokens):
+        """Generate advice for a segment with the previous advices as context (segments run in order)."""
+        segment = self.segments.get(i)
+        if segment is None:
+            return True
+        advice_file = f"advice_{i}.txt"
+
+        if os.path.exists(self.path(advice_file)):
+            with open(self.path(advice_file), 'r', encoding='utf-8') as f:
+                advice = f.read().strip()
+        elif segment.get("transcript") and os.path.exists(self.path(segment["frameFile"])):
+            if knowledge_index is not None:
+                knowledge_text = format_retrieved_knowledge(knowledge_index.search(segment["transcript"], top_k))
+            advice = generate_advice_with_claude_and_context(
+                self.path(segment["frameFile"]),
+                segment["transcript"],
+                knowledge_text,
+                self.last_advices,
+                api_key,
+                cache_knowledge=knowledge_index is None,
+                stats=self.usage_stats,
+                image_max_tokens=image_max_tokens
+            )
+            if not advice:
+                print(f"  ✗ [{self.name}] Failed to generate advice for segment {i}")
+                return False
+            with open(self.path(advice_file), 'w', encoding='utf-8') as f:
+                f.write(advice)
+        else:
+            return True
+
+        segment["adviceFile"] = advice_file
+        segment["advice"] = advice
+        self.last_advices.append(f"Segment {i}: {advice}")
+        if len(self.last_advices) > CONTEXT_ADVICES:
+            self.last_advices.pop(0)
+        return True
+
+    def speak(self, i, api_key, voice_id):
+        """Generate speech for a segment's advice, reusing the file from an earlier run."""
+        segment = self.segments.get(i)
+        if segment is None or not segment.get("advice"):
+            return True
+        speech_file = f"advice_{i}.mp3"
+        if not os.path.exists(self.path(speech_file)):
+            if not generate_speech_from_advice(segment["advice"], self.path(speech_file), api_key, voice_id):
+                return False
+
+        segment["speechFile"] = speech_file
+        speech_duration = get_mp3_duration(self.path(speech_file))
+        if speech_duration > 0:
+            segment["speechDuration"] = round(speech_duration, 3)
+        return True
+
+    def write_metadata(self):
+        """Write metadata.json in the format prepare_video.py and generate_advice.py produce."""
+        metadata = {
+            "originalVideo": self.name,
+            "totalDuration": self.duration,
+            "segmentCount": self.num_segments,
+            "segments": [self.segments[number] for number in sorted(self.segments)]
+        }
+        # Leave unchanged metadata alone, so its time stamp tells whether a render is current
+        try:
+            with open(self.path("metadata.json"), 'r', encoding='utf-8') as f:
+                if json.load(f) == metadata:
+                    return True
+        except (OSError, ValueError):
+            pass
+        write_metadata_atomic(metadata, self.path("metadata.json"))
+        return True
+
+    def render(self, render_dir, mix_mode):
+        """Render the video with the advice audio, if the disk has room for the copy."""
+        target_dir = render_dir or os.path.dirname(os.path.abspath(self.video_path))
+        os.makedirs(target_dir, exist_ok=True)
+        output_path = os.path.join(target_dir, f"{self.name}_with_advice.mp4")
+
+        # Keep a render made after the last metadata change; an older one would make FFmpeg
+        # stop and ask whether to overwrite it
+        if os.path.exists(output_path):
+            if os.path.getmtime(output_path) >= os.path.getmtime(self.path("metadata.json")):
+                print(f"  ✓ [{self.name}] Already rendered: {output_path}")
+                self.rendered = True
+                return True
+            os.remove(output_path)
+
+        # The output is a stream copy of the video plus the new audio, about the input's size
+        needed = os.path.getsize(self.video_path) * 1.1
+        free = shutil.disk_usage(target_dir).free
+        if free < needed:
+            print(f"  ✗ [{self.name}] Not enough disk space to render ({free / 1e9:.1f} GB free, "
+                  f"{needed / 1e9:.1f} GB needed)")
+            return False
+
+        self.rendered = generate_video_with_advice(self.video_path, self.output_dir, output_path, mix_mode=mix_mode)
+        return self.rendered
+
+def run_pipeline(video_paths, knowledge_dir, base_dir="website/videos", language="en", generate_speech=True,
+                 voice_id="pNInz6obpgDQGcFmaJgB", top_k=0, image_max_tokens=0, render=True,
+                 render_dir=None, mix_mode="auto", ffmpeg_slots=None, disk_slots=2, stt_slots=8, advice_slots=8,
+                 tts_slots=8, batch_extract=False):
+    """
+    Prepare, advise, voice and render many videos as one dependency graph.
+
+    Each segment goes extract -> transcribe -> advise -> speech on its own, advice following
+    segment order within a video, and a video is rendered once all its segments are done.
+    With batch_extract, segments are extracted in chunks of EXTRACT_CHUNK_SEGMENTS with one
+    FFmpeg pass each, and each segment moves on as soon as its chunk is done.
+    FFmpeg jobs share ffmpeg_slots CPU slots, renders also take one of disk_slots, and every
+    API has its own slots on top of the adaptive per-provider limits of http_client. Outputs
+    of an earlier run are reused, so an interrupted run can simply be started again.
+    """
+    api_key = os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        print("Error: ANTHROPIC_API_KEY not found in environment variables.")
+        return False
+    elevenlabs_api_key = os.getenv("ELEVENLABS_API_KEY")
+    if generate_speech and not elevenlabs_api_key:
+        print("Warning: ELEVENLABS_API_KEY not found in environment variables. Speech generation will be skipped.")
+        generate_speech = False
+
+    knowledge_index = None
+    knowledge_text = ""
+    if top_k > 0:
+        knowledge_index = load_or_build_index(knowledge_dir)
+    if knowledge_index is None:
+        knowledge_text = load_knowledge_files(knowledge_dir)
+
+    jobs = []
+    for video_path in video_paths:
+        if not os.path.exists(video_path):
+            print(f"✗ Video file '{video_path}' not found, skipping")
+            continue
+        duration = get_video_duration(video_path)
+        if duration is None:
+            print(f"✗ Could not read the duration of {video_path}, skipping")
+            continue
+        jobs.append(VideoJob(len(jobs), video_path, base_dir, duration))
+
+    if not jobs:
+        print("No videos to process")
+        return False
+
+    scheduler = DagScheduler({
+        "ffmpeg": ffmpeg_slots or max(1, (os.cpu_count() or 2) // 2),
+        "disk": disk_slots,
+        "stt": stt_slots,
+        "advice": advice_slots,
+        "tts": tts_slots
+    })
+
+    chunk_segments = EXTRACT_CHUNK_SEGMENTS if batch_extract else 1
+
+    def priority(job, stage, segment=0):
+        return (-STAGES.index(stage), segment, job.index)
+
+    for job in jobs:
+        print(f"{job.name}: {job.duration:.0f}s, {job.num_segments} segments -> {job.output_dir}")
+        previous_advice = None
+        finished = []
+        extract = None
+        for i in range(job.num_segments):
+            if i % chunk_segments == 0:
+                end = min(job.num_segments, i + chunk_segments)
+                extract = scheduler.add(f"{job.name} extract {i}" + (f"-{end - 1}" if end - i > 1 else ""), "extract",
+                                        lambda job=job, i=i, end=end: job.extract(i, end, batch_extract),
+                                        resources=["ffmpeg"], priority=priority(job, "extract", i))
+            transcribe = scheduler.add(f"{job.name} transcribe {i}", "transcribe", lambda job=job, i=i: job.transcribe(i, language),
+                                       deps=[extract], resources=["stt"], priority=priority(job, "transcribe", i))
+            # Advice runs in segment order even when a segment failed, for the context of the next
+            advise = scheduler.add(
+                f"{job.name} advise {i}", "advise",
+                lambda job=job, i=i: job.advise(i, knowledge_text, knowledge_index, top_k, api_key, image_max_tokens),
+                deps=[transcribe], after=[previous_advice] if previous_advice else [],
+                resources=["advice"], priority=priority(job, "advise", i)
+            )
+            previous_advice = advise
+            finished.append(advise)
+            if generate_speech:
+                finished.append(scheduler.add(
+                    f"{job.name} speech {i}", "speech", lambda job=job, i=i: job.speak(i, elevenlabs_api_key, voice_id),
+                    deps=[advise], resources=["tts"], priority=priority(job, "speech", i)
+                ))
+
+        metadata = scheduler.add(f"{job.name} metadata", "metadata", job.write_metadata, after=finished,
+                                 priority=priority(job, "metadata"))
+        if render:
+            scheduler.add(f"{job.name} render", "render", lambda job=job: job.render(render_dir, mix_mode), deps=[metadata],
+                          resources=["ffmpeg", "disk"], priority=priority(job, "render"))
+
+    print(f"\nRunning {len(scheduler.tasks)} tasks for {len(jobs)} videos "
+          f"(slots: {', '.join(f'{name} {limit}' for name, limit in scheduler.limits.items())})...")
+    counts = scheduler.run()
+
+    print("\nPipeline complete!")
+    print(f"Tasks: {', '.join(f'{count} {state}' for state, count in sorted(counts.items()))}")
+    usage_stats = {}
+    for job in jobs:
+        advices = sum(1 for s in job.segments.values() if s.get("advice"))
+        speech = sum(1 for s in job.segments.values() if s.get("speechFile"))
+        status = "✓" if job.rendered or not render else "✗"
+        print(f"  {status} {job.name}: {len(job.segments)}/{job.num_segments} segments, "
+              f"{advices} advices, {speech} speech clips{', rendered' if job.rendered else ''}")
+        for field, value in job.usage_stats.items():
+            usage_stats[field] = usage_stats.get(field, 0) + value
+    print_token_usage(usage_stats)
+    print_cache_stats()
+    return counts.get("failed", 0) == 0 and counts.get("skipped", 0) == 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prepare, advise, voice and render many videos in one dependency-driven run.")
+    parser.add_argument("knowledge_dir", help="Directory containing knowledge files")
+    parser.add_argument("videos", nargs='+', help="Video files to process")
+    parser.add_argument("--output-dir", default="website/videos", help="Base directory for prepared segments (default: website/videos)")
+    parser.add_argument("--language", default="en", help="Language code for transcription (default: en)")
+    parser.add_argument("--no-speech", action="store_true", help="Do not generate speech for the advice")
+    parser.add_argument("--voice-id", default="pNInz6obpgDQGcFmaJgB", help="ElevenLabs voice ID to use (default: pNInz6obpgDQGcFmaJgB)")
+    parser.add_argument("--top-k", type=int, default=0, help="Only send the K knowledge chunks most relevant to each segment (default: 0, send all knowledge)")
+    parser.add_argument("--image-tokens", type=int, default=0,
+                        help=f"Downscale frames to about this many image tokens, e.g. {SUGGESTED_IMAGE_TOKENS}; 0 uploads them unchanged (default: 0)")
+    parser.add_argument("--batch-extract", action="store_true",
+                        help=f"Extract frames and audio in one FFmpeg pass per {EXTRACT_CHUNK_SEGMENTS} segments instead of seeking to each segment")
+    parser.add_argument("--no-render", action="store_true", help="Stop after speech generation")
+    parser.add_argument("--render-dir", help="Where to write the rendered videos (default: next to each original)")
+    parser.add_argument("--mix-mode", choices=["auto", "inline", "track"], default="auto",
+                        help="How generate_video overlays advice clips (default: auto)")
+    parser.add_argument("--ffmpeg-slots", type=int, help="Concurrent FFmpeg jobs (default: half the CPU cores)")
+    parser.add_argument("--disk-slots", type=int, default=2, help="Concurrent renders, which copy whole videos (default: 2)")
+    parser.add_argument("--stt-slots", type=int, default=8, help="Maximum transcription requests in flight (default: 8)")
+    parser.add_argument("--advice-slots", type=int, default=8, help="Maximum advice requests in flight (default: 8)")
+    parser.add_argument("--tts-slots", type=int, default=8, help="Maximum speech requests in flight (default: 8)")
+    parser.add_argument("--trace", nargs='?', const="", help="Write a JSONL trace of spans, requests and retries and print a summary (default path: traces/pipeline_<time>.jsonl)")
+
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        configure_tracing(args.trace or default_trace_path(__file__))
+
+    if not check_ffmpeg():
+        print("Please install FFmpeg and make sure it's in your PATH.")
+        raise SystemExit(1)
+
+    with get_tracer().span("pipeline"):
+        success = run_pipeline(
+            args.videos,
+            args.knowledge_dir,
+            base_dir=args.output_dir,
+            language=args.language,
+            generate_speech=not args.no_speech,
+            voice_id=args.voice_id,
+            top_k=args.top_k,
+            image_max_tokens=args.image_tokens,
+            render=not args.no_render,
+            render_dir=args.render_dir,
+            mix_mode=args.mix_mode,
+            ffmpeg_slots=args.ffmpeg_slots,
+            disk_slots=args.disk_slots,
+            stt_slots=args.stt_slots,
+            advice_slots=args.advice_slots,
+            tts_slots=args.tts_slots,
+            batch_extract=args.batch_extract
+        )
+    print_trace_summary()
+    if not success:
+        raise SystemExit(1)
@@ -1,19 +1,91 @@
 import os
+import re
 import sys
 import argparse
+import asyncio
 import json
 import time
-import requests
+import hashlib
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from googleapiclient.discovery import build
 from youtube_transcript_api import YouTubeTranscriptApi
 from youtube_transcript_api.formatters import TextFormatter
 from dotenv import load_dotenv
-from time import sleep
+from claude_batch import get_anthropic_base_url, make_custom_id, run_batch
+from response_cache import get_response_cache, make_cache_key, print_cache_stats
+from adaptive_concurrency import get_limiter
+from http_client import get_rate_limit_delay, request_with_retries
+from tracing import configure_tracing, default_trace_path, get_tracer, print_trace_summary
+from transcript_store import load_or_build_store
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Chunk size for chunked extraction of long transcripts (characters)
+CHUNK_MAX_CHARS = 40000
+
+# Transcript files are named "<video id>_<title>.txt" and YouTube video ids have 11 characters
+YOUTUBE_ID_LENGTH = 11
+
+# Request rate allowed per host, shared by every thread that talks to it
+HOST_REQUESTS_PER_MINUTE = {
+    "www.googleapis.com": 300,  # YouTube Data API (search and video details)
+    "www.youtube.com": 60       # Transcript downloads
+}
+
+class HostRateLimiter:
+    """Thread-safe limiter that spaces the requests to one host evenly."""
+    
+    def __init__(self, rate_per_minute, name="host"):
+        self.interval = 60.0 / rate_per_minute
+        self.name = name
+        self.next_at = 0.0
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a request to the host may be sent."""
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            get_tracer().sleep(f"rate_limit.{self.name}", wait)
+
+# YouTube Data API quota units charged per call
+YOUTUBE_QUOTA_COSTS = {
+    "search.list": 100,
+    "videos.list": 1
+}
+
+_quota_used = {}
+_quota_lock = threading.Lock()
+
+def record_quota(method):
+    """Count one YouTube Data API call against the daily quota."""
+    with _quota_lock:
+        _quota_used[method] = _quota_used.get(method, 0) + 1
+
+def print_quota_usage():
+    """Print the YouTube Data API calls made by this run and the quota units they cost."""
+    with _quota_lock:
+        calls = dict(_quota_used)
+    total = sum(YOUTUBE_QUOTA_COSTS[method] * count for method, count in calls.items())
+    details = ", ".join(f"{count} {method}" for method, count in sorted(calls.items())) or "no calls"
+    print(f"YouTube Data API quota used: {total} units ({details})")
+
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+
+def get_host_limiter(host):
+    """Return the process-wide rate limiter for a host."""
+    with _host_limiters_lock:
+        if host not in _host_limiters:
+            _host_limiters[host] = HostRateLimiter(HOST_REQUESTS_PER_MINUTE.get(host, 60), host)
+        return _host_limiters[host]
+
 def setup_youtube_api():
     """Set up and return a YouTube API client."""
     api_key = os.getenv("YOUTUBE_API_KEY")
@@ -23,7 +95,9 @@ def setup_youtube_api():
         sys.exit(1)
     
     try:
-        youtube = build('youtube', 'v3', developerKey=api_key)
+        # YOUTUBE_API_ENDPOINT points the client at a local stand-in server
+        client_options = {"api_endpoint": os.getenv("YOUTUBE_API_ENDPOINT")} if os.getenv("YOUTUBE_API_ENDPOINT") else None
+        youtube = build('youtube', 'v3', developerKey=api_key, client_options=client_options)
         return youtube
     except Exception as e:
         print(f"Error setting up YouTube API: {str(e)}")
@@ -33,14 +107,17 @@ def search_youtube_videos(youtube, query, max_results=10):
     """Search YouTube for videos matching the query."""
     try:
         print(f"Searching YouTube for: '{query}'")
+        get_host_limiter("www.googleapis.com").acquire()
+        record_quota("search.list")
         
         # Execute the search
-        search_response = youtube.search().list(
-            q=query,
-            part='id,snippet',
-            maxResults=max_results,
-            type='video'
-        ).execute()
+        with get_tracer().span("youtube.search"), get_limiter("youtube.search").slot():
+            search_response = youtube.search().list(
+                q=query,
+                part='id,snippet',
+                maxResults=max_results,
+                type='video'
+            ).execute()
         
         # Extract video information
         videos = []
@@ -78,10 +155,13 @@ def get_video_details(youtube, video_ids):
             chunk = video_ids[i:i+50]
             
             # Get video details
-            response = youtube.videos().list(
-                part='contentDetails,statistics,snippet',
-                id=','.join(chunk)
-            ).execute()
+            get_host_limiter("www.googleapis.com").acquire()
+            record_quota("videos.list")
+            with get_tracer().span("youtube.videos", count=len(chunk)), get_limiter("youtube.videos").slot():
+                response = youtube.videos().list(
+                    part='contentDetails,statistics,snippet',
+                    id=','.join(chunk)
+                ).execute()
             
             # Process response
             for item in response.get('items', []):
@@ -105,7 +185,9 @@ def get_video_transcript(video_id):
     try:
         # Get transcript from YouTube
         print(f"  Requesting transcript for video {video_id}...")
-        transcript_list = YouTubeTranscriptApi.get_transcript(video_id)
+        get_host_limiter("www.youtube.com").acquire()
+        with get_tracer().span("youtube.transcript"), get_limiter("youtube.transcript").slot():
+            transcript_list = YouTubeTranscriptApi.get_transcript(video_id)
         
         # Debug the response
         print(f"  Transcript type: {type(transcript_list)}")
@@ -143,13 +225,10 @@ def sanitize_filename(filename):
     
     return filename
 
-def extract_knowledge_with_claude(transcript, api_key):
-    """Process transcript with Claude to extract specific knowledge and tips."""
-    if not transcript or not api_key:
-        return None
-    
-    # Prepare the request to Claude
-    url = "https://api.anthropic.com/v1/messages"
+CLAUDE_API_URL = f"{get_anthropic_base_url()}/v1/messages"
+
+def build_knowledge_request(transcript, api_key):
+    """Build the headers and payload for a knowledge extraction request."""
     headers = {
         "Content-Type": "application/json",
         "x-api-key": api_key,
@@ -171,44 +250,313 @@ def extract_knowledge_with_claude(transcript, api_key):
         ]
     }
     
+    return headers, payload
+
+def parse_claude_response(result):
+    """Extract the text content from a Claude API response."""
+    content = result.get("content", [])
+    if isinstance(content, list) and len(content) > 0:
+        # Handle the Claude API response format
+        text_blocks = [block.get("text", "") for block in content if block.get("type") == "text"]
+        return "\n".join(text_blocks)
+    return "No text content found in response"
+
+def extract_knowledge_with_claude(transcript, api_key):
+    """Process transcript with Claude to extract specific knowledge and tips."""
+    if not transcript or not api_key:
+        return None
+    
+    # Prepare the request to Claude
+    url = CLAUDE_API_URL
+    headers, payload = build_knowledge_request(transcript, api_key)
+    
+    # Reuse the response of an identical earlier request
+    cache = get_response_cache()
+    cache_key = make_cache_key("anthropic-messages", payload)
+    cached = cache.get_json(cache_key)
+    if cached is not None:
+        print("  ✓ Using cached Claude response")
+        return parse_claude_response(cached)
+    
     # Make the API request with retry logic
-    max_retries = 3
-    retry_delay = 5  # seconds
+    response = request_with_retries("POST", url, "anthropic.messages", "Claude API request",
+                                    headers=headers, json=payload)
+    if response is None or response.status_code != 200:
+        return None
     
-    for attempt in range(max_retries):
-        try:
-            print(f"  Making Claude API request (attempt {attempt+1}/{max_retries})...")
-            response = requests.post(url, headers=headers, json=payload, timeout=60)
-            
-            if response.status_code == 200:
-                result = response.json()
-                # Extract the text content from the response
-                content = result.get("content", [])
-                if isinstance(content, list) and len(content) > 0:
-                    # Handle the Claude API response format
-                    text_blocks = [block.get("text", "") for block in content if block.get("type") == "text"]
-                    return "\n".join(text_blocks)
-                return "No text content found in response"
-            else:
-                print(f"  ✗ Claude API request failed: {response.status_code} - {response.text}")
-                if attempt < max_retries - 1:
-                    print(f"  Retrying in {retry_delay} seconds...")
-                    sleep(retry_delay)
-                    retry_delay *= 2  # Exponential backoff
-                else:
-                    return None
-        except Exception as e:
-            print(f"  ✗ Error during Claude API request: {str(e)}")
-            if attempt < max_retries - 1:
-                print(f"  Retrying in {retry_delay} seconds...")
-                sleep(retry_delay)
-                retry_delay *= 2
-            else:
-                return None
+    result = response.json()
+    cache.put_json(cache_key, result)
+    return parse_claude_response(result)
+
+class TokenBucket:
+    """Async token-bucket rate limiter shared by all in-flight requests; a rate of 0 means no limit."""
+    
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1, rate_per_minute // 10)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+    
+    def pause(self, seconds):
+        """Stop handing out tokens for the given number of seconds (e.g. after a 429)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+    
+    async def acquire(self):
+        """Wait until a request may be sent."""
+        started = time.monotonic()
+        waited = False
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    waited = True
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                
+                if self.rate <= 0:
+                    return
+                
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    if waited:
+                        get_tracer().event("sleep", "rate_limit.token_bucket", duration=now - started)
+                    return
+                waited = True
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+async def extract_knowledge_async(transcript, api_key, bucket, label="", max_retries=3):
+    """Async variant of extract_knowledge_with_claude that waits on the shared rate limiter."""
+    if not transcript or not api_key:
+        return None
+    
+    headers, payload = build_knowledge_request(transcript, api_key)
+    
+    cache = get_response_cache()
+    cache_key = make_cache_key("anthropic-messages", payload)
+    cached = cache.get_json(cache_key)
+    if cached is not None:
+        print(f"  [{label}] ✓ Using cached Claude response")
+        return parse_claude_response(cached)
+    
+    # The shared retry loop runs in a worker thread and reaches the bucket through the event loop
+    loop = asyncio.get_running_loop()
+    
+    def acquire_token():
+        asyncio.run_coroutine_threadsafe(bucket.acquire(), loop).result()
     
-    return None
+    def pause_everyone(delay):
+        # Rate limited or overloaded: hold back every request, not just this one
+        loop.call_soon_threadsafe(bucket.pause, delay)
+    
+    response = await asyncio.to_thread(
+        request_with_retries, "POST", CLAUDE_API_URL, "anthropic.messages", "Claude API request",
+        max_retries=max_retries, base_delay=5, prefix=f"  [{label}] ",
+        before_attempt=acquire_token, on_throttle=pause_everyone, headers=headers, json=payload
+    )
+    if response is None or response.status_code != 200:
+        return None
+    
+    # Proactively stop everyone when a limit is exhausted
+    wait = get_rate_limit_delay(response)
+    if wait > 0:
+        bucket.pause(wait)
+    result = response.json()
+    cache.put_json(cache_key, result)
+    return parse_claude_response(result)
+
+def format_timestamp(seconds):
+    """Format seconds as h:mm:ss or m:ss."""
+    seconds = int(seconds)
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+def split_transcript_segments(segments, max_chars=CHUNK_MAX_CHARS):
+    """
+    Split timestamped transcript segments into chunks of at most max_chars characters.
+    
+    Chunks always end on a segment boundary. Returns a list of (start, end, text) tuples,
+    where the text is joined the same way as the saved .txt transcript.
+    """
+    chunks = []
+    current = []
+    current_chars = 0
+    for segment in segments:
+        text = segment.get('text', '')
+        if current and current_chars + len(text) + 1 > max_chars:
+            chunks.append(current)
+            current = []
+            current_chars = 0
+        current.append(segment)
+        current_chars += len(text) + 1
+    if current:
+        chunks.append(current)
+    
+    return [
+        (
+            chunk[0].get('start', 0),
+            chunk[-1].get('start', 0) + chunk[-1].get('duration', 0),
+            "\n".join(segment.get('text', '') for segment in chunk)
+        )
+        for chunk in chunks
+    ]
+
+def format_chunk_transcript(index, count, start, end, text):
+    """Prefix a transcript chunk with its position and time range, so Claude knows it is a part."""
+    return f"[Transcript part {index+1}/{count}, {format_timestamp(start)} - {format_timestamp(end)}]\n{text}"
+
+def normalize_knowledge_line(line):
+    """Reduce a knowledge line to the form used to detect duplicates."""
+    line = re.sub(r"^\s*(?:[-*•]|\d+[.)])\s+", "", line)
+    return " ".join(re.sub(r"[^\w\s]", " ", line.lower()).split())
+
+def merge_chunk_knowledge(chunk_results):
+    """
+    Merge the knowledge extracted from transcript chunks into one document.
+    
+    Each chunk keeps its own section, headed by its time range, and list items that already
+    appeared in an earlier chunk are dropped.
+    """
+    seen = set()
+    sections = []
+    for start, end, knowledge in chunk_results:
+        lines = []
+        for line in knowledge.splitlines():
+            if re.match(r"^\s*(?:[-*•]|\d+[.)])\s+", line):
+                key = normalize_knowledge_line(line)
+                if key in seen:
+                    continue
+                seen.add(key)
+            lines.append(line)
+        sections.append(f"## Part {format_timestamp(start)} - {format_timestamp(end)}\n\n" + "\n".join(lines).strip())
+    return "\n\n".join(sections)
+
+async def extract_transcript_knowledge(transcript_text, segments, api_key, bucket, semaphore, label="",
+                                       chunk_chars=0):
+    """
+    Extract knowledge from one transcript, in chunks when it is longer than chunk_chars.
+    
+    Chunks are extracted concurrently (each holding the semaphore only for its own request)
+    and merged with merge_chunk_knowledge, so a long video takes about as long as its slowest
+    chunk. Returns None if any chunk fails; the successful chunks stay in the response cache.
+    """
+    chunks = split_transcript_segments(segments, chunk_chars) if chunk_chars and segments else []
+    if len(chunks) <= 1:
+        async with semaphore:
+            return await extract_knowledge_async(transcript_text, api_key, bucket, label=label)
+    
+    print(f"  [{label}] Extracting knowledge from {len(chunks)} chunks...")
+    
+    async def run_chunk(j, start, end, text):
+        chunk_transcript = format_chunk_transcript(j, len(chunks), start, end, text)
+        async with semaphore:
+            return await extract_knowledge_async(chunk_transcript, api_key, bucket, label=f"{label} part {j+1}")
+    
+    results = await asyncio.gather(*(run_chunk(j, *chunk) for j, chunk in enumerate(chunks)))
+    if not all(results):
+        return None
+    return merge_chunk_knowledge([(start, end, knowledge) for (start, end, _), knowledge in zip(chunks, results)])
+
+async def extract_knowledge_concurrently(jobs, api_key, concurrency=4, requests_per_minute=50, chunk_chars=0):
+    """
+    Run knowledge extraction for (label, transcript_text, knowledge_path, segments) jobs concurrently.
+    
+    At most `concurrency` requests are in flight, and all of them draw from one token bucket
+    so the request rate stays within `requests_per_minute`. With chunk_chars set, transcripts
+    with timestamped segments are extracted in chunks. Returns the number of successes.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    bucket = TokenBucket(requests_per_minute)
+    
+    async def run(label, transcript_text, knowledge_path, segments):
+        knowledge = await extract_transcript_knowledge(
+            transcript_text, segments, api_key, bucket, semaphore, label=label, chunk_chars=chunk_chars
+        )
+        
+        if not knowledge:
+            print(f"  [{label}] ✗ Failed to extract knowledge")
+            return False
+        
+        with open(knowledge_path, 'w', encoding='utf-8') as f:
+            f.write(knowledge)
+        print(f"  [{label}] ✓ Saved extracted knowledge to {knowledge_path}")
+        return True
+    
+    results = await asyncio.gather(*(run(*job) for job in jobs), return_exceptions=True)
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            print(f"  [{job[0]}] ✗ Error processing transcript: {str(result)}")
+    return sum(1 for result in results if result is True)
 
-def process_existing_transcripts(folder_path, api_key=None):
+def extract_knowledge_with_batch_api(jobs, api_key, submission_path, poll_interval=30, chunk_chars=0):
+    """
+    Extract knowledge for (label, transcript_text, knowledge_path, segments) jobs through the Message Batches API.
+    
+    Every job becomes one request in a single submission file, or one request per chunk when
+    chunk_chars is set and the transcript is longer, merged with merge_chunk_knowledge as in
+    interactive mode. The results are written to the same _knowledge.txt files the interactive
+    mode produces. Returns the number of successes.
+    """
+    cache = get_response_cache()
+    batch_requests = []
+    parts_by_job = []
+    successful = 0
+    
+    for label, transcript_text, knowledge_path, segments in jobs:
+        chunks = split_transcript_segments(segments, chunk_chars) if chunk_chars and segments else []
+        if len(chunks) <= 1:
+            chunks = [(None, None, transcript_text)]
+        
+        parts = []
+        for j, (chunk_start, chunk_end, text) in enumerate(chunks):
+            if len(chunks) > 1:
+                text = format_chunk_transcript(j, len(chunks), chunk_start, chunk_end, text)
+            _, payload = build_knowledge_request(text, api_key)
+            cache_key = make_cache_key("anthropic-messages", payload)
+            custom_id = make_custom_id("transcript", os.path.abspath(knowledge_path), *([j] if len(chunks) > 1 else []))
+            
+            # Answer from the response cache where possible instead of paying for a batch request
+            cached = cache.get_json(cache_key)
+            if cached is None:
+                batch_requests.append({"custom_id": custom_id, "params": payload})
+            parts.append((chunk_start, chunk_end, custom_id, cache_key, cached))
+        parts_by_job.append((label, knowledge_path, parts))
+    
+    results = {}
+    if batch_requests:
+        results = run_batch(batch_requests, api_key, submission_path, poll_interval=poll_interval)
+    
+    for label, knowledge_path, parts in parts_by_job:
+        messages = [cached or results.get(custom_id) for _, _, custom_id, _, cached in parts]
+        
+        # Successful chunks stay in the response cache even if another chunk failed
+        for (_, _, _, cache_key, cached), message in zip(parts, messages):
+            if cached is None and message:
+                cache.put_json(cache_key, message)
+        
+        if not all(messages):
+            print(f"  [{label}] ✗ Failed to extract knowledge")
+            continue
+        
+        if len(parts) == 1:
+            knowledge = parse_claude_response(messages[0])
+        else:
+            knowledge = merge_chunk_knowledge([(chunk_start, chunk_end, parse_claude_response(message))
+                                               for (chunk_start, chunk_end, _, _, _), message in zip(parts, messages)])
+        with open(knowledge_path, 'w', encoding='utf-8') as f:
+            f.write(knowledge)
+        print(f"  [{label}] ✓ Saved extracted knowledge to {knowledge_path}")
+        successful += 1
+    
+    return successful
+
+def process_existing_transcripts(folder_path, api_key=None, concurrency=4, requests_per_minute=50,
+                                 batch=False, poll_interval=30, chunk_chars=0):
     """Process existing transcripts in a folder with Claude to extract knowledge."""
     if not api_key:
         api_key = os.getenv("ANTHROPIC_API_KEY")
@@ -235,12 +583,11 @@ def process_existing_transcripts(folder_path, api_key=None):
     
     print(f"Found {len(transcript_files)} transcript files to process")
     
-    # Process each transcript
+    # Collect the transcripts that still need extraction
     successful_extractions = 0
+    jobs = []
     
     for i, transcript_file in enumerate(transcript_files):
-        print(f"Processing transcript {i+1}/{len(transcript_files)}: {transcript_file}")
-        
         # Check if knowledge file already exists
         knowledge_filename = transcript_file.replace('.txt', '_knowledge.txt')
         knowledge_path = os.path.join(knowledge_dir, knowledge_filename)
@@ -256,35 +603,200 @@ def process_existing_transcripts(folder_path, api_key=None):
             with open(transcript_path, 'r', encoding='utf-8') as f:
                 transcript_text = f.read()
             
-            # Extract knowledge using Claude
-            print(f"  Extracting knowledge with Claude...")
-            knowledge = extract_knowledge_with_claude(transcript_text, api_key)
-            
-            if knowledge:
-                # Save extracted knowledge
-                with open(knowledge_path, 'w', encoding='utf-8') as f:
-                    f.write(knowledge)
-                
-                successful_extractions += 1
-                print(f"  ✓ Saved extracted knowledge to {knowledge_path}")
-            else:
-                print(f"  ✗ Failed to extract knowledge")
-        
+            # Chunked extraction splits at the timestamps saved next to the text
+            segments = None
+            segments_path = transcript_path[:-len('.txt')] + '.json'
+            if chunk_chars and os.path.exists(segments_path):
+                with open(segments_path, 'r', encoding='utf-8') as f:
+                    segments = json.load(f)
+            jobs.append((f"{i+1}/{len(transcript_files)}", transcript_text, knowledge_path, segments))
         except Exception as e:
-            print(f"  ✗ Error processing transcript {transcript_file}: {str(e)}")
-        
-        # Avoid rate limiting
-        if i < len(transcript_files) - 1:
-            print("  Waiting before processing next transcript...")
-            time.sleep(2)
+            print(f"  ✗ Error reading transcript {transcript_file}: {str(e)}")
+    
+    if jobs and batch:
+        print(f"Extracting knowledge from {len(jobs)} transcripts with the Message Batches API...")
+        submission_path = os.path.join(folder_path, 'batches', 'knowledge_batch.jsonl')
+        successful_extractions += extract_knowledge_with_batch_api(jobs, api_key, submission_path, poll_interval,
+                                                                   chunk_chars)
+    elif jobs:
+        print(f"Extracting knowledge from {len(jobs)} transcripts "
+              f"({concurrency} in flight, {requests_per_minute} requests/minute)...")
+        successful_extractions += asyncio.run(
+            extract_knowledge_concurrently(jobs, api_key, concurrency, requests_per_minute, chunk_chars)
+        )
     
     print(f"\nKnowledge extraction complete!")
     print(f"Successfully extracted knowledge from {successful_extractions}/{len(transcript_files)} transcripts")
     print(f"All data saved to {knowledge_dir}")
+    print_cache_stats()
     return True
 
-def prepare_knowledge(output_folder, queries, max_results_per_query=10):
-    """Main function to prepare knowledge from YouTube videos."""
+def load_json_file(path, default):
+    """Load a JSON state file, returning the default if it is missing or unreadable."""
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error loading {path}: {str(e)}")
+        return default
+
+def save_json_file(data, path):
+    """Atomically write a JSON state file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+def search_youtube_videos_cached(youtube, query, max_results, search_cache, ttl_hours=24):
+    """Return search results from the cache while they are younger than the TTL, otherwise search again."""
+    cache_key = f"{query}|{max_results}"
+    entry = search_cache.get(cache_key)
+    if entry and time.time() - entry["fetchedAt"] < ttl_hours * 3600:
+        print(f"Using cached search results for: '{query}' ({len(entry['videos'])} videos)")
+        return entry["videos"]
+    
+    videos = search_youtube_videos(youtube, query, max_results=max_results)
+    if videos:
+        search_cache[cache_key] = {"fetchedAt": time.time(), "videos": videos}
+    return videos
+
+def hash_transcript(text):
+    """Return the content hash used to detect changed transcripts."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def seed_video_index(transcripts_dir, knowledge_dir):
+    """
+    Build a video index from the transcripts already on disk, so the first delta run on a
+    knowledge folder from before the index existed does not download everything again.
+    """
+    video_index = {}
+    for transcript_file in sorted(os.listdir(transcripts_dir)):
+        filename_base, extension = os.path.splitext(transcript_file)
+        if extension != '.txt' or filename_base[YOUTUBE_ID_LENGTH:YOUTUBE_ID_LENGTH + 1] != '_':
+            continue
+        transcript_path = os.path.join(transcripts_dir, transcript_file)
+        with open(transcript_path, 'r', encoding='utf-8') as f:
+            entry = {
+                "filenameBase": filename_base,
+                "transcriptHash": hash_transcript(f.read()),
+                "processedAt": datetime.fromtimestamp(os.path.getmtime(transcript_path), timezone.utc).isoformat()
+            }
+        knowledge_file = f"{filename_base}_knowledge.txt"
+        if os.path.exists(os.path.join(knowledge_dir, knowledge_file)):
+            entry["knowledgeFile"] = knowledge_file
+        video_index[filename_base[:YOUTUBE_ID_LENGTH]] = entry
+    return video_index
+
+def save_video_transcript(video, transcripts_dir):
+    """
+    Download and save the transcript of a video, or read it if an earlier run saved it.
+    Returns (filename_base, text, segments) or None.
+    """
+    # Create sanitized filename
+    filename_base = sanitize_filename(f"{video['id']}_{video['title']}")
+    text_path = os.path.join(transcripts_dir, f"{filename_base}.txt")
+    json_path = os.path.join(transcripts_dir, f"{filename_base}.json")
+    
+    if os.path.exists(text_path):
+        with open(text_path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        segments = None
+        if os.path.exists(json_path):
+            with open(json_path, 'r', encoding='utf-8') as f:
+                segments = json.load(f)
+        print(f"  ✓ Transcript already downloaded: {text_path}")
+        return filename_base, text, segments
+    
+    transcript = get_video_transcript(video['id'])
+    if not transcript:
+        print(f"  ✗ No transcript available for {video['title']}")
+        return None
+    
+    # Save transcript text
+    with open(text_path, 'w', encoding='utf-8') as f:
+        f.write(transcript['text'])
+    
+    # Save transcript with timestamps
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(transcript['segments'], f, indent=2)
+    
+    print(f"  ✓ Saved transcript to {text_path}")
+    return filename_base, transcript['text'], transcript['segments']
+
+async def download_and_extract_transcripts(videos, transcripts_dir, knowledge_dir, api_key=None, download_workers=8,
+                                           concurrency=4, requests_per_minute=50, video_index=None, chunk_chars=0):
+    """
+    Download the transcripts of all videos and extract knowledge from each as soon as it arrives.
+    
+    Downloads run in a bounded thread pool paced by the per-host limiter, and extraction of
+    finished transcripts overlaps with the remaining downloads. When a video_index is given,
+    it is updated with each transcript's content hash, and transcripts whose hash is unchanged
+    keep their existing knowledge file. Returns the number of saved transcripts and the
+    number of videos with extracted knowledge.
+    """
+    video_index = video_index if video_index is not None else {}
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    bucket = TokenBucket(requests_per_minute)
+    
+    async def run(i, video):
+        label = f"{i+1}/{len(videos)}"
+        saved = await loop.run_in_executor(executor, save_video_transcript, video, transcripts_dir)
+        if not saved:
+            return False, False
+        
+        filename_base, transcript_text, segments = saved
+        knowledge_file = f"{filename_base}_knowledge.txt"
+        knowledge_path = os.path.join(knowledge_dir, knowledge_file)
+        transcript_hash = hash_transcript(transcript_text)
+        previous = video_index.get(video['id'], {})
+        video_index[video['id']] = {
+            "filenameBase": filename_base,
+            "transcriptHash": transcript_hash,
+            "processedAt": datetime.now(timezone.utc).isoformat()
+        }
+        if not api_key:
+            return True, False
+        
+        # Knowledge only depends on the transcript, so unchanged transcripts keep their knowledge
+        if previous.get("transcriptHash") == transcript_hash and os.path.exists(knowledge_path):
+            print(f"  [{label}] ✓ Transcript unchanged, keeping {knowledge_path}")
+            video_index[video['id']]["knowledgeFile"] = knowledge_file
+            return True, True
+        
+        knowledge = await extract_transcript_knowledge(
+            transcript_text, segments, api_key, bucket, semaphore, label=label, chunk_chars=chunk_chars
+        )
+        if not knowledge:
+            print(f"  [{label}] ✗ Failed to extract knowledge")
+            return True, False
+        
+        with open(knowledge_path, 'w', encoding='utf-8') as f:
+            f.write(knowledge)
+        video_index[video['id']]["knowledgeFile"] = knowledge_file
+        print(f"  [{label}] ✓ Saved extracted knowledge to {knowledge_path}")
+        return True, True
+    
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        results = await asyncio.gather(*(run(i, video) for i, video in enumerate(videos)), return_exceptions=True)
+    
+    for video, result in zip(videos, results):
+        if isinstance(result, Exception):
+            print(f"  ✗ Error processing video {video['id']}: {str(result)}")
+    results = [result for result in results if not isinstance(result, Exception)]
+    return sum(1 for saved, _ in results if saved), sum(1 for _, extracted in results if extracted)
+
+def prepare_knowledge(output_folder, queries, max_results_per_query=10, download_workers=8, concurrency=4,
+                      requests_per_minute=50, delta=False, search_ttl_hours=24, chunk_chars=0):
+    """
+    Main function to prepare knowledge from YouTube videos.
+    
+    Search results are cached for search_ttl_hours, and every processed video is recorded in
+    metadata/video_index.json with the hash of its transcript. With delta=True only videos
+    missing from that index are fetched and extracted, so a refresh costs only the new content.
+    """
     # Set up YouTube API
     youtube = setup_youtube_api()
     
@@ -302,14 +814,23 @@ def prepare_knowledge(output_folder, queries, max_results_per_query=10):
     os.makedirs(metadata_dir, exist_ok=True)
     os.makedirs(knowledge_dir, exist_ok=True)  # Create knowledge directory
     
+    # Persistent crawl state
+    index_path = os.path.join(metadata_dir, 'video_index.json')
+    search_cache_path = os.path.join(metadata_dir, 'search_cache.json')
+    metadata_path = os.path.join(metadata_dir, 'videos.json')
+    video_index = load_json_file(index_path, None)
+    if video_index is None:
+        video_index = seed_video_index(transcripts_dir, knowledge_dir)
+        if video_index:
+            print(f"Seeded the video index with {len(video_index)} transcripts already on disk")
+    search_cache = load_json_file(search_cache_path, {})
+    
     # Search for videos matching each query
     all_videos = []
     for query in queries:
-        videos = search_youtube_videos(youtube, query, max_results=max_results_per_query)
+        videos = search_youtube_videos_cached(youtube, query, max_results_per_query, search_cache, search_ttl_hours)
         all_videos.extend(videos)
-        
-        # Avoid rate limiting
-        time.sleep(1)
+    save_json_file(search_cache, search_cache_path)
     
     # Remove duplicates (same video ID)
     unique_videos = []
@@ -321,7 +842,17 @@ def prepare_knowledge(output_folder, queries, max_results_per_query=10):
     
     print(f"Found {len(unique_videos)} unique videos across all queries")
     
-    # Get additional details for all videos
+    # In delta mode, videos fully processed by an earlier run are left alone
+    if delta:
+        def is_processed(video_id):
+            entry = video_index.get(video_id)
+            return bool(entry) and (not anthropic_api_key or "knowledgeFile" in entry)
+        
+        new_videos = [video for video in unique_videos if not is_processed(video['id'])]
+        print(f"Delta mode: {len(new_videos)} new videos, {len(unique_videos) - len(new_videos)} already processed")
+        unique_videos = new_videos
+    
+    # Get additional details for the videos of this run
     video_ids = [video['id'] for video in unique_videos]
     video_details = get_video_details(youtube, video_ids)
     
@@ -331,70 +862,38 @@ def prepare_knowledge(output_folder, queries, max_results_per_query=10):
         if video_id in video_details:
             video.update(video_details[video_id])
     
-    # Save all video metadata
-    metadata_path = os.path.join(metadata_dir, 'videos.json')
-    with open(metadata_path, 'w', encoding='utf-8') as f:
-        json.dump(unique_videos, f, indent=2)
-    
-    print(f"Saved metadata for {len(unique_videos)} videos to {metadata_path}")
+    # Merge into the metadata of earlier runs instead of replacing it
+    known_videos = {video['id']: video for video in load_json_file(metadata_path, [])}
+    for video in unique_videos:
+        known_videos[video['id']] = video
+    save_json_file(list(known_videos.values()), metadata_path)
     
-    # Process each video to get transcript and extract knowledge
-    successful_transcripts = 0
-    successful_knowledge_extractions = 0
+    print(f"Saved metadata for {len(known_videos)} videos to {metadata_path}")
     
-    for i, video in enumerate(unique_videos):
-        video_id = video['id']
-        title = video['title']
-        
-        print(f"Processing video {i+1}/{len(unique_videos)}: {title}")
-        
-        # Get transcript
-        transcript = get_video_transcript(video_id)
-        
-        if transcript:
-            # Create sanitized filename
-            filename_base = sanitize_filename(f"{video_id}_{title}")
-            
-            # Save transcript text
-            text_path = os.path.join(transcripts_dir, f"{filename_base}.txt")
-            with open(text_path, 'w', encoding='utf-8') as f:
-                f.write(transcript['text'])
-            
-            # Save transcript with timestamps
-            json_path = os.path.join(transcripts_dir, f"{filename_base}.json")
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(transcript['segments'], f, indent=2)
-            
-            successful_transcripts += 1
-            print(f"  ✓ Saved transcript to {text_path}")
-            
-            # Extract knowledge using Claude if API key is available
-            if anthropic_api_key:
-                print(f"  Extracting knowledge with Claude...")
-                knowledge = extract_knowledge_with_claude(transcript['text'], anthropic_api_key)
-                
-                if knowledge:
-                    # Save extracted knowledge
-                    knowledge_path = os.path.join(knowledge_dir, f"{filename_base}_knowledge.txt")
-                    with open(knowledge_path, 'w', encoding='utf-8') as f:
-                        f.write(knowledge)
-                    
-                    successful_knowledge_extractions += 1
-                    print(f"  ✓ Saved extracted knowledge to {knowledge_path}")
-                else:
-                    print(f"  ✗ Failed to extract knowledge")
-            
-        else:
-            print(f"  ✗ No transcript available")
-        
-        # Avoid rate limiting
-        time.sleep(0.5)
+    # Download transcripts in a thread pool while Claude extraction runs as a separate stage
+    print(f"Downloading transcripts with {download_workers} workers"
+          + (f", extracting knowledge ({concurrency} in flight, {requests_per_minute} requests/minute)..."
+             if anthropic_api_key else "..."))
+    try:
+        successful_transcripts, successful_knowledge_extractions = asyncio.run(download_and_extract_transcripts(
+            unique_videos, transcripts_dir, knowledge_dir, anthropic_api_key,
+            download_workers, concurrency, requests_per_minute, video_index, chunk_chars
+        ))
+    finally:
+        # Keep the progress of an interrupted run
+        save_json_file(video_index, index_path)
+    
+    # Refresh the columnar store used for timestamp lookups
+    if successful_transcripts:
+        load_or_build_store(transcripts_dir)
     
     print(f"\nKnowledge preparation complete!")
     print(f"Found {len(unique_videos)} videos")
     print(f"Successfully downloaded {successful_transcripts} transcripts")
     print(f"Successfully extracted knowledge from {successful_knowledge_extractions} transcripts")
     print(f"All data saved to {output_folder}")
+    print_quota_usage()
+    print_cache_stats()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Prepare knowledge base from YouTube videos or process existing transcripts.")
@@ -407,24 +906,65 @@ if __name__ == "__main__":
     youtube_parser.add_argument("output_folder", help="Folder to save the knowledge base")
     youtube_parser.add_argument("queries", nargs='+', help="Search queries to find videos")
     youtube_parser.add_argument("--max-results", type=int, default=10, help="Maximum results per query (default: 10)")
+    youtube_parser.add_argument("--delta", action="store_true", help="Only fetch and extract videos that no earlier run processed")
+    youtube_parser.add_argument("--search-ttl-hours", type=float, default=24, help="Reuse cached search results younger than this (default: 24)")
+    youtube_parser.add_argument("--chunk-chars", type=int, nargs='?', const=CHUNK_MAX_CHARS, default=0,
+                                help=f"Extract transcripts longer than this many characters in timestamp-aligned chunks "
+                                     f"(default: off, {CHUNK_MAX_CHARS} if given without a value)")
+    youtube_parser.add_argument("--download-workers", type=int, default=8, help="Number of transcripts downloaded in parallel (default: 8)")
+    youtube_parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of Claude requests in flight (default: 4)")
+    youtube_parser.add_argument("--requests-per-minute", type=int, default=50, help="Rate limit for Claude requests, 0 for no limit (default: 50)")
+    youtube_parser.add_argument("--trace", nargs='?', const="", help="Write a JSONL trace of spans, requests and retries and print a summary (default path: traces/prepare_knowledge_<time>.jsonl)")
     
     # Parser for processing existing transcripts
     process_parser = subparsers.add_parser('process', help='Process existing transcripts with Claude')
     process_parser.add_argument("folder_path", help="Path to the folder containing transcripts")
+    process_parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of Claude requests in flight (default: 4)")
+    process_parser.add_argument("--requests-per-minute", type=int, default=50, help="Rate limit for Claude requests, 0 for no limit (default: 50)")
+    process_parser.add_argument("--chunk-chars", type=int, nargs='?', const=CHUNK_MAX_CHARS, default=0,
+                                help=f"Extract transcripts longer than this many characters in timestamp-aligned chunks "
+                                     f"(default: off, {CHUNK_MAX_CHARS} if given without a value)")
+    process_parser.add_argument("--batch", action="store_true", help="Submit all pending transcripts as one Message Batches API job")
+    process_parser.add_argument("--poll-interval", type=int, default=30, help="Seconds between batch status checks (default: 30)")
+    process_parser.add_argument("--trace", nargs='?', const="", help="Write a JSONL trace of spans, requests and retries and print a summary (default path: traces/prepare_knowledge_<time>.jsonl)")
     
     args = parser.parse_args()
     
+    if getattr(args, "trace", None) is not None:
+        configure_tracing(args.trace or default_trace_path(__file__))
+    
     # Handle different modes
     if args.mode == 'youtube':
         # Ensure the output folder exists
         os.makedirs(args.output_folder, exist_ok=True)
         
         # Run the knowledge preparation
-        prepare_knowledge(args.output_folder, args.queries, args.max_results)
+        with get_tracer().span("prepare_knowledge"):
+            prepare_knowledge(
+                args.output_folder,
+                args.queries,
+                args.max_results,
+                download_workers=args.download_workers,
+                concurrency=args.concurrency,
+                requests_per_minute=args.requests_per_minute,
+                delta=args.delta,
+                search_ttl_hours=args.search_ttl_hours,
+                chunk_chars=args.chunk_chars
+            )
+        print_trace_summary()
     
     elif args.mode == 'process':
         # Process existing transcripts
-        process_existing_transcripts(args.folder_path)
+        with get_tracer().span("process_existing_transcripts"):
+            process_existing_transcripts(
+                args.folder_path,
+                concurrency=args.concurrency,
+                requests_per_minute=args.requests_per_minute,
+                batch=args.batch,
+                poll_interval=args.poll_interval,
+                chunk_chars=args.chunk_chars
+            )
+        print_trace_summary()
     
     else:
         # If no mode specified, show help
@@ -3,16 +3,28 @@ import sys
 import json
 import argparse
 import subprocess
-import requests
-import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
+from response_cache import get_response_cache, make_cache_key, print_cache_stats
+from http_client import get_timeout, request_with_retries
+from tracing import configure_tracing, default_trace_path, get_tracer, print_trace_summary
+from segment_gating import DEFAULT_SCENE_THRESHOLD, extract_scene_frames, gate_segments
 
 # Load environment variables from .env file
 load_dotenv()
 
+# ELEVENLABS_BASE_URL points speech requests at a local stand-in server
+ELEVENLABS_BASE_URL = os.getenv("ELEVENLABS_BASE_URL", "https://api.elevenlabs.io").rstrip("/")
+
+# Whole-track transcription: length of each transcription request, and the extra audio
+# around each chunk so words that straddle a chunk boundary are not cut
+TRACK_CHUNK_SECONDS = 1800
+TRACK_CHUNK_OVERLAP = 5
+
 def get_video_duration(video_path, timeout=30):
-    """Get the duration of a video file using ffprobe with timeout."""
+    """Get the duration of a video file using ffprobe with timeout. Returns None on failure."""
     cmd = [
         'ffprobe', 
         '-v', 'error', 
@@ -23,24 +35,25 @@ def get_video_duration(video_path, timeout=30):
     
     try:
         print(f"Running FFprobe command: {' '.join(cmd)}")
-        result = subprocess.run(
-            cmd, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE, 
-            text=True,
-            timeout=timeout  # Add timeout
-        )
+        with get_tracer().span("ffprobe.duration"):
+            result = subprocess.run(
+                cmd, 
+                stdout=subprocess.PIPE, 
+                stderr=subprocess.PIPE, 
+                text=True,
+                timeout=timeout  # Add timeout
+            )
         
         if result.returncode != 0:
             print(f"Error getting video duration: {result.stderr}")
-            sys.exit(1)
+            return None
         return float(result.stdout.strip())
     except subprocess.TimeoutExpired:
         print(f"FFprobe timed out after {timeout} seconds")
-        sys.exit(1)
+        return None
     except Exception as e:
         print(f"Exception during video duration check: {str(e)}")
-        sys.exit(1)
+        return None
 
 def create_output_directory(video_path, base_dir="website/videos"):
     """Create output directory for the processed video."""
@@ -64,12 +77,13 @@ def extract_frame(video_path, output_path, time_position, timeout=30):
     try:
         # Use subprocess with timeout
         print(f"  Running FFmpeg command: {' '.join(cmd)}")
-        result = subprocess.run(
-            cmd, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE,
-            timeout=timeout  # Add timeout
-        )
+        with get_tracer().span("ffmpeg.extract_frame"):
+            result = subprocess.run(
+                cmd, 
+                stdout=subprocess.PIPE, 
+                stderr=subprocess.PIPE,
+                timeout=timeout  # Add timeout
+            )
         
         if result.returncode != 0:
             print(f"  ✗ Error extracting frame at {time_position}s: {result.stderr.decode()}")
@@ -98,12 +112,13 @@ def extract_audio_segment(video_path, output_path, start_time, duration=30, time
     try:
         # Use subprocess with timeout
         print(f"  Running FFmpeg command: {' '.join(cmd)}")
-        result = subprocess.run(
-            cmd, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE,
-            timeout=timeout  # Add timeout
-        )
+        with get_tracer().span("ffmpeg.extract_audio"):
+            result = subprocess.run(
+                cmd, 
+                stdout=subprocess.PIPE, 
+                stderr=subprocess.PIPE,
+                timeout=timeout  # Add timeout
+            )
         
         if result.returncode != 0:
             print(f"  ✗ Error extracting audio at {start_time}s: {result.stderr.decode()}")
@@ -116,28 +131,123 @@ def extract_audio_segment(video_path, output_path, start_time, duration=30, time
         print(f"  ✗ Exception during audio extraction: {str(e)}")
         return False
 
+def get_contiguous_runs(numbers):
+    """Split sorted segment numbers into (start, end) runs of consecutive numbers, end exclusive."""
+    runs = []
+    for number in numbers:
+        if runs and runs[-1][1] == number:
+            runs[-1][1] = number + 1
+        else:
+            runs.append([number, number + 1])
+    return [tuple(run) for run in runs]
+
+def extract_segments_batch(video_path, output_dir, start_segment, end_segment, segment_duration=30, timeout=None):
+    """
+    Extract the frames and audio segments for a range of segments in a single FFmpeg pass.
+
+    The input is decoded once: a select filter keeps the first frame of every segment
+    (written as frame_{i}.jpg) and the segment muxer splits the audio into audio_{i}.mp3,
+    so the outputs match what extract_frame and extract_audio_segment produce per segment.
+    """
+    start_time = start_segment * segment_duration
+    span = (end_segment - start_segment) * segment_duration
+    if span <= 0:
+        return True
+
+    # Decoding is much faster than realtime, so the span length is a generous upper bound
+    if timeout is None:
+        timeout = max(300, span)
+
+    # Keep the first frame whose timestamp falls into a new segment window
+    select_filter = (
+        f"select='isnan(prev_selected_t)"
+        f"+gte(floor(t/{segment_duration})-floor(prev_selected_t/{segment_duration})\\,1)'"
+    )
+
+    # Write into a staging directory first: the segment muxer can emit a short trailing
+    # segment past the requested range, which must not overwrite an existing segment
+    with tempfile.TemporaryDirectory(dir=output_dir, prefix=".batch_") as staging_dir:
+        cmd = [
+            'ffmpeg',
+            '-ss', str(start_time),
+            '-t', str(span),
+            '-i', video_path,
+            # Frames: one JPEG per segment window
+            '-map', '0:v:0?',
+            '-vf', select_filter,
+            '-vsync', 'vfr',
+            '-q:v', '2',
+            '-start_number', str(start_segment),
+            '-y',
+            os.path.join(staging_dir, "frame_%d.jpg"),
+            # Audio: one MP3 per segment window
+            '-map', '0:a:0?',
+            '-q:a', '0',
+            '-f', 'segment',
+            '-segment_time', str(segment_duration),
+            '-segment_start_number', str(start_segment),
+            '-reset_timestamps', '1',
+            '-y',
+            os.path.join(staging_dir, "audio_%d.mp3")
+        ]
+
+        try:
+            print(f"Running FFmpeg command: {' '.join(cmd)}")
+            with get_tracer().span("ffmpeg.extract_batch"):
+                result = subprocess.run(
+                    cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    timeout=timeout
+                )
+
+            if result.returncode != 0:
+                print(f"✗ Error extracting segments {start_segment}-{end_segment-1}: {result.stderr.decode()}")
+                return False
+        except subprocess.TimeoutExpired:
+            print(f"✗ FFmpeg batch extraction timed out after {timeout} seconds")
+            return False
+        except Exception as e:
+            print(f"✗ Exception during batch extraction: {str(e)}")
+            return False
+
+        # Move the outputs for the requested range into place
+        for i in range(start_segment, end_segment):
+            for name in (f"frame_{i}.jpg", f"audio_{i}.mp3"):
+                staged_path = os.path.join(staging_dir, name)
+                if os.path.exists(staged_path):
+                    os.replace(staged_path, os.path.join(output_dir, name))
+    
+    return True
+
 def transcribe_audio(audio_path, language="en", timeout_seconds=60):
-    """Transcribe audio using ElevenLabs API with timeout protection."""
+    """Transcribe audio using ElevenLabs API with timeout protection. Returns the transcript text."""
+    result = request_transcription(audio_path, language, timeout_seconds)
+    if result is None:
+        return None
+    return result.get("text", "")
+
+def request_transcription(audio_path, language="en", timeout_seconds=60):
+    """Transcribe audio using ElevenLabs API and return the full response, including word timings."""
     api_key = os.getenv("ELEVENLABS_API_KEY")
     if not api_key:
         print("Warning: ELEVENLABS_API_KEY not found in environment variables. Skipping transcription.")
         return None
     
-    # Platform-independent timeout handling
-    file_handle = None
     try:
-        print(f"  Opening audio file: {audio_path}")
-        file_handle = open(audio_path, 'rb')
+        print(f"  Reading audio file: {audio_path}")
+        with open(audio_path, 'rb') as f:
+            audio_bytes = f.read()
         
         # Prepare request with multipart form data
-        url = "https://api.elevenlabs.io/v1/speech-to-text"
+        url = f"{ELEVENLABS_BASE_URL}/v1/speech-to-text"
         headers = {
             "xi-api-key": api_key
         }
         
-        # Create multipart form data
+        # The audio is sent from memory, so a retry uploads it again from the start
         files = {
-            'file': (os.path.basename(audio_path), file_handle, 'audio/mpeg')
+            'file': (os.path.basename(audio_path), audio_bytes, 'audio/mpeg')
         }
         
         data = {
@@ -147,65 +257,254 @@ def transcribe_audio(audio_path, language="en", timeout_seconds=60):
             'timestamps_granularity': 'word'
         }
         
+        # Reuse the transcription of identical audio
+        cache = get_response_cache()
+        cache_key = make_cache_key("elevenlabs-stt", data, blobs=[audio_bytes])
+        cached = cache.get_json(cache_key)
+        if cached is not None:
+            print("  ✓ Using cached transcription")
+            return cached
+        
         # Make API request with retry logic
-        max_retries = 3
-        retry_delay = 2  # seconds
+        timeout = (get_timeout("elevenlabs.stt")[0], timeout_seconds) if timeout_seconds else None
+        response = request_with_retries("POST", url, "elevenlabs.stt", "transcription request",
+                                        headers=headers, files=files, data=data, timeout=timeout)
+        if response is None or response.status_code != 200:
+            return None
         
-        for attempt in range(max_retries):
-            try:
-                print(f"  Transcribing audio... (attempt {attempt+1}/{max_retries})")
-                
-                # Use a shorter timeout for the request itself
-                response = requests.post(
-                    url, 
-                    headers=headers, 
-                    files=files, 
-                    data=data, 
-                    timeout=timeout_seconds  # Use the full timeout for the request
-                )
-                
-                print(f"  Received response with status code: {response.status_code}")
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    return result.get("text", "")
-                else:
-                    print(f"  ✗ Transcription failed: {response.status_code} - {response.text}")
-                    if attempt < max_retries - 1:
-                        print(f"  Retrying in {retry_delay} seconds...")
-                        time.sleep(retry_delay)
-                        retry_delay *= 2  # Exponential backoff
-                    else:
-                        return None
-            except requests.exceptions.RequestException as e:
-                print(f"  ✗ Connection error during transcription: {str(e)}")
-                if attempt < max_retries - 1:
-                    print(f"  Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # Exponential backoff
-                else:
-                    return None
+        result = response.json()
+        cache.put_json(cache_key, result)
+        return result
     except Exception as e:
         print(f"  ✗ Error during transcription: {str(e)}")
         return None
-    finally:
-        # Close the file handle if it was opened
-        if file_handle is not None:
-            try:
-                file_handle.close()
-                print("  File handle closed")
-            except:
-                pass
+
+def transcribe_track(video_path, output_dir, ranges, language="en",
+                     chunk_duration=TRACK_CHUNK_SECONDS, workers=4):
+    """
+    Transcribe the audio track within the (start_time, end_time) ranges in a few large requests.
+    
+    Each range is cut into chunks of chunk_duration seconds, each extracted with a little
+    overlap so that words spanning a chunk boundary are complete in the earlier chunk.
+    Word timings are shifted to video time, saved to words.json and returned as a list of
+    {"text", "start", "end", "type"} entries (None if any chunk failed).
+    """
+    words_path = os.path.join(output_dir, "words.json")
+    if os.path.exists(words_path):
+        try:
+            with open(words_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            # Files from before ranges were tracked cover a single range
+            saved_ranges = saved.get("ranges") or [[saved["startTime"], saved["endTime"]]]
+            if saved.get("language") == language and all(
+                    any(s <= start and e >= end for s, e in saved_ranges) for start, end in ranges):
+                print(f"Using word timings from {words_path}")
+                return saved["words"]
+        except Exception as e:
+            print(f"Error loading word timings: {str(e)}")
+    
+    chunks = []
+    for start_time, end_time in ranges:
+        boundaries = list(range(int(start_time), int(end_time), int(chunk_duration))) + [end_time]
+        chunks.extend(zip(boundaries[:-1], boundaries[1:]))
+    print(f"Transcribing {sum(end - start for start, end in ranges):.0f}s of audio in {len(chunks)} requests...")
+    
+    def transcribe_chunk(chunk):
+        chunk_start, chunk_end = chunk
+        extract_start = max(0, chunk_start - TRACK_CHUNK_OVERLAP)
+        extract_end = chunk_end + TRACK_CHUNK_OVERLAP
+        chunk_path = os.path.join(temp_dir, f"track_{chunk_start}.mp3")
+        if not extract_audio_segment(video_path, chunk_path, extract_start, extract_end - extract_start,
+                                     timeout=max(30, int(chunk_duration))):
+            return None
+        result = request_transcription(chunk_path, language, timeout_seconds=max(60, int(chunk_duration)))
+        if result is None:
+            return None
+        
+        # Each chunk owns the words that start inside it
+        words = []
+        for word in result.get("words", []):
+            word = dict(word)
+            word["start"] = round(word.get("start", 0) + extract_start, 3)
+            word["end"] = round(word.get("end", 0) + extract_start, 3)
+            if chunk_start <= word["start"] < chunk_end:
+                words.append(word)
+        return words
+    
+    with tempfile.TemporaryDirectory(dir=output_dir, prefix=".track_") as temp_dir:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks)))) as executor:
+            results = list(executor.map(transcribe_chunk, chunks))
+    
+    if any(result is None for result in results):
+        print("✗ Track transcription failed")
+        return None
+    
+    words = [word for result in results for word in result]
+    with open(words_path, 'w', encoding='utf-8') as f:
+        json.dump({"language": language, "ranges": [list(r) for r in ranges], "words": words}, f)
+    print(f"✓ Transcribed {sum(1 for w in words if w.get('type') == 'word')} words, timings saved to {words_path}")
+    return words
+
+def slice_transcript(words, start_time, end_time):
+    """Return the transcript of the words that start within [start_time, end_time)."""
+    return "".join(w.get("text", "") for w in words if start_time <= w["start"] < end_time).strip()
+
+def process_segment(video_path, output_dir, i, segment_duration=30, language="en",
+                    skip_transcription=False, batch_extracted=False, track_words=None):
+    """
+    Extract and transcribe a single segment. Returns the segment info, or None on failure.
+    
+    With track_words (from transcribe_track) the transcript is sliced from the word timings
+    instead of uploading the segment audio.
+    """
+    start_time = i * segment_duration
+    
+    try:
+        # Extract frame
+        print(f"  Extracting frame at {start_time}s...")
+        frame_path = os.path.join(output_dir, f"frame_{i}.jpg")
+        if batch_extracted:
+            frame_success = os.path.exists(frame_path) and os.path.getsize(frame_path) > 0
+        else:
+            frame_success = extract_frame(video_path, frame_path, start_time)
+        if frame_success:
+            print(f"  ✓ Extracted frame to {frame_path}")
+        else:
+            print(f"  ✗ Failed to extract frame")
+        
+        # Extract audio
+        print(f"  Extracting audio segment at {start_time}s...")
+        audio_path = os.path.join(output_dir, f"audio_{i}.mp3")
+        if batch_extracted:
+            audio_success = os.path.exists(audio_path) and os.path.getsize(audio_path) > 0
+        else:
+            audio_success = extract_audio_segment(video_path, audio_path, start_time, segment_duration)
+        if audio_success:
+            print(f"  ✓ Extracted audio to {audio_path}")
+        else:
+            print(f"  ✗ Failed to extract audio")
+            return None
+        
+        # Transcribe audio (with timeout) if not skipped
+        transcript = None
+        if not skip_transcription and track_words is not None:
+            transcript = slice_transcript(track_words, start_time, start_time + segment_duration)
+        elif not skip_transcription and os.path.exists(audio_path) and os.path.getsize(audio_path) > 0:
+            transcript = transcribe_audio(audio_path, language, timeout_seconds=60)
+        else:
+            if skip_transcription:
+                print(f"  ℹ Transcription skipped as requested")
+            else:
+                print(f"  ✗ Audio file is empty or missing, skipping transcription")
+        
+        transcript_path = os.path.join(output_dir, f"transcript_{i}.txt")
+        
+        if transcript:
+            # Save transcript to file
+            with open(transcript_path, 'w', encoding='utf-8') as f:
+                f.write(transcript)
+            print(f"  ✓ Created transcript: {transcript_path}")
+        else:
+            print(f"  ✗ No transcript generated")
+            transcript_path = None
+        
+        # Add segment info
+        segment_info = {
+            "segment": i,
+            "startTime": start_time,
+            "frameFile": f"frame_{i}.jpg",
+            "audioFile": f"audio_{i}.mp3"
+        }
+        
+        # Add transcript info if available
+        if transcript:
+            segment_info["transcriptFile"] = f"transcript_{i}.txt"
+            segment_info["transcript"] = transcript
+        
+        return segment_info
+    
+    except Exception as e:
+        print(f"  ✗ Error processing segment {i}: {str(e)}")
+        return None
+
+def write_metadata_atomic(metadata, metadata_path):
+    """Write metadata to a temporary file and atomically replace the target."""
+    tmp_path = f"{metadata_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, metadata_path)
+
+class SegmentJournal:
+    """Append-only JSONL log of finished segments, compacted into metadata.json at the end of a run."""
+    
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+    
+    def load(self):
+        """Return the segments recorded by an earlier run, ignoring a torn last record."""
+        if not os.path.exists(self.path):
+            return []
+        
+        segments = []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    segments.append(json.loads(line))
+                except ValueError:
+                    print(f"Ignoring incomplete journal record in {self.path}")
+        return segments
+    
+    def append(self, segment_info):
+        """Durably record one finished segment."""
+        if self.file is None:
+            # Terminate a torn record from a crash so the new record starts on its own line
+            needs_newline = False
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    needs_newline = f.read(1) != b"\n"
+            self.file = open(self.path, 'a', encoding='utf-8')
+            if needs_newline:
+                self.file.write("\n")
+        
+        self.file.write(json.dumps(segment_info, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    
+    def remove(self):
+        """Delete the journal once its records are part of metadata.json."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
 
 def prepare_video(video_path, base_dir="website/videos", language="en", 
-                 skip_transcription=False, start_segment=0, end_segment=None):
-    """Process a video file, extracting frames and audio segments every 30 seconds."""
+                 skip_transcription=False, start_segment=0, end_segment=None,
+                 batch_extract=False, workers=1, gate=False, scene_threshold=None, transcription="segment"):
+    """
+    Process a video file, extracting frames and audio segments every 30 seconds.
+    
+    With gate, segments whose frame and transcript barely differ from the last changed
+    segment are marked "unchanged" so generate_advice.py skips them. With scene_threshold,
+    extra frames are extracted at scene cuts and attached to their segments. With
+    transcription="track" the audio is transcribed in a few large requests and the segment
+    transcripts are sliced from the word timings.
+    """
     if not os.path.exists(video_path):
         print(f"Error: Video file '{video_path}' not found.")
         return False
     
     # Get video duration
     duration = get_video_duration(video_path)
+    if duration is None:
+        return False
     print(f"Video duration: {duration:.2f} seconds")
     
     # Create output directory
@@ -223,104 +522,126 @@ def prepare_video(video_path, base_dir="website/videos", language="en",
     
     print(f"Processing segments {start_segment} to {end_segment-1}...")
     
-    # Load existing metadata if available
-    existing_segments = []
+    # Load existing metadata if available, indexed by segment number
+    segments_by_number = {}
     metadata_path = os.path.join(output_dir, "metadata.json")
     if os.path.exists(metadata_path):
         try:
             with open(metadata_path, 'r') as f:
                 existing_metadata = json.load(f)
-                existing_segments = existing_metadata.get("segments", [])
-                print(f"Loaded {len(existing_segments)} existing segments from metadata")
+                for segment in existing_metadata.get("segments", []):
+                    segments_by_number[segment["segment"]] = segment
+                print(f"Loaded {len(segments_by_number)} existing segments from metadata")
         except Exception as e:
             print(f"Error loading existing metadata: {str(e)}")
     
-    # Process each segment
-    segments = existing_segments.copy()
-    for i in range(start_segment, end_segment):
-        start_time = i * segment_duration
-        print(f"Processing segment {i+1}/{end_segment} (starting at {start_time}s)...")
-        
-        # Check if segment already exists in metadata
-        existing_segment = next((s for s in existing_segments if s["segment"] == i), None)
-        if existing_segment:
-            print(f"  Segment {i} already exists in metadata, skipping...")
-            continue
-        
+    # Recover segments committed by an interrupted run
+    journal = SegmentJournal(os.path.join(output_dir, "segments.jsonl"))
+    recovered = [s for s in journal.load() if s["segment"] not in segments_by_number]
+    
+    # Runs from before the journal checkpointed into metadata_temp.json
+    temp_metadata_path = os.path.join(output_dir, "metadata_temp.json")
+    if os.path.exists(temp_metadata_path):
         try:
-            # Extract frame
-            print(f"  Extracting frame at {start_time}s...")
-            frame_path = os.path.join(output_dir, f"frame_{i}.jpg")
-            frame_success = extract_frame(video_path, frame_path, start_time)
-            if frame_success:
-                print(f"  ✓ Extracted frame to {frame_path}")
-            else:
-                print(f"  ✗ Failed to extract frame")
-            
-            # Extract audio
-            print(f"  Extracting audio segment at {start_time}s...")
-            audio_path = os.path.join(output_dir, f"audio_{i}.mp3")
-            audio_success = extract_audio_segment(video_path, audio_path, start_time, segment_duration)
-            if audio_success:
-                print(f"  ✓ Extracted audio to {audio_path}")
+            with open(temp_metadata_path, 'r') as f:
+                temp_metadata = json.load(f)
+            recovered.extend(s for s in temp_metadata.get("segments", []) if s["segment"] not in segments_by_number)
+        except Exception as e:
+            print(f"Error loading temporary metadata: {str(e)}")
+    
+    if recovered:
+        for segment in recovered:
+            segments_by_number[segment["segment"]] = segment
+        print(f"Recovered {len(recovered)} segments from interrupted run "
+              f"(last processed segment: {max(s['segment'] for s in recovered)})")
+    
+    pending = [i for i in range(start_segment, end_segment) if i not in segments_by_number]
+    
+    # Runs of consecutive missing segments; segments done earlier inside a span are not touched again
+    pending_runs = get_contiguous_runs(pending)
+    
+    # Extract each run of missing segments in one FFmpeg pass if requested
+    batch_extracted = set()
+    if batch_extract and pending:
+        for run_start, run_end in pending_runs:
+            print(f"Batch extracting segments {run_start} to {run_end - 1} in a single pass...")
+            if extract_segments_batch(video_path, output_dir, run_start, run_end, segment_duration):
+                batch_extracted.update(range(run_start, run_end))
+                print("✓ Batch extraction complete")
             else:
-                print(f"  ✗ Failed to extract audio")
+                print("✗ Batch extraction failed, falling back to per-segment extraction")
+    
+    skipped = (end_segment - start_segment) - len(pending)
+    if skipped > 0:
+        print(f"Skipping {skipped} segments that already exist in metadata")
+    
+    # Transcribe the whole range up front and slice it per segment
+    track_words = None
+    if transcription == "track" and pending and not skip_transcription:
+        if os.getenv("ELEVENLABS_API_KEY"):
+            with get_tracer().span("transcribe_track"):
+                track_words = transcribe_track(
+                    video_path, output_dir,
+                    [(run_start * segment_duration, min(duration, run_end * segment_duration))
+                     for run_start, run_end in pending_runs],
+                    language
+                )
+        if track_words is None:
+            print("Falling back to per-segment transcription")
+    
+    def run_segment(i):
+        print(f"Processing segment {i+1}/{end_segment} (starting at {i * segment_duration}s)...")
+        with get_tracer().span("prepare_video.segment", segment=i):
+            return process_segment(
+                video_path, output_dir, i, segment_duration, language,
+                skip_transcription=skip_transcription, batch_extracted=i in batch_extracted, track_words=track_words
+            )
+    
+    # Workers extract and transcribe segments concurrently, while this thread is the
+    # single writer that commits finished segments to the journal in segment order
+    executor = None
+    futures = {}
+    if workers > 1 and len(pending) > 1:
+        print(f"Processing {len(pending)} segments with {workers} workers...")
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = {i: executor.submit(run_segment, i) for i in pending}
+    
+    try:
+        for i in pending:
+            segment_info = futures[i].result() if executor else run_segment(i)
+            if not segment_info:
                 continue
             
-            # Transcribe audio (with timeout) if not skipped
-            transcript = None
-            if not skip_transcription and os.path.exists(audio_path) and os.path.getsize(audio_path) > 0:
-                transcript = transcribe_audio(audio_path, language, timeout_seconds=60)
-            else:
-                if skip_transcription:
-                    print(f"  ℹ Transcription skipped as requested")
-                else:
-                    print(f"  ✗ Audio file is empty or missing, skipping transcription")
-            
-            transcript_path = os.path.join(output_dir, f"transcript_{i}.txt")
-            
-            if transcript:
-                # Save transcript to file
-                with open(transcript_path, 'w', encoding='utf-8') as f:
-                    f.write(transcript)
-                print(f"  ✓ Created transcript: {transcript_path}")
-            else:
-                print(f"  ✗ No transcript generated")
-                transcript_path = None
-            
-            # Add segment info
-            segment_info = {
-                "segment": i,
-                "startTime": start_time,
-                "frameFile": f"frame_{i}.jpg",
-                "audioFile": f"audio_{i}.mp3"
-            }
-            
-            # Add transcript info if available
-            if transcript:
-                segment_info["transcriptFile"] = f"transcript_{i}.txt"
-                segment_info["transcript"] = transcript
-            
-            segments.append(segment_info)
-            
-            # Save metadata after each segment (in case of crash)
-            temp_metadata = {
-                "originalVideo": video_filename,
-                "totalDuration": duration,
-                "segmentCount": num_segments,
-                "segments": segments,
-                "lastProcessedSegment": i
-            }
-            
-            temp_metadata_path = os.path.join(output_dir, "metadata_temp.json")
-            with open(temp_metadata_path, 'w') as f:
-                json.dump(temp_metadata, f, indent=2)
-                
-        except Exception as e:
-            print(f"  ✗ Error processing segment {i}: {str(e)}")
-            # Continue with next segment
+            # Checkpoint the segment (in case of crash) in constant time
+            segments_by_number[i] = segment_info
+            journal.append(segment_info)
+    finally:
+        journal.close()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+    
+    # Compact metadata and journal into the final metadata file
+    segments = [segments_by_number[number] for number in sorted(segments_by_number)]
+    
+    # Segments done by an earlier run keep the scene frames stored in their metadata
+    if scene_threshold is not None and pending:
+        print(f"Extracting frames at scene cuts (threshold {scene_threshold})...")
+        scene_frames = {}
+        with get_tracer().span("ffmpeg.scene_frames"):
+            for run_start, run_end in pending_runs:
+                scene_frames.update(extract_scene_frames(
+                    video_path, output_dir, segment_duration, scene_threshold,
+                    start_segment=run_start, end_segment=run_end
+                ))
+        for segment in segments:
+            if segment["segment"] in scene_frames:
+                segment["sceneFrames"] = scene_frames[segment["segment"]]
     
-    # Create final metadata file
+    if gate:
+        print("Gating segments by frame hash and transcript similarity...")
+        with get_tracer().span("gate_segments"):
+            unchanged_count = gate_segments(output_dir, segments)
+        print(f"✓ Marked {unchanged_count}/{len(segments)} segments as unchanged")
     metadata = {
         "originalVideo": video_filename,
         "totalDuration": duration,
@@ -328,12 +649,10 @@ def prepare_video(video_path, base_dir="website/videos", language="en",
         "segments": segments
     }
     
-    metadata_path = os.path.join(output_dir, "metadata.json")
-    with open(metadata_path, 'w') as f:
-        json.dump(metadata, f, indent=2)
+    write_metadata_atomic(metadata, metadata_path)
     
-    # Remove temporary metadata file if it exists
-    temp_metadata_path = os.path.join(output_dir, "metadata_temp.json")
+    # The journal is fully contained in metadata.json now
+    journal.remove()
     if os.path.exists(temp_metadata_path):
         try:
             os.remove(temp_metadata_path)
@@ -342,6 +661,7 @@ def prepare_video(video_path, base_dir="website/videos", language="en",
     
     print(f"\nProcessing complete! Metadata saved to {metadata_path}")
     print(f"Created {len(segments)} segments in {output_dir}")
+    print_cache_stats()
     return True
 
 def check_ffmpeg():
@@ -377,9 +697,20 @@ if __name__ == "__main__":
     parser.add_argument("--skip-transcription", action="store_true", help="Skip the transcription step")
     parser.add_argument("--start-segment", type=int, default=0, help="Start processing from this segment number")
     parser.add_argument("--end-segment", type=int, default=None, help="Stop processing at this segment number")
+    parser.add_argument("--batch-extract", action="store_true", help="Extract all frames and audio segments in a single FFmpeg pass")
+    parser.add_argument("--workers", type=int, default=1, help="Number of segments to extract and transcribe concurrently (default: 1)")
+    parser.add_argument("--transcription", choices=["segment", "track"], default="segment",
+                        help="Transcribe each segment separately, or the whole track in a few requests sliced by word timings (default: segment)")
+    parser.add_argument("--gate", action="store_true", help="Mark segments that barely changed so no advice is generated for them")
+    parser.add_argument("--scene-threshold", type=float, nargs='?', const=DEFAULT_SCENE_THRESHOLD, default=None,
+                        help=f"Extract extra frames at scene cuts above this scene score (default: off, {DEFAULT_SCENE_THRESHOLD} if given without a value)")
+    parser.add_argument("--trace", nargs='?', const="", help="Write a JSONL trace of spans, requests and retries and print a summary (default path: traces/prepare_video_<time>.jsonl)")
     
     args = parser.parse_args()
     
+    if args.trace is not None:
+        configure_tracing(args.trace or default_trace_path(__file__))
+    
     # Check if FFmpeg is installed
     if not check_ffmpeg():
         print("Please install FFmpeg and make sure it's in your PATH.")
@@ -389,11 +720,21 @@ if __name__ == "__main__":
     os.makedirs(args.output_dir, exist_ok=True)
     
     # Process the video
-    prepare_video(
-        args.video_path, 
-        args.output_dir, 
-        args.language, 
-        skip_transcription=args.skip_transcription,
-        start_segment=args.start_segment,
-        end_segment=args.end_segment
-    )
+    with get_tracer().span("prepare_video"):
+        success = prepare_video(
+            args.video_path, 
+            args.output_dir, 
+            args.language, 
+            skip_transcription=args.skip_transcription,
+            start_segment=args.start_segment,
+            end_segment=args.end_segment,
+            batch_extract=args.batch_extract,
+            workers=args.workers,
+            gate=args.gate,
+            scene_threshold=args.scene_threshold,
+            transcription=args.transcription
+        )
+    print_trace_summary()
+    
+    if not success:
+        sys.exit(1)
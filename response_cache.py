@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+# Shared by every script, so the location does not depend on the video or knowledge folder layout
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "duoai", "responses")
+DEFAULT_MAX_MB = 2048
+
+def make_cache_key(namespace, payload, blobs=()):
+    """
+    Build a content-addressed key from the request payload.
+
+    The payload is serialised with sorted keys so equal requests always hash the same,
+    and binary inputs (images, audio) are hashed separately instead of being serialised.
+    """
+    digest = hashlib.sha256()
+    digest.update(namespace.encode('utf-8'))
+    digest.update(b"\0")
+    digest.update(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    for blob in blobs:
+        digest.update(b"\0")
+        digest.update(hashlib.sha256(blob).digest())
+    return digest.hexdigest()
+
+class ResponseCache:
+    """On-disk cache of API responses with a size cap and least-recently-used eviction."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_MB * 1024 * 1024, enabled=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Create a cache configured by DUOAI_CACHE_DIR, DUOAI_CACHE_MAX_MB and DUOAI_CACHE_DISABLE."""
+        return cls(
+            cache_dir=os.getenv("DUOAI_CACHE_DIR", DEFAULT_CACHE_DIR),
+            max_bytes=int(float(os.getenv("DUOAI_CACHE_MAX_MB", DEFAULT_MAX_MB)) * 1024 * 1024),
+            enabled=os.getenv("DUOAI_CACHE_DISABLE", "").lower() not in ("1", "true", "yes")
+        )
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _entries(self):
+        """Yield (path, size, mtime) for every cached entry."""
+        if not os.path.exists(self.cache_dir):
+            return
+        for root, _, files in os.walk(self.cache_dir):
+            for filename in files:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        """Return the cached bytes for a key, or None on a miss."""
+        if not self.enabled:
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Touch the entry so eviction treats it as recently used
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """Store bytes under a key, evicting the least recently used entries if over the cap."""
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so readers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"  ✗ Could not write response cache entry: {str(e)}")
+            return
+
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self.total_bytes += len(data) - previous_size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Delete the least recently used entries until the cache is 10% below its cap."""
+        target = self.max_bytes * 0.9
+        for path, size, _ in sorted(self._entries(), key=lambda entry: entry[2]):
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+                self.total_bytes -= size
+                self.evictions += 1
+            except OSError:
+                pass
+
+    def get_json(self, key):
+        """Return a cached JSON value, or None on a miss."""
+        data = self.get(key)
+        if data is None:
+            return None
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            return None
+
+    def put_json(self, key, value):
+        """Store a JSON-serialisable value."""
+        self.put(key, json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+    def stats(self):
+        """Return hit/miss counters for this process."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": self.hits / lookups if lookups else 0.0
+        }
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """Return the process-wide response cache."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache.from_env()
+        return _default_cache
+
+def print_cache_stats():
+    """Print the response cache counters if the cache was used."""
+    cache = get_response_cache()
+    stats = cache.stats()
+    if stats["hits"] or stats["misses"]:
+        print(f"Response cache: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hitRate']:.0%} hit rate), {stats['evictions']} evictions")
@@ -0,0 +1,227 @@
+import os
+import re
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+# A segment is unchanged when its frame differs from the last advised frame by at most this
+# many of the 64 hash bits and its transcript is at least this similar to that segment's
+DEFAULT_HASH_THRESHOLD = 6
+DEFAULT_TEXT_THRESHOLD = 0.5
+
+# Scene score (0-1) above which FFmpeg reports a cut, and how many cut frames a segment keeps
+DEFAULT_SCENE_THRESHOLD = 0.4
+MAX_SCENE_FRAMES = 2
+
+# Bytes FFmpeg writes per frame hashed: 9x8 grayscale pixels
+HASH_FRAME_BYTES = 72
+
+def hash_pixels(raw):
+    """Return the dHash hex string of 9x8 grayscale pixels: one bit per pixel brighter than its right neighbour."""
+    pixels = np.frombuffer(raw, dtype=np.uint8).reshape(8, 9).astype(np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return f"{int(np.packbits(bits).view('>u8')[0]):016x}"
+
+def compute_frame_hash(image_path, timeout=30):
+    """
+    Return the 64-bit difference hash (dHash) of an image as a hex string, or None on failure.
+
+    FFmpeg shrinks the image to 9x8 grayscale pixels; each bit records whether a pixel is
+    brighter than its right neighbour, so small changes in a frame flip only a few bits.
+    """
+    cmd = [
+        'ffmpeg',
+        '-v', 'error',
+        '-i', image_path,
+        '-vf', 'scale=9:8:flags=area,format=gray',
+        '-f', 'rawvideo',
+        'pipe:1'
+    ]
+
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        if result.returncode != 0 or len(result.stdout) != HASH_FRAME_BYTES:
+            print(f"  ✗ Could not hash frame {image_path}: {result.stderr.decode(errors='replace').strip()}")
+            return None
+    except Exception as e:
+        print(f"  ✗ Could not hash frame {image_path}: {str(e)}")
+        return None
+
+    return hash_pixels(result.stdout)
+
+def compute_frame_hashes(image_paths, staging_parent=None, timeout=300):
+    """
+    Return a dict of image path -> dHash (or None) for many images with a single FFmpeg process.
+
+    The images are linked into a staging directory as a numbered sequence, FFmpeg decodes
+    the sequence as one input, and its raw output is split into one 9x8 frame per image. If
+    the pass fails, or a broken image leaves the output misaligned, each image is hashed on its own.
+    """
+    image_paths = list(image_paths)
+    if not image_paths:
+        return {}
+
+    with tempfile.TemporaryDirectory(dir=staging_parent, prefix=".hash_") as staging_dir:
+        for n, image_path in enumerate(image_paths):
+            staged_path = os.path.join(staging_dir, f"{n}.jpg")
+            try:
+                os.link(image_path, staged_path)
+            except OSError:
+                shutil.copyfile(image_path, staged_path)
+
+        cmd = [
+            'ffmpeg',
+            '-v', 'error',
+            '-f', 'image2',
+            '-start_number', '0',
+            '-i', os.path.join(staging_dir, '%d.jpg'),
+            '-vf', 'scale=9:8:flags=area,format=gray',
+            '-vsync', 'passthrough',
+            '-f', 'rawvideo',
+            'pipe:1'
+        ]
+
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+            output = result.stdout if result.returncode == 0 else b""
+        except Exception as e:
+            print(f"  ✗ Could not hash frames in one pass: {str(e)}")
+            output = b""
+
+    if len(output) != HASH_FRAME_BYTES * len(image_paths):
+        print("  ✗ Could not hash frames in one pass, hashing them one by one")
+        return {image_path: compute_frame_hash(image_path) for image_path in image_paths}
+
+    return {
+        image_path: hash_pixels(output[n * HASH_FRAME_BYTES:(n + 1) * HASH_FRAME_BYTES])
+        for n, image_path in enumerate(image_paths)
+    }
+
+def hamming_distance(hash_a, hash_b):
+    """Return the number of differing bits between two hex hashes."""
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+def transcript_similarity(text_a, text_b):
+    """Return the Jaccard similarity of the word sets of two transcripts (1.0 if both are empty)."""
+    words_a = set(re.findall(r"[a-z0-9']+", (text_a or "").lower()))
+    words_b = set(re.findall(r"[a-z0-9']+", (text_b or "").lower()))
+    if not words_a and not words_b:
+        return 1.0
+    return len(words_a & words_b) / len(words_a | words_b)
+
+def extract_scene_frames(video_path, output_dir, segment_duration=30, threshold=DEFAULT_SCENE_THRESHOLD,
+                         max_per_segment=MAX_SCENE_FRAMES, timeout=None, start_segment=0, end_segment=None):
+    """
+    Extract a frame at every scene cut between start_segment and end_segment in one FFmpeg pass.
+
+    Only that range is decoded (the whole video if end_segment is None). Frames are saved as
+    scene_<segment>_<n>.jpg, keeping at most max_per_segment per segment.
+    Returns a dict of segment number -> list of {"time", "frameFile"}.
+    """
+    start_time = start_segment * segment_duration
+    range_args = ['-ss', str(start_time)] if start_time else []
+    if end_segment is not None:
+        range_args += ['-t', str((end_segment - start_segment) * segment_duration)]
+
+    with tempfile.TemporaryDirectory(dir=output_dir, prefix=".scenes_") as staging_dir:
+        cmd = [
+            'ffmpeg',
+            *range_args,
+            '-i', video_path,
+            '-vf', f"select='gt(scene,{threshold})',showinfo",
+            '-vsync', 'vfr',
+            '-q:v', '2',
+            '-y',
+            os.path.join(staging_dir, 'cut_%d.jpg')
+        ]
+
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=timeout)
+            if result.returncode != 0:
+                print(f"Error detecting scene cuts: {result.stderr[-500:]}")
+                return {}
+        except Exception as e:
+            print(f"Error detecting scene cuts: {str(e)}")
+            return {}
+
+        # showinfo logs one line per selected frame, in output order, timed from the seek point
+        cut_times = [start_time + float(t)
+                     for t in re.findall(r"Parsed_showinfo.*?pts_time:\s*([\d.]+)", result.stderr)]
+
+        scene_frames = {}
+        for n, cut_time in enumerate(cut_times, start=1):
+            segment_num = int(cut_time // segment_duration)
+            frames = scene_frames.setdefault(segment_num, [])
+            if len(frames) >= max_per_segment:
+                continue
+            staged_path = os.path.join(staging_dir, f"cut_{n}.jpg")
+            if not os.path.exists(staged_path):
+                continue
+            frame_file = f"scene_{segment_num}_{len(frames)}.jpg"
+            shutil.move(staged_path, os.path.join(output_dir, frame_file))
+            frames.append({"time": round(cut_time, 3), "frameFile": frame_file})
+
+    print(f"✓ Found {len(cut_times)} scene cuts in {len(scene_frames)} segments")
+    return scene_frames
+
+def gate_segments(output_dir, segments, hash_threshold=DEFAULT_HASH_THRESHOLD, text_threshold=DEFAULT_TEXT_THRESHOLD):
+    """
+    Mark segments whose screen and transcript barely changed as "unchanged".
+
+    Each segment is compared with the last segment that was not unchanged, so a slow drift
+    still produces advice once it adds up. Segments with scene cuts are never unchanged.
+    Updates the segments in place (frameHash, unchanged) and returns the number marked.
+    """
+    # Hash every frame that has no hash yet in one FFmpeg pass
+    unhashed = {
+        os.path.join(output_dir, segment["frameFile"]): segment
+        for segment in segments
+        if not segment.get("frameHash") and segment.get("frameFile")
+        and os.path.exists(os.path.join(output_dir, segment["frameFile"]))
+    }
+    for frame_path, frame_hash in compute_frame_hashes(unhashed, staging_parent=output_dir).items():
+        unhashed[frame_path]["frameHash"] = frame_hash
+
+    reference = None
+    unchanged_count = 0
+    for segment in sorted(segments, key=lambda s: s["segment"]):
+
+        unchanged = (
+            reference is not None
+            and segment.get("frameHash") is not None
+            and reference.get("frameHash") is not None
+            and not segment.get("sceneFrames")
+            and hamming_distance(segment["frameHash"], reference["frameHash"]) <= hash_threshold
+            and transcript_similarity(segment.get("transcript"), reference.get("transcript")) >= text_threshold
+        )
+        segment["unchanged"] = unchanged
+        if unchanged:
+            unchanged_count += 1
+        else:
+            reference = segment
+
+    return unchanged_count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mark prepared segments whose screen and transcript barely changed.")
+    parser.add_argument("prepared_folder", help="Folder containing metadata.json and the segment frames")
+    parser.add_argument("--hash-threshold", type=int, default=DEFAULT_HASH_THRESHOLD,
+                        help=f"Maximum differing frame hash bits for an unchanged segment (default: {DEFAULT_HASH_THRESHOLD})")
+    parser.add_argument("--text-threshold", type=float, default=DEFAULT_TEXT_THRESHOLD,
+                        help=f"Minimum transcript similarity for an unchanged segment (default: {DEFAULT_TEXT_THRESHOLD})")
+
+    args = parser.parse_args()
+
+    metadata_path = os.path.join(args.prepared_folder, "metadata.json")
+    with open(metadata_path, 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+
+    segments = metadata.get("segments", [])
+    unchanged_count = gate_segments(args.prepared_folder, segments, args.hash_threshold, args.text_threshold)
+
+    with open(metadata_path, 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=2)
+    print(f"✓ Marked {unchanged_count}/{len(segments)} segments as unchanged in {metadata_path}")
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import time
+import threading
+from datetime import datetime
+
+# Numeric event fields that are summed per row of the summary table
+SUMMED_FIELDS = ("duration", "bytes_sent", "bytes_received", "input_tokens", "output_tokens",
+                 "cache_creation_input_tokens", "cache_read_input_tokens", "delay")
+
+def default_trace_path(script):
+    """Return a new trace file path for a run of a script, e.g. traces/prepare_video_20250101-120000.jsonl."""
+    name = os.path.splitext(os.path.basename(script))[0]
+    return os.path.join("traces", f"{name}_{datetime.now().strftime('%Y%m%d-%H%M%S')}.jsonl")
+
+class _NullSpan:
+    """Span returned while tracing is disabled; attributes set on it are discarded."""
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    def __init__(self, tracer, name, fields):
+        self.tracer = tracer
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.fields
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.fields["error"] = f"{exc_type.__name__}: {exc}"
+        self.tracer.event("span", self.name, duration=time.perf_counter() - self.start, **self.fields)
+        return False
+
+class Tracer:
+    """
+    Records stage spans, API requests, retries and sleeps of one run.
+
+    Every event is appended to a JSONL file as it happens and added to per-name totals for
+    the summary table. A tracer without a path is disabled and every call returns at once.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.enabled = path is not None
+        self.file = None
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.totals = {}  # (kind, name) -> counters
+
+    @classmethod
+    def from_env(cls):
+        """Create a tracer writing to DUOAI_TRACE, or a disabled one if it is not set."""
+        return cls(os.getenv("DUOAI_TRACE") or None)
+
+    def event(self, kind, name, **fields):
+        """Write one event and add it to the totals."""
+        if not self.enabled:
+            return
+        record = {"t": round(time.perf_counter() - self.start, 6), "kind": kind, "name": name,
+                  "thread": threading.current_thread().name, **fields}
+        line = json.dumps(record, default=str)
+
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self.file = open(self.path, 'a', encoding='utf-8')
+                self.file.write(json.dumps({"t": 0, "kind": "run", "name": os.path.basename(sys.argv[0]),
+                                            "argv": sys.argv[1:], "started": datetime.now().isoformat()}) + "\n")
+            self.file.write(line + "\n")
+            self.file.flush()
+
+            totals = self.totals.setdefault((kind, name), {"count": 0, "errors": 0})
+            totals["count"] += 1
+            if fields.get("error") or fields.get("status", 200) >= 400:
+                totals["errors"] += 1
+            for field in SUMMED_FIELDS:
+                value = fields.get(field)
+                if value:
+                    totals[field] = totals.get(field, 0) + value
+
+    def span(self, name, **fields):
+        """
+        Time a block of work. Use as `with tracer.span("ffmpeg.extract_frame") as attrs:`;
+        keys added to attrs inside the block are written with the span.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, fields)
+
+    def request(self, name, started, response=None, error=None, **fields):
+        """
+        Record an HTTP request that began at time.perf_counter() value started.
+
+        Sizes come from the prepared request and the response body, and the token usage of
+        Anthropic responses is read from the response.
+        """
+        if not self.enabled:
+            return
+        duration = time.perf_counter() - started
+        if response is not None:
+            body = response.request.body if response.request is not None else None
+            fields.update(status=response.status_code, bytes_sent=len(body or b""),
+                          bytes_received=len(response.content))
+            if "json" in response.headers.get("Content-Type", ""):
+                try:
+                    usage = response.json().get("usage") or {}
+                    fields.update({key: value for key, value in usage.items() if isinstance(value, int)})
+                except (ValueError, AttributeError):
+                    pass
+        if error is not None:
+            fields["error"] = str(error)
+        self.event("request", name, duration=duration, **fields)
+
+    def retry(self, name, delay, reason=None):
+        """Record that a request is retried after delay seconds."""
+        self.event("retry", name, delay=delay, reason=reason)
+
+    def sleep(self, name, seconds):
+        """Sleep and record the time spent as a "sleep" event."""
+        time.sleep(seconds)
+        self.event("sleep", name, duration=seconds)
+
+    def summary_rows(self):
+        """Return the totals as a list of dicts, slowest first within each kind."""
+        with self.lock:
+            rows = [{"kind": kind, "name": name, **totals} for (kind, name), totals in self.totals.items()]
+        order = {"span": 0, "request": 1, "retry": 2, "sleep": 3}
+        return sorted(rows, key=lambda row: (order.get(row["kind"], 4), -row.get("duration", row.get("delay", 0))))
+
+    def print_summary(self):
+        """Print the summary table and append it to the trace."""
+        if not self.enabled or not self.totals:
+            return
+        rows = self.summary_rows()
+        self.event("summary", "totals", wall=time.perf_counter() - self.start, rows=rows)
+
+        print(f"\nTrace summary ({time.perf_counter() - self.start:.1f}s wall, events in {self.path}):")
+        print(f"  {'kind':<8} {'name':<32} {'count':>6} {'errors':>6} {'total s':>9} {'avg ms':>9} "
+              f"{'sent KB':>9} {'in tok':>9} {'out tok':>8} {'cached':>9}")
+        for row in rows:
+            seconds = row.get("duration", row.get("delay", 0))
+            print(f"  {row['kind']:<8} {row['name'][:32]:<32} {row['count']:>6} {row['errors']:>6} "
+                  f"{seconds:>9.2f} {seconds / row['count'] * 1000:>9.1f} "
+                  f"{row.get('bytes_sent', 0) / 1024:>9.1f} {row.get('input_tokens', 0):>9} "
+                  f"{row.get('output_tokens', 0):>8} {row.get('cache_read_input_tokens', 0):>9}")
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+def get_tracer():
+    """Return the process-wide tracer."""
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                _tracer = Tracer.from_env()
+    return _tracer
+
+def configure_tracing(path):
+    """Enable tracing to path for this process (e.g. from a --trace flag) and return the tracer."""
+    global _tracer
+    with _tracer_lock:
+        if _tracer is not None:
+            _tracer.close()
+        _tracer = Tracer(path)
+        if path:
+            print(f"Tracing to {path}")
+        return _tracer
+
+def print_trace_summary():
+    """Print the trace summary table if tracing is enabled."""
+    tracer = get_tracer()
+    tracer.print_summary()
+    tracer.close()
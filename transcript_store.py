@@ -0,0 +1,179 @@
+import os
+import json
+import mmap
+import argparse
+import numpy as np
+
+# The store lives next to the transcript files it was built from
+STORE_DIRNAME = ".store"
+STORE_VERSION = 1
+
+def get_transcript_manifest(transcripts_dir):
+    """Return name, size and mtime of every timestamped transcript, used to detect a stale store."""
+    manifest = []
+    for filename in sorted(os.listdir(transcripts_dir)):
+        if not filename.endswith('.json'):
+            continue
+        stat = os.stat(os.path.join(transcripts_dir, filename))
+        manifest.append([filename, stat.st_size, int(stat.st_mtime)])
+    return manifest
+
+class TranscriptStore:
+    """
+    Columnar store of timestamped transcript segments for a whole transcripts folder.
+
+    Segment starts, durations and text offsets are NumPy arrays and all segment text is one
+    UTF-8 blob; everything is memory-mapped, so opening the store reads almost nothing and a
+    time-window lookup is a binary search over the rows of one video.
+    """
+
+    def __init__(self, videos, starts, durations, max_ends, offsets, text):
+        self.videos = videos  # name -> (first_row, end_row)
+        self.starts = starts
+        self.durations = durations
+        self.max_ends = max_ends  # running maximum of start + duration within each video
+        self.offsets = offsets
+        self.text = text
+
+    @staticmethod
+    def build(transcripts_dir, manifest=None):
+        """Convert every transcript .json in the folder into the store files."""
+        manifest = manifest if manifest is not None else get_transcript_manifest(transcripts_dir)
+        store_dir = os.path.join(transcripts_dir, STORE_DIRNAME)
+        os.makedirs(store_dir, exist_ok=True)
+
+        videos = []
+        starts = []
+        durations = []
+        offsets = [0]
+        position = 0
+        with open(os.path.join(store_dir, "text.bin"), 'wb') as text_file:
+            for filename, _, _ in manifest:
+                try:
+                    with open(os.path.join(transcripts_dir, filename), 'r', encoding='utf-8') as f:
+                        segments = json.load(f)
+                except Exception as e:
+                    print(f"Error reading transcript {filename}: {str(e)}")
+                    continue
+
+                segments = sorted(segments, key=lambda segment: segment.get('start', 0))
+                videos.append([filename[:-len('.json')], len(starts), len(starts) + len(segments)])
+                for segment in segments:
+                    data = segment.get('text', '').encode('utf-8')
+                    text_file.write(data)
+                    position += len(data)
+                    starts.append(segment.get('start', 0))
+                    durations.append(segment.get('duration', 0))
+                    offsets.append(position)
+
+        starts = np.array(starts, dtype=np.float64)
+        durations = np.array(durations, dtype=np.float32)
+        max_ends = starts + durations
+        for _, first, end in videos:
+            if end > first:
+                max_ends[first:end] = np.maximum.accumulate(max_ends[first:end])
+
+        np.save(os.path.join(store_dir, "starts.npy"), starts)
+        np.save(os.path.join(store_dir, "durations.npy"), durations)
+        np.save(os.path.join(store_dir, "max_ends.npy"), max_ends)
+        np.save(os.path.join(store_dir, "offsets.npy"), np.array(offsets, dtype=np.int64))
+
+        # Written last, so a store interrupted while building is never considered valid
+        with open(os.path.join(store_dir, "index.json"), 'w', encoding='utf-8') as f:
+            json.dump({"version": STORE_VERSION, "manifest": manifest, "videos": videos}, f)
+
+    @classmethod
+    def load(cls, transcripts_dir, manifest=None):
+        """Memory-map a built store, or return None if it is missing or out of date."""
+        store_dir = os.path.join(transcripts_dir, STORE_DIRNAME)
+        index_path = os.path.join(store_dir, "index.json")
+        if not os.path.exists(index_path):
+            return None
+
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                info = json.load(f)
+            if info.get("version") != STORE_VERSION:
+                return None
+            if manifest is not None and info.get("manifest") != manifest:
+                return None
+
+            arrays = {
+                name: np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode='r')
+                for name in ("starts", "durations", "max_ends", "offsets")
+            }
+            text = b""
+            if arrays["offsets"][-1] > 0:
+                with open(os.path.join(store_dir, "text.bin"), 'rb') as f:
+                    text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            videos = {name: (first, end) for name, first, end in info["videos"]}
+            return cls(videos, arrays["starts"], arrays["durations"], arrays["max_ends"], arrays["offsets"], text)
+        except Exception as e:
+            print(f"Error loading transcript store: {str(e)}")
+            return None
+
+    def get_text(self, row):
+        """Return the text of one segment row."""
+        return self.text[self.offsets[row]:self.offsets[row + 1]].decode('utf-8')
+
+    def find_video(self, video):
+        """Resolve a video ID or transcript name to its name in the store, or None."""
+        if video in self.videos:
+            return video
+        for name in self.videos:
+            if name.startswith(f"{video}_"):
+                return name
+        return None
+
+    def lookup(self, video, start_time, end_time):
+        """Return the (start, duration, text) segments of a video that overlap [start_time, end_time)."""
+        name = self.find_video(video)
+        if name is None:
+            return []
+
+        first, end = self.videos[name]
+        # First segment that may still be playing at start_time, and first starting after end_time
+        lo = first + int(np.searchsorted(self.max_ends[first:end], start_time, side='right'))
+        hi = first + int(np.searchsorted(self.starts[first:end], end_time, side='left'))
+
+        return [
+            (float(self.starts[row]), float(self.durations[row]), self.get_text(row))
+            for row in range(lo, hi)
+            if self.starts[row] + self.durations[row] > start_time
+        ]
+
+    def get_window_text(self, video, start_time, end_time):
+        """Return the transcript text spoken in a time window, joined the way the .txt files are."""
+        return "\n".join(text for _, _, text in self.lookup(video, start_time, end_time))
+
+def load_or_build_store(transcripts_dir):
+    """Load the store for a transcripts folder, rebuilding it if any transcript changed."""
+    if not os.path.exists(transcripts_dir):
+        print(f"Transcripts directory not found: {transcripts_dir}")
+        return None
+
+    manifest = get_transcript_manifest(transcripts_dir)
+    store = TranscriptStore.load(transcripts_dir, manifest)
+    if store is not None:
+        return store
+
+    print(f"Building transcript store for {len(manifest)} transcripts...")
+    TranscriptStore.build(transcripts_dir, manifest)
+    store = TranscriptStore.load(transcripts_dir, manifest)
+    if store is not None:
+        print(f"✓ Stored {len(store.starts)} segments in {os.path.join(transcripts_dir, STORE_DIRNAME)}")
+    return store
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the columnar store of a transcripts folder.")
+    parser.add_argument("transcripts_dir", help="Directory containing timestamped transcript .json files")
+    parser.add_argument("--video", help="Video ID or transcript name to query")
+    parser.add_argument("--start", type=float, default=0, help="Start of the time window in seconds (default: 0)")
+    parser.add_argument("--end", type=float, default=30, help="End of the time window in seconds (default: 30)")
+
+    args = parser.parse_args()
+
+    store = load_or_build_store(args.transcripts_dir)
+    if store is not None and args.video:
+        for start, duration, text in store.lookup(args.video, args.start, args.end):
+            print(f"[{start:8.2f} +{duration:5.2f}] {text}")